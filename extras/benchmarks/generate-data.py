@@ -0,0 +1,781 @@
+#!/usr/bin/env python
+
+"""Fills a MongoDB database with a synthetic CyHy dataset to benchmark against.
+
+The requests tree, hosts, tallies, host, port and vulnerability scans,
+snapshots, reports and tickets are random but repeatable: the same scale,
+seed, end date and organization count give the same documents.  Their times are spread over the
+YEARS years up to the end date, which is recorded with them; run-benchmarks.py
+times the fiscal year metrics over the last fiscal year before it.  Pass a
+recent end date to have data in the current fiscal year too.
+
+The database is dropped before it is filled.  To avoid dropping real data, a
+database that has collections but wasn't created by this script is left alone.
+
+Usage:
+  COMMAND_NAME [--uri URI] [--database NAME] [--scale SCALE] [--orgs COUNT] [--seed SEED] [--end-date DATE] [--no-indexes]
+  COMMAND_NAME (-h | --help)
+  COMMAND_NAME --version
+
+Options:
+  -h --help                      Show this screen.
+  --version                      Show version.
+  -u URI --uri=URI               MongoDB server to fill [default: mongodb://localhost:27017].
+  -d NAME --database=NAME        Database to fill [default: cyhy-benchmark].
+  -s SCALE --scale=SCALE         Number of tickets: 10k, 1m or 10m [default: 10k].
+  -o COUNT --orgs=COUNT          Number of organizations, instead of the 50, 500
+                                 or 2000 of the scale.
+  -r SEED --seed=SEED            Seed of the random generator [default: 1].
+  -e DATE --end-date=DATE        Date (YYYY-MM-DD) the data runs up to [default: 2026-10-01].
+  --no-indexes                   Don't create the indexes the data functions rely on.
+
+"""
+
+import bisect
+import calendar
+import datetime
+import itertools
+import logging
+import random
+import re
+import socket
+import struct
+import sys
+import time
+
+from bson.objectid import ObjectId
+from docopt import docopt
+import netaddr
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+from cyhy.core import SCAN_TYPE, STAGE, STATUS
+from cyhy.core.common import AGENCY_TYPE, REPORT_TYPE
+
+META_COLLECTION = "benchmark_meta"
+SCALES = {
+    "10k": {"tickets": 10 ** 4, "orgs": 50, "hosts": 5000},
+    "1m": {"tickets": 10 ** 6, "orgs": 500, "hosts": 500000},
+    "10m": {"tickets": 10 ** 7, "orgs": 2000, "hosts": 5000000},
+}
+YEARS = 3  # of data up to the end date
+BATCH_SIZE = 10000  # documents inserted at a time
+FIRST_ADDRESS = int(netaddr.IPAddress("11.0.0.0"))
+SNAPSHOT_INTERVAL = datetime.timedelta(days=7)
+SNAPSHOT_DURATION = datetime.timedelta(days=2)
+PLUGIN_COUNT = 2000
+MEAN_DAYS_TO_CLOSE = 45
+
+# (type, share of the organizations)
+ORG_TYPES = [
+    (AGENCY_TYPE.FEDERAL, 0.30),
+    (AGENCY_TYPE.STATE, 0.15),
+    (AGENCY_TYPE.LOCAL, 0.32),
+    (AGENCY_TYPE.TRIBAL, 0.04),
+    (AGENCY_TYPE.TERRITORIAL, 0.04),
+    (AGENCY_TYPE.PRIVATE, 0.15),
+]
+SLTT_TYPES = (
+    AGENCY_TYPE.STATE,
+    AGENCY_TYPE.LOCAL,
+    AGENCY_TYPE.TRIBAL,
+    AGENCY_TYPE.TERRITORIAL,
+)
+# the sectors ticketReport.scanning_breakdown() counts
+CI_SECTORS = [
+    "CI_CHEMICAL",
+    "CI_COMMERCIAL_FACILITIES",
+    "CI_COMMUNICATIONS",
+    "CI_CRITICAL_MANUFACTURING",
+    "CI_DAMS",
+    "CI_DEFENSE_INDUSTRIAL_BASE",
+    "CI_EMERGENCY_SERVICES",
+    "CI_ENERGY",
+    "CI_FINANCIAL_SERVICES",
+    "CI_FOOD_AND_AGRICULTURE",
+    "CI_GOVERNMENT_FACILITIES",
+    "CI_HEALTHCARE_AND_PUBLIC_HEALTH",
+    "CI_INFORMATION_TECHNOLOGY",
+    "CI_NUCLEAR_REACTORS_MATERIALS_AND_WASTE",
+    "CI_TRANSPORTATION_SYSTEMS",
+    "CI_WATER_AND_WASTEWATER_SYSTEMS",
+]
+STATES = ["AK", "AZ", "CA", "CO", "DC", "FL", "GA", "IL", "MA", "MD", "MN", "NY"]
+STATES += ["OH", "OR", "PA", "PR", "TX", "VA", "WA", "WI"]
+OPERATING_SYSTEMS = [
+    "Linux 3.10 - 4.11",
+    "Linux 2.6.32",
+    "Microsoft Windows Server 2012",
+    "Microsoft Windows Server 2016",
+    "Microsoft Windows 10",
+    "FreeBSD 11.0",
+    "Cisco IOS 15",
+    "Juniper JUNOS 12",
+    "OpenBSD 6.0",
+    "Apple macOS 10.13",
+    "HP printer",
+    "unknown",
+]
+# (port, service name), the risky ones first
+SERVICES = [
+    (21, "ftp"),
+    (23, "telnet"),
+    (445, "microsoft-ds"),
+    (3389, "ms-wbt-server"),
+    (5900, "vnc"),
+    (22, "ssh"),
+    (25, "smtp"),
+    (53, "domain"),
+    (80, "http"),
+    (443, "https"),
+    (8080, "http-proxy"),
+    (8443, "https-alt"),
+]
+RISKY_SERVICE_COUNT = 5
+# (severity, share of the vulnerability tickets)
+SEVERITIES = [(1, 0.30), (2, 0.45), (3, 0.17), (4, 0.08)]
+CVSS_RANGES = {1: (0.1, 3.9), 2: (4.0, 6.9), 3: (7.0, 8.9), 4: (9.0, 10.0)}
+SEVERITY_NAMES = {1: "low", 2: "medium", 3: "high", 4: "critical"}
+HOST_STATUSES = [
+    (STATUS.DONE, 0.70),
+    (STATUS.WAITING, 0.15),
+    (STATUS.READY, 0.10),
+    (STATUS.RUNNING, 0.05),
+]
+SCAN_STAGES = [STAGE.NETSCAN1, STAGE.NETSCAN2, STAGE.PORTSCAN, STAGE.VULNSCAN]
+
+DEFAULT_LOGGER_LEVEL = logging.INFO
+logging.basicConfig(
+    level=DEFAULT_LOGGER_LEVEL, format="%(asctime)s %(levelname)s %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+###############################################################################
+#  Utils
+###############################################################################
+
+
+def weighted_choice(rng, choices):
+    """Returns the value of one of the (value, weight) choices."""
+    target = rng.random() * sum(weight for value, weight in choices)
+    for value, weight in choices:
+        target -= weight
+        if target < 0:
+            return value
+    return choices[-1][0]
+
+
+def object_id(rng, when):
+    """Returns an ObjectId for when whose other bytes come from rng, so the
+    ids are repeatable."""
+    seconds = calendar.timegm(when.utctimetuple())
+    return ObjectId(struct.pack(">IQ", seconds, rng.getrandbits(64)))
+
+
+def random_time(rng, start, end):
+    return start + datetime.timedelta(
+        seconds=rng.random() * (end - start).total_seconds()
+    )
+
+
+def ip_string(ip_int):
+    return socket.inet_ntoa(struct.pack(">I", ip_int))
+
+
+def insert_batches(collection, docs):
+    """Inserts the documents generated by docs BATCH_SIZE at a time and
+    returns their number."""
+    count = 0
+    batch = list()
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            count += len(batch)
+            batch = list()
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        count += len(batch)
+    logger.info("inserted {:,d} documents into {!s}".format(count, collection.name))
+    return count
+
+
+###############################################################################
+#  Organizations
+###############################################################################
+
+
+class Org(object):
+    """An organization, its addresses and its snapshots."""
+
+    def __init__(self, org_id, org_type, location, first_address, address_count):
+        self.id = org_id
+        self.type = org_type
+        self.location = location  # [longitude, latitude]
+        self.first_address = first_address
+        self.address_count = address_count
+        self.snapshot_times = list()
+        self.snapshot_ids = list()
+
+    def snapshots_at(self, when):
+        """Returns a list of the id of the last snapshot started by when, if
+        any."""
+        i = bisect.bisect_right(self.snapshot_times, when) - 1
+        if i < 0:
+            return []
+        return [self.snapshot_ids[i]]
+
+
+def make_orgs(rng, scale):
+    """Returns the stakeholder organizations, with their share of the
+    addresses weighted so a few large organizations own most of them."""
+    weights = [rng.paretovariate(1.2) for i in range(scale["orgs"])]
+    total_weight = sum(weights)
+    orgs = list()
+    next_address = FIRST_ADDRESS
+    for i, weight in enumerate(weights):
+        org_type = weighted_choice(rng, ORG_TYPES)
+        address_count = max(1, int(scale["hosts"] * weight / total_weight))
+        location = [rng.uniform(-124.0, -67.0), rng.uniform(25.0, 49.0)]
+        org_id = "{!s}{:04d}".format(org_type[:3], i)
+        orgs.append(Org(org_id, org_type, location, next_address, address_count))
+        next_address += address_count
+    return orgs
+
+
+def request_doc(org_id, name, children, org_type=None, location=None, networks=()):
+    return {
+        "_id": org_id,
+        "agency": {
+            "name": name,
+            "acronym": org_id,
+            "type": org_type,
+            "location": location or {},
+            "contacts": [],
+        },
+        "children": children,
+        "networks": list(networks),
+        "init_stage": STAGE.NETSCAN1,
+        "period_start": None,
+        "report_period": "WEEKLY",
+        "report_types": [REPORT_TYPE.CYHY] if org_type else [],
+        "scan_types": [SCAN_TYPE.CYHY] if org_type else [],
+        "retired": False,
+        "stakeholder": False,
+        "windows": [{"day": "Sunday", "duration": 168, "start": "00:00:00"}],
+    }
+
+
+def generate_requests(rng, orgs):
+    """Generates the requests tree: a grouping node for each agency type, with
+    the federal organizations under EXECUTIVE (and some also under
+    FED_CFO_ACT), a share of the SLTT ones also under ELECTION and the private ones also under a critical infrastructure
+    sector.  Every tenth organization has two sub-organizations."""
+    groups = dict((org_type, list()) for org_type, share in ORG_TYPES)
+    executive = list()
+    cfo_act = list()
+    election = list()
+    sectors = dict((sector, list()) for sector in CI_SECTORS)
+    for org in orgs:
+        if org.type == AGENCY_TYPE.FEDERAL:
+            executive.append(org.id)
+            if rng.random() < 0.3:
+                cfo_act.append(org.id)
+        else:
+            groups[org.type].append(org.id)
+        if org.type in SLTT_TYPES and rng.random() < 0.2:
+            election.append(org.id)
+        if org.type == AGENCY_TYPE.PRIVATE:
+            sectors[rng.choice(CI_SECTORS)].append(org.id)
+
+        state = rng.choice(STATES)
+        location = {"name": "City {!s}".format(org.id), "state": state}
+        children = list()
+        if int(org.id[-4:]) % 10 == 0:
+            children = [org.id + "-A", org.id + "-B"]
+            for child in children:
+                yield request_doc(child, "Office " + child, [], org.type, location)
+        networks = netaddr.iprange_to_cidrs(
+            netaddr.IPAddress(org.first_address),
+            netaddr.IPAddress(org.first_address + org.address_count - 1),
+        )
+        doc = request_doc(
+            org.id,
+            "{!s} Organization {!s}".format(org.type.title(), org.id),
+            children,
+            org.type,
+            location,
+            (str(network) for network in networks),
+        )
+        doc["stakeholder"] = True
+        doc["retired"] = rng.random() < 0.02
+        yield doc
+
+    groups[AGENCY_TYPE.FEDERAL].append("EXECUTIVE")
+    yield request_doc("EXECUTIVE", "Executive Branch", executive)
+    yield request_doc("FED_CFO_ACT", "CFO Act Agencies", cfo_act)
+    yield request_doc("ELECTION", "Election Organizations", election)
+    yield request_doc("CRITICAL_INFRASTRUCTURE", "Critical Infrastructure", CI_SECTORS)
+    for sector, children in sectors.items():
+        yield request_doc(sector, sector.title(), children)
+    for org_type, children in groups.items():
+        yield request_doc(org_type, org_type.title(), children)
+
+
+###############################################################################
+#  Hosts and scans
+###############################################################################
+
+
+def generate_hosts(rng, orgs, end, tallies):
+    """Generates the hosts of every organization's addresses, counting them by
+    stage and status in tallies."""
+    for org in orgs:
+        counts = tallies[org.id] = dict(
+            (stage, dict((status, 0) for status, share in HOST_STATUSES))
+            for stage in SCAN_STAGES
+        )
+        for ip_int in xrange(org.first_address, org.first_address + org.address_count):
+            roll = rng.random()
+            if roll < 0.1:
+                up, reason = False, "new"
+            elif roll < 0.5:
+                up, reason = True, "syn-ack"
+            else:
+                up, reason = False, "no-response"
+            status = weighted_choice(rng, HOST_STATUSES)
+            if status == STATUS.RUNNING or not up:
+                stage = rng.choice(SCAN_STAGES)
+            else:
+                stage = STAGE.VULNSCAN
+            counts[stage][status] += 1
+            last_change = random_time(rng, end - datetime.timedelta(days=60), end)
+            if status == STATUS.RUNNING:
+                # scans run for minutes to hours
+                last_change = end - datetime.timedelta(seconds=rng.randint(1, 14400))
+            yield {
+                "_id": ip_int,
+                "ip": ip_string(ip_int),
+                "owner": org.id,
+                "stage": stage,
+                "status": status,
+                "state": {"up": up, "reason": reason},
+                "loc": [
+                    org.location[0] + rng.uniform(-1, 1),
+                    org.location[1] + rng.uniform(-1, 1),
+                ],
+                "last_change": last_change,
+                "next_scan": last_change + datetime.timedelta(days=rng.randint(1, 7)),
+                "priority": rng.randint(-16, 1),
+                "r": rng.random(),
+            }
+
+
+def generate_tallies(tallies, end):
+    for owner, counts in sorted(tallies.items()):
+        yield {"_id": owner, "counts": counts, "last_change": end}
+
+
+def scan_times(rng, start, end, count):
+    return sorted(random_time(rng, start, end) for i in range(count))
+
+
+def generate_host_scans(rng, orgs, start, end):
+    """Generates two OS scans of a third of every organization's addresses."""
+    for org in orgs:
+        for ip_int in xrange(org.first_address, org.first_address + org.address_count):
+            if rng.random() > 0.33:
+                continue
+            os_name = rng.choice(OPERATING_SYSTEMS)
+            times = scan_times(rng, start, end, 2)
+            for i, scan_time in enumerate(times):
+                doc = {
+                    "ip": ip_string(ip_int),
+                    "ip_int": ip_int,
+                    "owner": org.id,
+                    "time": scan_time,
+                    "name": os_name,
+                    "accuracy": rng.randint(85, 100),
+                    "source": "nmap",
+                    "latest": i == len(times) - 1,
+                    "snapshots": org.snapshots_at(scan_time),
+                }
+                if rng.random() < 0.5:
+                    doc["hostname"] = "host-{:d}.{!s}.example".format(
+                        ip_int - org.first_address, org.id.lower()
+                    )
+                yield doc
+
+
+def generate_port_scans(rng, orgs, start, end):
+    """Generates the open ports of a third of every organization's
+    addresses."""
+    for org in orgs:
+        for ip_int in xrange(org.first_address, org.first_address + org.address_count):
+            if rng.random() > 0.33:
+                continue
+            for port, service in rng.sample(SERVICES, rng.randint(1, 4)):
+                scan_time = random_time(rng, start, end)
+                yield {
+                    "ip": ip_string(ip_int),
+                    "ip_int": ip_int,
+                    "owner": org.id,
+                    "time": scan_time,
+                    "port": port,
+                    "protocol": "tcp",
+                    "service": {"name": service},
+                    "state": "open",
+                    "reason": "syn-ack",
+                    "source": "nmap",
+                    "latest": True,
+                    "snapshots": org.snapshots_at(scan_time),
+                }
+
+
+###############################################################################
+#  Snapshots and reports
+###############################################################################
+
+
+def severity_stats(rng):
+    return dict(
+        (name, {"median": rng.randint(1, 90) * 86400000, "max": None})
+        for name in SEVERITY_NAMES.values()
+    )
+
+
+def generate_snapshots(rng, orgs, start, end, reports):
+    """Generates a snapshot of every organization each SNAPSHOT_INTERVAL,
+    recording their times and ids in the organizations, and appends the
+    reports on nine in ten of them to reports."""
+    for org in orgs:
+        snapshot_start = start + datetime.timedelta(
+            seconds=rng.random() * SNAPSHOT_INTERVAL.total_seconds()
+        )
+        while snapshot_start + SNAPSHOT_DURATION < end:
+            snapshot_end = snapshot_start + SNAPSHOT_DURATION
+            snapshot_id = object_id(rng, snapshot_end)
+            org.snapshot_times.append(snapshot_start)
+            org.snapshot_ids.append(snapshot_id)
+            vulnerabilities = dict(
+                (name, rng.randint(0, max(1, org.address_count // (2 * severity))))
+                for severity, name in SEVERITY_NAMES.items()
+            )
+            vulnerabilities["total"] = sum(vulnerabilities.values())
+            host_count = rng.randint(0, org.address_count)
+            yield {
+                "_id": snapshot_id,
+                "owner": org.id,
+                "start_time": snapshot_start,
+                "end_time": snapshot_end,
+                "last_change": snapshot_end,
+                "latest": snapshot_end + SNAPSHOT_INTERVAL >= end,
+                "descendants_included": [],
+                "addresses_scanned": org.address_count,
+                "host_count": host_count,
+                "vulnerable_host_count": rng.randint(0, host_count),
+                "port_count": host_count * 2,
+                "unique_port_count": rng.randint(0, len(SERVICES)),
+                "unique_os_count": rng.randint(0, len(OPERATING_SYSTEMS)),
+                "cvss_average_all": round(rng.uniform(0, 10), 2),
+                "cvss_average_vulnerable": round(rng.uniform(4, 10), 2),
+                "vulnerabilities": vulnerabilities,
+                "unique_vulnerabilities": vulnerabilities,
+                "tix_msec_open": severity_stats(rng),
+                "tix_msec_to_close": severity_stats(rng),
+            }
+            if rng.random() < 0.9:
+                generated_time = snapshot_end + datetime.timedelta(hours=12)
+                reports.append(
+                    {
+                        "_id": object_id(rng, generated_time),
+                        "owner": org.id,
+                        "generated_time": generated_time,
+                        "snapshot_oid": snapshot_id,
+                        "report_types": [REPORT_TYPE.CYHY],
+                    }
+                )
+            snapshot_start += SNAPSHOT_INTERVAL
+
+
+###############################################################################
+#  Tickets
+###############################################################################
+
+
+def make_plugins(rng):
+    """Returns a list of the vulnerability plugins of each severity."""
+    plugins = dict((severity, list()) for severity, share in SEVERITIES)
+    for plugin_id in xrange(10000, 10000 + PLUGIN_COUNT):
+        severity = weighted_choice(rng, SEVERITIES)
+        low, high = CVSS_RANGES[severity]
+        plugins[severity].append(
+            {
+                "plugin_id": plugin_id,
+                "name": "Synthetic Vulnerability {:d}".format(plugin_id),
+                "cve": "CVE-20{:02d}-{:05d}".format(rng.randint(10, 24), plugin_id),
+                "cvss_base_score": round(rng.uniform(low, high), 1),
+                "severity": severity,
+                "kev": rng.random() < 0.05,
+                "kev_ransomware": rng.random() < 0.01,
+            }
+        )
+    return plugins
+
+
+def generate_tickets(rng, orgs, start, end, count, vuln_scans):
+    """Generates count tickets on random addresses, nine in ten of them for
+    vulnerabilities (whose scans are appended to vuln_scans) and the rest for
+    services.  About a third of them are still open."""
+    plugins = make_plugins(rng)
+    first_addresses = [org.first_address for org in orgs]
+    address_count = orgs[-1].first_address + orgs[-1].address_count - FIRST_ADDRESS
+    span = (end - start).total_seconds()
+    for i in xrange(count):
+        ip_int = FIRST_ADDRESS + rng.randrange(address_count)
+        org = orgs[bisect.bisect_right(first_addresses, ip_int) - 1]
+        time_opened = start + datetime.timedelta(seconds=rng.random() * span)
+        time_closed = None
+        if rng.random() < 0.67:
+            time_closed = time_opened + datetime.timedelta(
+                days=rng.expovariate(1.0 / MEAN_DAYS_TO_CLOSE)
+            )
+            if time_closed >= end:
+                time_closed = None
+        if rng.random() < 0.9:
+            severity = weighted_choice(rng, SEVERITIES)
+            plugin = rng.choice(plugins[severity])
+            port, service = rng.choice(SERVICES)
+            source, source_id = "nessus", plugin["plugin_id"]
+            details = {
+                "cve": plugin["cve"],
+                "cvss_base_score": plugin["cvss_base_score"],
+                "kev": plugin["kev"],
+                "kev_ransomware": plugin["kev_ransomware"],
+                "name": plugin["name"],
+                "score_source": "nvd",
+                "service": service,
+                "severity": severity,
+            }
+        else:
+            port, service = rng.choice(SERVICES[:RISKY_SERVICE_COUNT])
+            source, source_id = "nmap", 1
+            details = {
+                "cve": None,
+                "cvss_base_score": None,
+                "name": "Potentially Risky Service Detected: {!s}".format(service),
+                "score_source": None,
+                "service": service,
+                "severity": 0,
+            }
+        events = [{"action": "OPENED", "time": time_opened, "reason": "detected"}]
+        if time_closed:
+            events.append({"action": "CLOSED", "time": time_closed, "reason": "fixed"})
+        host_location = [
+            org.location[0] + rng.uniform(-1, 1),
+            org.location[1] + rng.uniform(-1, 1),
+        ]
+        ticket = {
+            "_id": object_id(rng, time_opened),
+            "ip": ip_string(ip_int),
+            "ip_int": ip_int,
+            "port": port,
+            "protocol": "tcp",
+            "source": source,
+            "source_id": source_id,
+            "owner": org.id,
+            "open": time_closed is None,
+            "false_positive": rng.random() < 0.02,
+            "time_opened": time_opened,
+            "time_closed": time_closed,
+            "last_change": time_closed or time_opened,
+            "details": details,
+            "events": events,
+            "loc": host_location,
+            "snapshots": org.snapshots_at(time_opened),
+        }
+        if source == "nessus":
+            vuln_scans.append(
+                {
+                    "ip": ticket["ip"],
+                    "ip_int": ip_int,
+                    "owner": org.id,
+                    "time": time_opened,
+                    "port": port,
+                    "protocol": "tcp",
+                    "service": service,
+                    "plugin_id": source_id,
+                    "plugin_name": details["name"],
+                    "severity": details["severity"],
+                    "cvss_base_score": details["cvss_base_score"],
+                    "source": source,
+                    "latest": ticket["open"],
+                    "snapshots": ticket["snapshots"],
+                }
+            )
+        yield ticket
+
+
+###############################################################################
+#  Indexes
+###############################################################################
+
+INDEXES = {
+    "tickets": [
+        [("open", ASCENDING), ("owner", ASCENDING)],
+        [("ip_int", ASCENDING)],
+        [("time_opened", ASCENDING)],
+        [("time_closed", ASCENDING)],
+        [("last_change", ASCENDING)],
+        [("details.severity", ASCENDING)],
+    ],
+    "hosts": [
+        [("status", ASCENDING), ("stage", ASCENDING)],
+        [("state.up", ASCENDING), ("owner", ASCENDING)],
+        [("owner", ASCENDING)],
+        [("last_change", ASCENDING)],
+    ],
+    "host_scans": [
+        [("ip_int", ASCENDING), ("latest", ASCENDING)],
+        [("time", ASCENDING), ("owner", ASCENDING)],
+        [("snapshots", ASCENDING)],
+    ],
+    "port_scans": [
+        [("ip_int", ASCENDING), ("latest", ASCENDING)],
+        [("time", ASCENDING), ("owner", ASCENDING)],
+        [("snapshots", ASCENDING)],
+    ],
+    "vuln_scans": [
+        [("ip_int", ASCENDING), ("latest", ASCENDING)],
+        [("time", ASCENDING), ("owner", ASCENDING)],
+        [("snapshots", ASCENDING)],
+    ],
+    "snapshots": [
+        [("owner", ASCENDING), ("start_time", DESCENDING)],
+        [("last_change", ASCENDING)],
+        [("latest", ASCENDING)],
+    ],
+    "reports": [
+        [("owner", ASCENDING), ("generated_time", ASCENDING)],
+        [("snapshot_oid", ASCENDING)],
+        [("generated_time", ASCENDING)],
+    ],
+}
+
+
+def create_indexes(db):
+    for collection, indexes in sorted(INDEXES.items()):
+        for keys in indexes:
+            db[collection].create_index(keys)
+        logger.info("created {:d} indexes on {!s}".format(len(indexes), collection))
+
+
+###############################################################################
+#  Main
+###############################################################################
+
+
+def generate(db, scale_name, seed, end, indexes, org_count=None):
+    scale = dict(SCALES[scale_name])
+    if org_count is not None:
+        scale["orgs"] = org_count
+    rng = random.Random(seed)
+    start = end - datetime.timedelta(days=365 * YEARS)
+    counts = dict()
+
+    orgs = make_orgs(rng, scale)
+    counts["requests"] = insert_batches(db.requests, generate_requests(rng, orgs))
+    reports = list()
+    counts["snapshots"] = insert_batches(
+        db.snapshots, generate_snapshots(rng, orgs, start, end, reports)
+    )
+    counts["reports"] = insert_batches(db.reports, reports)
+    tallies = dict()
+    counts["hosts"] = insert_batches(db.hosts, generate_hosts(rng, orgs, end, tallies))
+    counts["tallies"] = insert_batches(db.tallies, generate_tallies(tallies, end))
+    counts["host_scans"] = insert_batches(
+        db.host_scans, generate_host_scans(rng, orgs, start, end)
+    )
+    counts["port_scans"] = insert_batches(
+        db.port_scans, generate_port_scans(rng, orgs, start, end)
+    )
+    # the vulnerability scans of each batch of tickets are inserted after it
+    vuln_scans = list()
+    tickets = generate_tickets(rng, orgs, start, end, scale["tickets"], vuln_scans)
+    counts["tickets"] = counts["vuln_scans"] = 0
+    while True:
+        batch = list(itertools.islice(tickets, BATCH_SIZE))
+        if not batch:
+            break
+        db.tickets.insert_many(batch, ordered=False)
+        if vuln_scans:
+            db.vuln_scans.insert_many(vuln_scans, ordered=False)
+        counts["tickets"] += len(batch)
+        counts["vuln_scans"] += len(vuln_scans)
+        del vuln_scans[:]
+        if counts["tickets"] % (BATCH_SIZE * 10) == 0:
+            logger.info("inserted {:,d} tickets".format(counts["tickets"]))
+    logger.info("inserted {:,d} documents into tickets".format(counts["tickets"]))
+
+    if indexes:
+        create_indexes(db)
+    db[META_COLLECTION].insert_one(
+        {
+            "_id": "generator",
+            "scale": scale_name,
+            "orgs": scale["orgs"],
+            "seed": seed,
+            "start": start,
+            "end": end,
+            "generated": datetime.datetime.utcnow(),
+            "indexes": indexes,
+            "counts": counts,
+        }
+    )
+    return counts
+
+
+def main():
+    global __doc__
+    __doc__ = re.sub("COMMAND_NAME", __file__, __doc__)
+    args = docopt(__doc__, version="v0.0.1")
+    scale_name = args["--scale"].lower()
+    if scale_name not in SCALES:
+        sys.exit(
+            "Error: the scale must be one of {!s}".format(", ".join(sorted(SCALES)))
+        )
+    org_count = None
+    if args["--orgs"] is not None:
+        try:
+            org_count = int(args["--orgs"])
+        except ValueError:
+            org_count = 0
+        if org_count < 1:
+            sys.exit("Error: the number of organizations must be a positive integer")
+    try:
+        seed = int(args["--seed"])
+    except ValueError:
+        sys.exit("Error: the seed must be an integer")
+    try:
+        end = datetime.datetime.strptime(args["--end-date"], "%Y-%m-%d")
+    except ValueError:
+        sys.exit("Error: the end date must be given as YYYY-MM-DD")
+
+    db = MongoClient(args["--uri"])[args["--database"]]
+    collections = db.collection_names()
+    if collections and META_COLLECTION not in collections:
+        sys.exit(
+            "Error: {!s} has collections not created by this script".format(db.name)
+        )
+    db.client.drop_database(db.name)
+
+    started = time.time()
+    counts = generate(db, scale_name, seed, end, not args["--no-indexes"], org_count)
+    logger.info(
+        "generated {:,d} documents in {:.1f} seconds".format(
+            sum(counts.values()), time.time() - started
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+
+"""Explains the queries the data functions send to MongoDB and suggests indexes.
+
+The scenarios of run-benchmarks.py are run once each while the find, count,
+distinct and aggregate commands they send are recorded.  Commands that only
+differ in their values (the owners, the dates) have the same shape and are
+explained once.  For each shape, "report" prints the plan the server chose,
+flagging collection scans and queries that examine more than RATIO documents
+for each one they return, and suggests an index for them: the fields matched
+on equality, then the sort fields, then the fields matched on a range.  The
+documents examined by a pipeline are those examined by its initial $match.
+
+"verify" compares the plans with those of a report saved with --output, and
+fails if a query issued by a hot scenario (those behind the dashboard, maps,
+queues, BOD and CybEx pages, refreshed every few minutes) used an index then
+and scans its collection now.
+
+Usage:
+  COMMAND_NAME report [--uri URI] [--database NAME] [--section SECTION] [--ratio RATIO] [--output FILE] [SCENARIO...]
+  COMMAND_NAME verify BASELINE [--uri URI] [--database NAME] [--section SECTION] [SCENARIO...]
+  COMMAND_NAME (-h | --help)
+  COMMAND_NAME --version
+
+Options:
+  -h --help                      Show this screen.
+  --version                      Show version.
+  -u URI --uri=URI               MongoDB server [default: mongodb://localhost:27017].
+  -d NAME --database=NAME        Database to explain against [default: cyhy-benchmark].
+  -s SECTION --section=SECTION   Configuration section to use instead of URI and NAME.
+  -r RATIO --ratio=RATIO         Documents examined per document returned above which a query is flagged [default: 10].
+  -o FILE --output=FILE          Also write the report to FILE as JSON.
+
+"""
+
+import imp
+import json
+import os
+import re
+import sys
+import traceback
+
+from bson.son import SON
+from docopt import docopt
+from flask import Flask
+from pymongo import monitoring
+
+from cyhy.db import database
+from cyhy.util import util
+from ncats_webd.blueprints.metrics.congressional_metrics import explain_pipeline
+
+# the scenarios are shared with the benchmarks
+benchmarks = imp.load_source(
+    "run_benchmarks",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "run-benchmarks.py"),
+)
+
+HOT_SCENARIO_PREFIXES = ("dashboard.", "maps.", "queues.", "bod.", "cybex.")
+# command name -> (its fields kept for the explain, the field of its filter)
+COMMANDS = {
+    "find": (("filter", "projection", "sort", "skip", "limit"), "filter"),
+    "count": (("query", "skip", "limit"), "query"),
+    "distinct": (("key", "query"), "query"),
+    "aggregate": (("pipeline",), None),
+}
+EQUALITY_OPERATORS = ("$eq", "$in")
+
+###############################################################################
+#  Recording
+###############################################################################
+
+
+def value_shape(value):
+    """Returns value with the literals replaced by their type, keeping the
+    operators and the field paths of pipeline expressions."""
+    if isinstance(value, dict):
+        return dict((k, value_shape(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(v, (dict, list, tuple)) for v in value):
+            return [value_shape(v) for v in value]
+        # a list of literals, such as the owners of an $in
+        return "<list>"
+    if isinstance(value, basestring) and value.startswith("$"):
+        return value
+    return "<{!s}>".format(type(value).__name__)
+
+
+class Query(object):
+    """A command shape, the first command of that shape and the scenarios
+    that sent it."""
+
+    def __init__(self, collection, command_name, command):
+        self.collection = collection
+        self.command_name = command_name
+        self.command = command
+        self.scenarios = list()
+        self.count = 0
+
+    @property
+    def key(self):
+        return json.dumps(
+            [self.collection, self.command_name, value_shape(self.command)],
+            sort_keys=True,
+        )
+
+    @property
+    def hot(self):
+        return any(
+            scenario.startswith(HOT_SCENARIO_PREFIXES) for scenario in self.scenarios
+        )
+
+
+class QueryRecorder(monitoring.CommandListener):
+    """Records the queries sent while a scenario is set."""
+
+    def __init__(self):
+        self.scenario = None
+        self.queries = dict()  # key -> Query
+
+    def started(self, event):
+        if self.scenario is None or event.command_name not in COMMANDS:
+            return
+        command = event.command
+        if "explain" in command:
+            return
+        fields = COMMANDS[event.command_name][0]
+        kept = dict((field, command[field]) for field in fields if field in command)
+        query = Query(command[event.command_name], event.command_name, kept)
+        query = self.queries.setdefault(query.key, query)
+        query.count += 1
+        if self.scenario not in query.scenarios:
+            query.scenarios.append(self.scenario)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def record_queries(db, recorder, names):
+    """Runs the scenarios once each, recording their queries."""
+    benchmarks.use_fiscal_year_of(db)
+    app = Flask(__name__)
+    app.db = db
+    with app.app_context():
+        for name, function, setup in benchmarks.SCENARIOS:
+            if names and name not in names:
+                continue
+            reason = benchmarks.refusal(db, function, setup)
+            if reason is not None:
+                print >> sys.stderr, "{!s} not run: {!s}".format(name, reason)
+                continue
+            try:
+                if setup:
+                    setup(db)
+                recorder.scenario = name
+                function(db)
+            except Exception:
+                print >> sys.stderr, "{!s} failed:\n{!s}".format(
+                    name, traceback.format_exc()
+                )
+            finally:
+                recorder.scenario = None
+    return recorder.queries.values()
+
+
+###############################################################################
+#  Explaining
+###############################################################################
+
+
+def plan_nodes(explain):
+    """Generates the nodes of the winning plans in the explain output."""
+    if isinstance(explain, dict):
+        if "stage" in explain:
+            yield explain
+        for key, value in explain.items():
+            if key != "rejectedPlans":
+                for node in plan_nodes(value):
+                    yield node
+    elif isinstance(explain, list):
+        for value in explain:
+            for node in plan_nodes(value):
+                yield node
+
+
+def find_value(explain, key):
+    """Returns the first value of key in the explain output, or None."""
+    if isinstance(explain, dict):
+        if key in explain:
+            return explain[key]
+        values = explain.values()
+    elif isinstance(explain, list):
+        values = explain
+    else:
+        return None
+    for value in values:
+        found = find_value(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def leading_match(pipeline):
+    """Returns the filter and sort of the $match and $sort stages a pipeline
+    starts with."""
+    match, sort = dict(), None
+    for stage in pipeline:
+        if "$match" in stage and not match and sort is None:
+            match = stage["$match"]
+        elif "$sort" in stage and sort is None:
+            sort = stage["$sort"]
+        else:
+            break
+    return match, sort
+
+
+def explain_find(db, collection, query_filter, sort=None, projection=None):
+    command = SON([("find", collection), ("filter", query_filter)])
+    if sort:
+        command["sort"] = sort
+    if projection:
+        command["projection"] = projection
+    return db.command(SON([("explain", command), ("verbosity", "executionStats")]))
+
+
+def explain_query(db, query):
+    """Returns the plan of query: its stages and indexes, the documents
+    examined and returned and the time taken."""
+    command = query.command
+    if query.command_name == "aggregate":
+        planned = explain_pipeline((command["pipeline"], query.collection), db)
+        query_filter, sort = leading_match(command["pipeline"])
+        executed = explain_find(db, query.collection, query_filter, sort)
+    else:
+        # count and distinct report no documents returned, so their filter is
+        # explained as a find
+        query_filter = command.get(COMMANDS[query.command_name][1]) or dict()
+        sort = command.get("sort")
+        if query.command_name == "find":
+            explain_command = SON([("find", query.collection)])
+            explain_command.update(command)
+            planned = executed = db.command(
+                SON([("explain", explain_command), ("verbosity", "executionStats")])
+            )
+        else:
+            planned = executed = explain_find(db, query.collection, query_filter)
+    nodes = list(plan_nodes(find_value(planned, "winningPlan") or planned))
+    stats = find_value(executed, "executionStats") or dict()
+    return {
+        "stages": sorted(set(node["stage"] for node in nodes)),
+        "indexes": sorted(
+            set(node["indexName"] for node in nodes if "indexName" in node)
+        ),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "returned": stats.get("nReturned"),
+        "millis": stats.get("executionTimeMillis"),
+        "suggested_index": suggest_index(query_filter, sort),
+    }
+
+
+###############################################################################
+#  Suggesting indexes
+###############################################################################
+
+
+def filter_fields(query_filter):
+    """Returns the fields of query_filter matched on equality and those matched
+    on a range, leaving out the branches of $or and $nor, which need indexes
+    of their own."""
+    equality, ranges = list(), list()
+    for field, condition in query_filter.items():
+        if field == "$and":
+            for clause in condition:
+                clause_equality, clause_ranges = filter_fields(clause)
+                equality += clause_equality
+                ranges += clause_ranges
+        elif field.startswith("$"):
+            continue
+        elif isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+            if all(k in EQUALITY_OPERATORS for k in condition):
+                equality.append(field)
+            else:
+                ranges.append(field)
+        else:
+            equality.append(field)
+    return equality, ranges
+
+
+def suggest_index(query_filter, sort):
+    """Returns the keys of an index for query_filter and sort: the equality
+    fields, then the sort fields, then the range fields."""
+    equality, ranges = filter_fields(query_filter or dict())
+    keys = list()
+    for field in equality:
+        keys.append((field, 1))
+    for field, direction in (sort or dict()).items():
+        if isinstance(direction, (int, long, float)):
+            keys.append((field, int(direction)))
+    for field in ranges:
+        keys.append((field, 1))
+    suggestion = list()
+    for field, direction in keys:
+        if field not in [f for f, d in suggestion]:
+            suggestion.append((field, direction))
+    return suggestion or None
+
+
+def is_covered(suggestion, indexes):
+    """Returns whether an existing index starts with the suggested fields."""
+    fields = [field for field, direction in suggestion]
+    for index in indexes.values():
+        index_fields = [field for field, direction in index["key"]]
+        if index_fields[: len(fields)] == fields:
+            return True
+    return False
+
+
+###############################################################################
+#  Reporting
+###############################################################################
+
+
+def analyze(db, queries, ratio):
+    """Explains the queries and returns the report entries, the most
+    documents examined first."""
+    entries = list()
+    indexes = dict()
+    for query in queries:
+        try:
+            plan = explain_query(db, query)
+        except Exception as e:
+            plan = {"error": str(e)}
+        problems = list()
+        if "COLLSCAN" in plan.get("stages", []):
+            problems.append("COLLSCAN")
+        examined, returned = plan.get("docs_examined"), plan.get("returned")
+        if examined and examined > ratio * max(returned or 0, 1):
+            problems.append("examines {:,d} for {:,d}".format(examined, returned or 0))
+        suggestion = plan.get("suggested_index")
+        if suggestion:
+            if query.collection not in indexes:
+                indexes[query.collection] = db[query.collection].index_information()
+            if not problems or is_covered(suggestion, indexes[query.collection]):
+                plan["suggested_index"] = None
+        entries.append(
+            {
+                "key": query.key,
+                "collection": query.collection,
+                "command": query.command_name,
+                "shape": value_shape(query.command),
+                "scenarios": query.scenarios,
+                "hot": query.hot,
+                "count": query.count,
+                "plan": plan,
+                "problems": problems,
+            }
+        )
+    entries.sort(key=lambda entry: -(entry["plan"].get("docs_examined") or 0))
+    return entries
+
+
+def print_report(entries):
+    for entry in entries:
+        plan = entry["plan"]
+        print "{!s}.{!s} sent {:d} time(s) by {!s}{!s}".format(
+            entry["collection"],
+            entry["command"],
+            entry["count"],
+            ", ".join(entry["scenarios"]),
+            " (hot)" if entry["hot"] else "",
+        )
+        print "  shape:    {!s}".format(json.dumps(entry["shape"], sort_keys=True))
+        if "error" in plan:
+            print "  explain failed: {!s}".format(plan["error"])
+            continue
+        print "  plan:     {!s}{!s}".format(
+            " ".join(plan["stages"]),
+            " on " + ", ".join(plan["indexes"]) if plan["indexes"] else "",
+        )
+        print "  examined: {!s} documents, {!s} keys; returned {!s} in {!s} ms".format(
+            plan["docs_examined"],
+            plan["keys_examined"],
+            plan["returned"],
+            plan["millis"],
+        )
+        if entry["problems"]:
+            print "  PROBLEMS: {!s}".format("; ".join(entry["problems"]))
+        if plan["suggested_index"]:
+            print "  suggested index: {!s}".format(
+                json.dumps(SON(plan["suggested_index"]))
+            )
+        print
+    flagged = [entry for entry in entries if entry["problems"]]
+    print "{:d} query shapes, {:d} flagged".format(len(entries), len(flagged))
+
+
+def uses_index(entry):
+    plan = entry["plan"]
+    return "error" not in plan and "COLLSCAN" not in plan["stages"]
+
+
+def verify(baseline, entries):
+    """Returns a message for each hot query that used an index in baseline
+    and no longer does."""
+    baseline_entries = dict((entry["key"], entry) for entry in baseline["queries"])
+    failures = list()
+    for entry in entries:
+        before = baseline_entries.get(entry["key"])
+        if entry["hot"] and before and uses_index(before) and not uses_index(entry):
+            failures.append(
+                "{!s}.{!s} from {!s} used {!s} and now scans the collection".format(
+                    entry["collection"],
+                    entry["command"],
+                    ", ".join(entry["scenarios"]),
+                    ", ".join(before["plan"]["indexes"]) or "an index",
+                )
+            )
+    return failures
+
+
+###############################################################################
+#  Main
+###############################################################################
+
+
+def main():
+    global __doc__
+    __doc__ = re.sub("COMMAND_NAME", __file__, __doc__)
+    args = docopt(__doc__, version="v0.0.1")
+    try:
+        ratio = float(args["--ratio"])
+    except ValueError:
+        sys.exit("Error: the ratio must be a number")
+    known = set(name for name, function, setup in benchmarks.SCENARIOS)
+    unknown = [name for name in args["SCENARIO"] if name not in known]
+    if unknown:
+        sys.exit("Error: unknown scenarios: {!s}".format(", ".join(unknown)))
+    baseline = None
+    if args["verify"]:
+        with open(args["BASELINE"]) as f:
+            baseline = json.load(f)
+
+    # the listener has to be registered before the client is created
+    recorder = QueryRecorder()
+    monitoring.register(recorder)
+    if args["--section"]:
+        db = database.db_from_config(args["--section"])
+    else:
+        db = database.db_from_connection(args["--uri"], args["--database"])
+
+    queries = record_queries(db, recorder, set(args["SCENARIO"]))
+    entries = analyze(db, queries, ratio)
+
+    if baseline is not None:
+        failures = verify(baseline, entries)
+        for failure in failures:
+            print failure
+        if failures:
+            sys.exit(1)
+        print "{:d} query shapes checked, no hot query lost its index".format(
+            len(entries)
+        )
+        return
+
+    print_report(entries)
+    if args["--output"]:
+        with open(args["--output"], "w") as f:
+            json.dump(
+                {
+                    "generated": util.utcnow(),
+                    "database": db.name,
+                    "ratio": ratio,
+                    "queries": entries,
+                },
+                f,
+                default=util.custom_json_handler,
+                indent=2,
+                sort_keys=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+
+"""Times the data functions of the blueprints and compares the timings of runs.
+
+"run" calls each scenario (all of them unless some are named) COUNT times in
+a row against the database, uncached, and writes the times taken to a JSON
+file along with the commit, package versions and database contents they were
+measured with.  The first call of a scenario also loads whatever its
+functions keep in memory (the organization index, report times), so its time
+is kept apart from the others.  "compare" prints the median times of two such
+files side by side.
+
+The fiscal year metrics are timed over the last fiscal year before the end
+date of a generated database, so runs against it are comparable whenever
+they are made.  The scenarios that drop or rebuild the ticket summary only
+run against a database generate-data.py made, never one named by a section
+of the configuration alone.
+
+Usage:
+  COMMAND_NAME run [--uri URI] [--database NAME] [--section SECTION] [--repeat COUNT] [--output FILE] [SCENARIO...]
+  COMMAND_NAME compare BASELINE RESULTS
+  COMMAND_NAME list
+  COMMAND_NAME (-h | --help)
+  COMMAND_NAME --version
+
+Options:
+  -h --help                      Show this screen.
+  --version                      Show version.
+  -u URI --uri=URI               MongoDB server [default: mongodb://localhost:27017].
+  -d NAME --database=NAME        Database to run against [default: cyhy-benchmark].
+  -s SECTION --section=SECTION   Configuration section to use instead of URI and NAME.
+  -r COUNT --repeat=COUNT        Number of calls of each scenario [default: 3].
+  -o FILE --output=FILE          File to write the results to [default: benchmark-TIMESTAMP.json].
+
+"""
+
+import datetime
+import gc
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import traceback
+
+from docopt import docopt
+from flask import Flask
+import numpy
+import pandas
+import pymongo
+
+from cyhy.db import database
+from cyhy.util import util
+from ncats_webd import cybex_queries, ticket_summary
+from ncats_webd.queries import DashboardQueries, MapQueries
+from ncats_webd.blueprints.bod import bod
+from ncats_webd.blueprints.cybex import cybex
+from ncats_webd.blueprints.dashboard import dashboard
+from ncats_webd.blueprints.metrics import (
+    FYcalcs,
+    congressional_metrics,
+    fema_stats,
+    risk_me,
+    ticketReport,
+)
+from ncats_webd.blueprints.queues import queues
+
+META_COLLECTION = "benchmark_meta"  # written by generate-data.py
+FY_START_MONTH = 10
+
+###############################################################################
+#  Scenarios
+###############################################################################
+
+
+def last_fiscal_year(today):
+    """Returns the start and end of the last complete fiscal year."""
+    end_year = today.year if today.month >= FY_START_MONTH else today.year - 1
+    end = datetime.datetime(end_year, FY_START_MONTH, 1)
+    return end.replace(year=end_year - 1), end
+
+
+FY_START, FY_END = last_fiscal_year(datetime.datetime.utcnow())
+
+
+def generator_meta(db):
+    """Returns what generate-data.py recorded about db, or None if it didn't
+    make it."""
+    return db[META_COLLECTION].find_one({"_id": "generator"})
+
+
+def use_fiscal_year_of(db):
+    """Time the fiscal year metrics over the last fiscal year before the end
+    of the generated data in db, if it was generated."""
+    global FY_START, FY_END
+    meta = generator_meta(db)
+    if meta is not None:
+        FY_START, FY_END = last_fiscal_year(meta["end"])
+
+
+def without_ticket_summary(db):
+    db[ticket_summary.SUMMARY_COLLECTION].drop()
+
+
+def with_ticket_summary(db):
+    if not ticket_summary.is_fresh(db):
+        ticket_summary.rebuild(db)
+
+
+def writes_to_database(function, setup):
+    """Whether the scenario drops or rewrites a collection."""
+    return setup in (without_ticket_summary, with_ticket_summary) or (
+        function is ticket_summary.rebuild
+    )
+
+
+def refusal(db, function, setup):
+    """Returns why the scenario may not be run against db, or None."""
+    if writes_to_database(function, setup) and generator_meta(db) is None:
+        return "it rewrites {!s}, and {!s} wasn't made by generate-data.py".format(
+            ticket_summary.SUMMARY_COLLECTION, db.name
+        )
+    return None
+
+
+def fiscal_year_metric(name, function):
+    """Returns the scenario of the FYcalcs function over the last fiscal
+    year."""
+    return (
+        name,
+        lambda db: function(FY_START, FY_END, db),
+        FYcalcs.categorize_orgs,
+    )
+
+
+# (name, function of the database, setup function of the database or None);
+# the dashboard counts are timed with and without the ticket summary
+SCENARIOS = [
+    (
+        "dashboard.first_seen_ticket_counts",
+        lambda db: list(
+            database.run_pipeline_cursor(dashboard.first_seen_ticket_counts(), db)
+        ),
+        None,
+    ),
+    (
+        "dashboard.ticket_severity_counts",
+        lambda db: DashboardQueries.get_ticket_severity_counts(
+            db, db.requests.find({"stakeholder": True})
+        ),
+        without_ticket_summary,
+    ),
+    (
+        "dashboard.overall_metrics",
+        lambda db: DashboardQueries.get_overall_metrics(
+            db, DashboardQueries.build_stakeholder_list(db)
+        ),
+        without_ticket_summary,
+    ),
+    (
+        "dashboard.election_metrics",
+        DashboardQueries.get_election_metrics,
+        without_ticket_summary,
+    ),
+    ("dashboard.ticket_summary_rebuild", ticket_summary.rebuild, None),
+    (
+        "dashboard.ticket_severity_counts_summary",
+        lambda db: DashboardQueries.get_ticket_severity_counts(
+            db, db.requests.find({"stakeholder": True})
+        ),
+        with_ticket_summary,
+    ),
+    (
+        "dashboard.overall_metrics_summary",
+        lambda db: DashboardQueries.get_overall_metrics(
+            db, DashboardQueries.build_stakeholder_list(db)
+        ),
+        with_ticket_summary,
+    ),
+    (
+        "dashboard.election_metrics_summary",
+        DashboardQueries.get_election_metrics,
+        with_ticket_summary,
+    ),
+    ("maps.open_ticket_locs", MapQueries.get_open_ticket_locs_by_severity, None),
+    ("maps.running_ips", MapQueries.get_running_ips, None),
+    ("maps.host_locations", MapQueries.get_host_locations, None),
+    ("queues.running_times", queues.get_running_times, None),
+    ("queues.tally_details", DashboardQueries.get_tally_details, None),
+    (
+        "bod.open_tickets",
+        lambda db: bod.get_bod_open_tickets_dataframe(bod.BOD_START_DATE),
+        None,
+    ),
+    ("bod.history", lambda db: bod.get_bod_dataframe(db, bod.BOD_START_DATE), None),
+    (
+        "cybex.open_tickets_json",
+        lambda db: cybex_queries.json_get_open_tickets(db, cybex.CRITICAL_SEVERITY),
+        None,
+    ),
+    (
+        "cybex.open_tickets_csv",
+        lambda db: "".join(
+            cybex_queries.csv_get_open_tickets(db, cybex.CRITICAL_SEVERITY)
+        ),
+        None,
+    ),
+    (
+        "cybex.closed_tickets_csv",
+        lambda db: "".join(
+            cybex_queries.csv_get_closed_tickets(db, cybex.CRITICAL_SEVERITY)
+        ),
+        None,
+    ),
+    (
+        "cybex.history",
+        lambda db: cybex_queries.json_get_cybex_data(
+            db, cybex.GRAPH_START_DATE, cybex.CRITICAL_SEVERITY
+        ),
+        None,
+    ),
+    (
+        "cybex.histogram",
+        lambda db: cybex_queries.json_get_cybex_histogram_data(
+            db, cybex.CRITICAL_SEVERITY, cybex.CRITICAL_HISTOGRAM_CUTOFF_DAYS
+        ),
+        None,
+    ),
+    fiscal_year_metric("metrics.vuln_ticket_counts", FYcalcs.vuln_ticket_counts),
+    fiscal_year_metric("metrics.top_vulns", FYcalcs.top_vulns),
+    fiscal_year_metric("metrics.top_OS", FYcalcs.top_OS),
+    fiscal_year_metric("metrics.top_vuln_services", FYcalcs.top_vuln_services),
+    fiscal_year_metric("metrics.top_services", FYcalcs.top_services),
+    fiscal_year_metric("metrics.num_orgs_scanned", FYcalcs.num_orgs_scanned),
+    fiscal_year_metric(
+        "metrics.num_addresses_hosts_scanned", FYcalcs.num_addresses_hosts_scanned
+    ),
+    fiscal_year_metric("metrics.num_reports_generated", FYcalcs.num_reports_generated),
+    fiscal_year_metric("metrics.avg_cvss_score", FYcalcs.avg_cvss_score),
+    fiscal_year_metric("metrics.unique_vulns", FYcalcs.unique_vulns),
+    fiscal_year_metric("metrics.new_vuln_detections", FYcalcs.new_vuln_detections),
+    (
+        "metrics.congressional_data",
+        lambda db: congressional_metrics.congressional_data(db, FY_START, FY_END),
+        None,
+    ),
+    ("metrics.weekly_tickets", ticketReport.get_stats, None),
+    ("metrics.risk_rating", risk_me.get_ranking_lists, None),
+    ("metrics.fema", fema_stats.fema_detail, None),
+]
+
+###############################################################################
+#  Running
+###############################################################################
+
+
+def time_scenario(db, function, setup, repeat):
+    """Returns the seconds taken by each of repeat calls of function."""
+    times = list()
+    for i in range(repeat):
+        if setup:
+            setup(db)
+        gc.collect()
+        start = time.time()
+        function(db)
+        times.append(time.time() - start)
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(times):
+    result = {"first": times[0], "runs": times}
+    # the later runs are the steady state, when there are any
+    steady = times[1:] or times
+    result["min"] = min(steady)
+    result["median"] = median(steady)
+    result["max"] = max(steady)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe_database(db):
+    counts = dict(
+        (name, db[name].count())
+        for name in db.collection_names()
+        if not name.startswith("system.")
+    )
+    return {
+        "name": db.name,
+        "generator": generator_meta(db),
+        "counts": counts,
+    }
+
+
+def run(db, names, repeat):
+    use_fiscal_year_of(db)
+    results = {
+        "started": util.utcnow(),
+        "git_commit": git_commit(),
+        "python": sys.version,
+        "packages": {
+            "numpy": numpy.__version__,
+            "pandas": pandas.__version__,
+            "pymongo": pymongo.version,
+        },
+        "database": describe_database(db),
+        "fiscal_year": [FY_START, FY_END],
+        "repeat": repeat,
+        "scenarios": dict(),
+    }
+    # some of the functions find the database through the app
+    app = Flask(__name__)
+    app.db = db
+    with app.app_context():
+        for name, function, setup in SCENARIOS:
+            if names and name not in names:
+                continue
+            reason = refusal(db, function, setup)
+            if reason is not None:
+                results["scenarios"][name] = {"error": "not run: " + reason}
+                print "{:<45} {:>12}".format(name, "not run")
+                continue
+            try:
+                result = summarize(time_scenario(db, function, setup, repeat))
+                print "{:<45} {:>10.3f} s".format(name, result["median"])
+            except Exception:
+                result = {"error": traceback.format_exc()}
+                print "{:<45} {:>12}".format(name, "failed")
+            results["scenarios"][name] = result
+    results["finished"] = util.utcnow()
+    return results
+
+
+###############################################################################
+#  Comparing
+###############################################################################
+
+
+def compare(baseline, results):
+    """Prints the median times of the scenarios of baseline and results, and
+    the ratio of the second to the first."""
+    print "{:<45} {:>10} {:>10} {:>8}".format(
+        "scenario", "baseline", "results", "ratio"
+    )
+    names = sorted(set(baseline["scenarios"]) | set(results["scenarios"]))
+    for name in names:
+        before = baseline["scenarios"].get(name, {}).get("median")
+        after = results["scenarios"].get(name, {}).get("median")
+        if before and after is not None:
+            ratio = "{:.2f}".format(after / before)
+        else:
+            ratio = "-"
+        print "{:<45} {:>10} {:>10} {:>8}".format(
+            name,
+            "-" if before is None else "{:.3f}".format(before),
+            "-" if after is None else "{:.3f}".format(after),
+            ratio,
+        )
+    for label, data in (("baseline", baseline), ("results", results)):
+        generator = data["database"].get("generator") or {}
+        print "{!s}: commit {!s}, scale {!s}, {!s} orgs, seed {!s}".format(
+            label,
+            data["git_commit"],
+            generator.get("scale"),
+            generator.get("orgs"),
+            generator.get("seed"),
+        )
+
+
+###############################################################################
+#  Main
+###############################################################################
+
+
+def main():
+    global __doc__
+    __doc__ = re.sub("COMMAND_NAME", __file__, __doc__)
+    args = docopt(__doc__, version="v0.0.1")
+
+    if args["list"]:
+        for name, function, setup in SCENARIOS:
+            print name
+        return
+
+    if args["compare"]:
+        with open(args["BASELINE"]) as f:
+            baseline = json.load(f)
+        with open(args["RESULTS"]) as f:
+            results = json.load(f)
+        compare(baseline, results)
+        return
+
+    try:
+        repeat = int(args["--repeat"])
+    except ValueError:
+        repeat = 0
+    if repeat < 1:
+        sys.exit("Error: the repeat count must be a positive integer")
+    known = set(name for name, function, setup in SCENARIOS)
+    unknown = [name for name in args["SCENARIO"] if name not in known]
+    if unknown:
+        sys.exit("Error: unknown scenarios: {!s}".format(", ".join(unknown)))
+
+    if args["--section"]:
+        db = database.db_from_config(args["--section"])
+    else:
+        db = database.db_from_connection(args["--uri"], args["--database"])
+
+    output = args["--output"]
+    if output == "benchmark-TIMESTAMP.json":
+        output = "benchmark-{:%Y%m%d-%H%M%S}.json".format(datetime.datetime.now())
+    results = run(db, set(args["SCENARIO"]), repeat)
+    with open(output, "w") as f:
+        json.dump(
+            results, f, default=util.custom_json_handler, indent=2, sort_keys=True
+        )
+    print "results written to {!s}".format(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,11 @@
 
 """Pulls the data needed for the CyHy Dashboard and pushes it to a server in our DMZ.
 
+Files whose content hasn't changed since they were last pushed to a host are
+not pushed to it again.
+
 Usage:
-  COMMAND_NAME [--section SECTION]
+  COMMAND_NAME [--section SECTION] [--gzip]
   COMMAND_NAME (-h | --help)
   COMMAND_NAME --version
 
@@ -11,12 +14,19 @@ Options:
   -h --help                      Show this screen.
   --version                      Show version.
   -s SECTION --section=SECTION   Configuration section to use.
+  -z --gzip                      Also push a gzipped copy of each file (FILE.gz).
 
 """
 
 import sys
 import os
 import re
+import gzip
+import hashlib
+import io
+from multiprocessing.pool import ThreadPool
+import posixpath
+import tempfile
 from docopt import docopt
 from cyhy.core import STAGE, STATUS
 from cyhy.db import database
@@ -25,12 +35,13 @@ import json
 import schedule
 import time
 from fabric.tasks import Task, execute
-from fabric.api import task, env
-from fabric import operations
+from fabric.api import task, env, parallel
+from fabric.state import connections
 import logging
 
 REFRESH_INTERVAL = 300
 env.use_ssh_config = True  # env used by fabric
+env.skip_bad_hosts = True  # a host that is down shouldn't stop the others
 DESTINATION_HOSTS = ["drop.ncats.dhs.gov"]
 DESTINATION_DIR = "dashdog/data_drop/"
 TICKET_COUNT_FILENAME = "ticket_counts.json"
@@ -43,25 +54,82 @@ OPEN_TICKET_LOCATIONS_3_FILENAME = "active_vulns_loc_3.json"
 OPEN_TICKET_LOCATIONS_4_FILENAME = "active_vulns_loc_4.json"
 RUNNING_IPS_FILENAME = "running_scans.json"
 HOST_LOCATIONS_FILENAME = "host_locations.json"
+GZIP_SUFFIX = ".gz"
+UPLOAD_THREADS = 4  # files uploaded to a host at the same time
 
 DEFAULT_LOGGER_LEVEL = logging.INFO
 LOG_FILE = "data-pusher.log"
 root = setup_logging(DEFAULT_LOGGER_LEVEL, filename=LOG_FILE)
 logger = logging.getLogger(__name__)
 
+# content digests of the files last written, and of those last pushed to each
+# host, keyed by filename
+written_digests = dict()
+pushed_digests = dict()
+
 
 @task
-def push_data(source_file_list, destination_dir):
-    for filename in source_file_list:
-        paths = operations.put(filename, destination_dir)
-        if len(paths.failed) == 0:
-            logger.info(
-                "{!s} was pushed successfully to {!s}".format(filename, env.host_string)
-            )
-        else:
-            logger.error(
-                "Error pushing {!s} to host {!s}".format(filename, env.host_string)
+@parallel
+def push_data(files_by_host, destination_dir):
+    """Pushes this host's files from files_by_host to destination_dir, several
+    at a time.  Each is uploaded under a temporary name and renamed, so readers
+    never see a partial file.  Returns the files pushed successfully."""
+    host = env.host_string
+    client = connections[host]
+
+    def push(filename):
+        start = time.time()
+        remote_path = posixpath.join(destination_dir, filename)
+        temp_path = posixpath.join(destination_dir, "." + filename + ".tmp")
+        sftp = None
+        try:
+            sftp = client.open_sftp()
+            sftp.put(filename, temp_path)
+            sftp.posix_rename(temp_path, remote_path)
+        except Exception:
+            logger.exception("Error pushing {!s} to host {!s}".format(filename, host))
+            return None
+        finally:
+            if sftp is not None:
+                sftp.close()
+        logger.info(
+            "{!s} was pushed successfully to {!s} in {:.3f} seconds".format(
+                filename, host, time.time() - start
             )
+        )
+        return filename
+
+    filenames = files_by_host[host]
+    pool = ThreadPool(min(UPLOAD_THREADS, len(filenames)))
+    try:
+        pushed = pool.map(push, filenames)
+    finally:
+        pool.close()
+        pool.join()
+    return [filename for filename in pushed if filename is not None]
+
+
+def write_atomically(path, data):
+    """Replace the file at path with data, without ever leaving a partial file."""
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix="." + os.path.basename(path)
+    )
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def gzip_data(data):
+    """Returns data gzipped, with no timestamp so the same data gives the same
+    bytes."""
+    output = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=output, mtime=0) as out:
+        out.write(data)
+    return output.getvalue()
 
 
 def build_stakeholder_list(db):
@@ -229,23 +297,21 @@ def get_tally_details(db):
     return results
 
 
-def get_open_ticket_loc_by_severity(db, severity=None):
-    if severity != None:
-        tickets = db.TicketDoc.collection.find(
-            {
-                "open": True,
-                "source": "nessus",
-                "details.severity": severity,
-                "loc.0": {"$ne": None},
-            },
-            {"_id": 0, "loc": 1, "details.severity": 1},
-        )
-    else:
-        tickets = db.TicketDoc.collection.find(
-            {"open": True, "source": "nessus", "loc.0": {"$ne": None}},
-            {"_id": 0, "loc": 1, "details.severity": 1},
-        )
-    return list(tickets)
+def get_open_ticket_locs_by_severity(db):
+    """Returns a dict of severity (1-4) to the locations of open tickets of that
+    severity, plus all open ticket locations under 0, from a single scan of
+    the tickets."""
+    tickets = db.TicketDoc.collection.find(
+        {"open": True, "source": "nessus", "loc.0": {"$ne": None}},
+        {"_id": 0, "loc": 1, "details.severity": 1},
+    )
+    results = {0: [], 1: [], 2: [], 3: [], 4: []}
+    for ticket in tickets:
+        results[0].append(ticket)
+        severity = ticket.get("details", {}).get("severity")
+        if severity in (1, 2, 3, 4):
+            results[severity].append(ticket)
+    return results
 
 
 def get_running_ips(db):
@@ -262,20 +328,17 @@ def get_host_locations(db):
     return list(host_locations)
 
 
-def generate_push_data_files(db):
+def generate_push_data_files(db, gzip_sidecar=False):
     logger.info("generating dashboard data; starting db queries")
     stakeholders = build_stakeholder_list(db)
     ticket_severity_counts = get_ticket_severity_counts(db, stakeholders)
     overall_metrics = get_overall_metrics(db, stakeholders)
     tally_details = get_tally_details(db)
-    open_ticket_locations = dict()
-    open_ticket_locations[0] = get_open_ticket_loc_by_severity(db)
-    for severity in (1, 2, 3, 4):
-        open_ticket_locations[severity] = get_open_ticket_loc_by_severity(db, severity)
+    open_ticket_locations = get_open_ticket_locs_by_severity(db)
     running_ips = get_running_ips(db)
     host_locations = get_host_locations(db)
     logger.info("done with db queries")
-    data_file_list = []
+    digests = dict()
 
     for (output_file, json_data) in [
         (TICKET_COUNT_FILENAME, ticket_severity_counts),
@@ -289,13 +352,49 @@ def generate_push_data_files(db):
         (RUNNING_IPS_FILENAME, running_ips),
         (HOST_LOCATIONS_FILENAME, host_locations),
     ]:
-        with open(output_file, "wb") as out:
-            out.write(
-                json.dumps(json_data, sort_keys=True, default=util.custom_json_handler)
+        start = time.time()
+        data = json.dumps(json_data, sort_keys=True, default=util.custom_json_handler)
+        digest = hashlib.sha1(data).hexdigest()
+        output_files = [output_file]
+        if gzip_sidecar:
+            output_files.append(output_file + GZIP_SUFFIX)
+        for filename in output_files:
+            digests[filename] = digest
+        if digest == written_digests.get(output_file) and all(
+            os.path.exists(filename) for filename in output_files
+        ):
+            logger.info(" output file unchanged: {!s}".format(output_file))
+            continue
+        write_atomically(output_file, data)
+        if gzip_sidecar:
+            write_atomically(output_file + GZIP_SUFFIX, gzip_data(data))
+        written_digests[output_file] = digest
+        logger.info(
+            " output file written: {!s} in {:.3f} seconds".format(
+                output_file, time.time() - start
             )
-            logger.info(" output file written: {!s}".format(output_file))
-            data_file_list.append(output_file)
-    execute(push_data, data_file_list, DESTINATION_DIR, hosts=DESTINATION_HOSTS)
+        )
+
+    files_by_host = dict()
+    for host in DESTINATION_HOSTS:
+        pushed = pushed_digests.setdefault(host, dict())
+        files_by_host[host] = sorted(
+            filename
+            for filename, digest in digests.items()
+            if pushed.get(filename) != digest
+        )
+    hosts = [host for host in DESTINATION_HOSTS if files_by_host[host]]
+    if not hosts:
+        logger.info("no files changed since the last push")
+        return
+    start = time.time()
+    results = execute(push_data, files_by_host, DESTINATION_DIR, hosts=hosts)
+    for host, pushed_files in results.items():
+        # a host that couldn't be reached has no list of pushed files
+        if isinstance(pushed_files, list):
+            for filename in pushed_files:
+                pushed_digests[host][filename] = digests[filename]
+    logger.info("push finished in {:.3f} seconds".format(time.time() - start))
 
 
 def main():
@@ -305,9 +404,12 @@ def main():
     db = database.db_from_config(args["--section"])
     # import IPython; IPython.embed() #<<< BREAKPOINT >>>
 
-    generate_push_data_files(db)  # Initial call
+    gzip_sidecar = args["--gzip"]
+    generate_push_data_files(db, gzip_sidecar)  # Initial call
     logger.info("scheduled refresh interval: {!s} seconds".format(REFRESH_INTERVAL))
-    schedule.every(REFRESH_INTERVAL).seconds.do(generate_push_data_files, db)
+    schedule.every(REFRESH_INTERVAL).seconds.do(
+        generate_push_data_files, db, gzip_sidecar
+    )
 
     logger.info("starting scheduler loop")
     while True:
@@ -0,0 +1,76 @@
+"""Daily ticket age buckets for the age history graphs.
+
+Every ticket is open on a contiguous range of days, and within that range it
+falls into each age bucket on a contiguous sub-range.  The range boundaries
+are found with a binary search over the sorted day array and accumulated with
+a difference array, so the cost is O((tickets + days) log days) instead of
+rebuilding a mask over every ticket for every day.
+"""
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+ONE_DAY_NS = pd.Timedelta(days=1).value
+
+
+def _as_ns(values):
+    """returns datetimes (tz-aware or UTC) as int64 nanoseconds since epoch"""
+    return np.asarray(pd.DatetimeIndex(values).values, dtype="datetime64[ns]").view(
+        "int64"
+    )
+
+
+def _count_ranges(starts, stops, length):
+    """returns how many [start, stop) ranges cover each index in range(length)"""
+    covered = starts < stops
+    deltas = np.bincount(starts[covered], minlength=length + 1) - np.bincount(
+        stops[covered], minlength=length + 1
+    )
+    return np.cumsum(deltas[:length])
+
+
+def daily_age_buckets(days, time_opened, time_closed, cutoffs, labels, age_from=None):
+    """Count the tickets open on each day, split by age.
+
+    A ticket is open on a day when it was opened before the end of the day
+    and closed after the start of it.  Its age on that day is measured from
+    the start of the day back to age_from (time_opened when not given).
+    Bucket i holds ages in [cutoffs[i - 1], cutoffs[i]), so there is one more
+    label than cutoffs.
+
+    Returns a DataFrame indexed by days with a column for each label followed
+    by a "total" column.
+    """
+    day_starts = _as_ns(days)
+    day_ends = day_starts + (ONE_DAY_NS - 1)
+    opened = _as_ns(time_opened)
+    closed = _as_ns(time_closed)
+    if age_from is None:
+        age_origin = opened
+    else:
+        age_origin = _as_ns(age_from)
+    length = len(day_starts)
+
+    # first day whose end is at/after the open time, first day starting at/after close
+    first_open_day = np.searchsorted(day_ends, opened, side="left")
+    first_closed_day = np.searchsorted(day_starts, closed, side="left")
+
+    results_df = DataFrame(index=days)
+    lower = np.zeros(len(opened), dtype=np.int64)
+    for i, label in enumerate(labels):
+        if i < len(cutoffs):
+            # first day on which the ticket has reached the next cutoff age
+            upper = np.searchsorted(
+                day_starts, age_origin + pd.Timedelta(cutoffs[i]).value, side="left"
+            )
+        else:
+            upper = np.full(len(opened), length, dtype=np.int64)
+        results_df[label] = _count_ranges(
+            np.maximum(first_open_day, lower),
+            np.minimum(first_closed_day, upper),
+            length,
+        )
+        lower = upper
+    results_df["total"] = _count_ranges(first_open_day, first_closed_day, length)
+    return results_df
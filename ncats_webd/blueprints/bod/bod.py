@@ -15,7 +15,21 @@ import schedule
 
 from cyhy.util import util
 from cyhy.db import database
-from ncats_webd.common import cache, socketio, catch_exceptions
+from ncats_webd.common import cache, socketio, process_pool, catch_exceptions
+from ncats_webd.refresh import refresh_ahead
+from ncats_webd.broadcast import Broadcaster
+from ncats_webd.leader import on_elected
+from ncats_webd.age_buckets import daily_age_buckets
+from ncats_webd.org_index import get_org_index
+from ncats_webd.offload import DB
+from ncats_webd.frames import (
+    CATEGORY,
+    DATETIME,
+    Column,
+    load_frame,
+    projection,
+    utc_timestamp,
+)
 
 # from trepan.api import debug
 
@@ -30,7 +44,19 @@ BOD_START_DATE = parser.parse("2015-05-21T00:00:00").replace(tzinfo=tz.tzutc())
 #       is set to UTC, it was being stored as tzinfo=tzlocal(), which threw an error when comparing to other timestamps where tzinfo=tzutc()
 BOD_CUTOFF_1 = 30
 BOD_CUTOFF_2 = 60
+# in the order of the CSV columns
+OPEN_TICKET_COLUMNS = [
+    Column("cve", path="details.cve"),
+    Column("ip"),
+    Column("name", CATEGORY, path="details.name"),
+    Column("owner", CATEGORY),
+    Column("port"),
+    Column("time_opened", DATETIME),
+]
+BACKLOG_COLUMNS = [Column("time_closed", DATETIME)]
+AGE_COLUMNS = [Column("time_opened", DATETIME), Column("time_closed", DATETIME)]
 data_pusher = None
+bod_broadcaster = Broadcaster("bod_data_push", "bod")
 
 # import IPython; IPython.embed() #<<< BREAKPOINT >>>
 
@@ -39,8 +65,9 @@ data_pusher = None
 ###############################################################################
 
 
-@bp.before_app_first_request
+@on_elected
 def schedule_broadcaster():
+    @catch_exceptions
     def job():
         broadcast_bod_update()
 
@@ -53,7 +80,7 @@ def schedule_broadcaster():
 
 
 def get_bod_open_tickets_dataframe(bod_start_date):
-    bod_owners = current_app.db.RequestDoc.get_all_descendants("EXECUTIVE")
+    bod_owners = get_org_index(current_app.db).get_all_descendants("EXECUTIVE")
     tix = current_app.db.TicketDoc.find(
         {
             "source": "nessus",
@@ -62,21 +89,9 @@ def get_bod_open_tickets_dataframe(bod_start_date):
             "owner": {"$in": bod_owners},
             "open": True,
         },
-        {
-            "_id": False,
-            "owner": True,
-            "time_opened": True,
-            "ip": True,
-            "port": True,
-            "details.name": True,
-            "details.cve": True,
-        },
+        projection(OPEN_TICKET_COLUMNS),
     )
-    tix = list(tix)
-    for x in tix:
-        x.update(x["details"])
-        del x["details"]
-    df = DataFrame(tix)
+    df = load_frame(tix, OPEN_TICKET_COLUMNS)
     if not df.empty:
         bsd_utc = pd.to_datetime(
             bod_start_date
@@ -98,14 +113,14 @@ def get_bod_open_tickets_dataframe(bod_start_date):
     return df
 
 
-def get_bod_dataframe(bod_start_date):
+def get_bod_dataframe(db, bod_start_date):
     now = util.utcnow()
     tomorrow = now + datetime.timedelta(days=1)
     days_of_the_bod = pd.to_datetime(pd.date_range(bod_start_date, now), utc=True)
 
-    bod_owners = current_app.db.RequestDoc.get_all_descendants("EXECUTIVE")
+    bod_owners = get_org_index(db).get_all_descendants("EXECUTIVE")
 
-    backlog_tix = current_app.db.TicketDoc.find(
+    backlog_tix = db.TicketDoc.find(
         {
             "source": "nessus",
             "details.severity": 4,
@@ -114,22 +129,17 @@ def get_bod_dataframe(bod_start_date):
             "false_positive": False,
             "$or": [{"time_closed": {"$gte": bod_start_date}}, {"time_closed": None}],
         },
-        {"_id": False, "time_closed": True},
+        projection(BACKLOG_COLUMNS),
     )
 
     results_df = DataFrame(
         index=days_of_the_bod, columns=["young", "mid", "old", "total"]
     )
-    backlog_tix = list(backlog_tix)
-    df = DataFrame(backlog_tix)
+    df = load_frame(backlog_tix, BACKLOG_COLUMNS)
     if not df.empty:
         df["tally"] = 1
-        df.time_closed = df.time_closed.fillna(
-            tomorrow
-        )  # assume they'll close tomorrow
-        df.time_closed = df.time_closed.apply(
-            pd.to_datetime
-        )  # if fillna is noop we have wrong types still
+        # assume they'll close tomorrow
+        df.time_closed = df.time_closed.fillna(utc_timestamp(tomorrow))
 
         df_backlog = df.set_index("time_closed")
         df_backlog = df_backlog.resample("1D").sum()
@@ -137,11 +147,11 @@ def get_bod_dataframe(bod_start_date):
         df_backlog = df_backlog.reindex(days_of_the_bod)  # does not include tomorrow
         df_backlog.tally = df_backlog.tally.fillna(0).astype(np.int)
         df_backlog["csum"] = df_backlog.tally.cumsum()
-        df_backlog["remaining"] = len(backlog_tix) - df_backlog.csum
+        df_backlog["remaining"] = len(df) - df_backlog.csum
     else:
         df_backlog = DataFrame()
     # Calculate Buckets
-    tix = current_app.db.TicketDoc.find(
+    tix = db.TicketDoc.find(
         {
             "source": "nessus",
             "details.severity": 4,
@@ -149,17 +159,12 @@ def get_bod_dataframe(bod_start_date):
             "owner": {"$in": bod_owners},
             "$or": [{"time_closed": {"$gte": bod_start_date}}, {"time_closed": None}],
         },
-        {"_id": False, "time_opened": True, "time_closed": True},
+        projection(AGE_COLUMNS),
     )
-    df = DataFrame(list(tix))
+    df = load_frame(tix, AGE_COLUMNS)
     if not df.empty:
-        # Convert times to pandas Timestamp
-        df.time_opened = pd.to_datetime(df.time_opened, utc=True)
         # For tickets that haven't closed yet, also set time_closed to tomorrow
-        # df.time_closed = pd.to_datetime(df.time_closed.fillna(tomorrow), utc=True).dt.tz_localize('UTC')
-        df.time_closed = pd.to_datetime(
-            df.time_closed.fillna(tomorrow), utc=True
-        ).dt.tz_convert("UTC")
+        df.time_closed = df.time_closed.fillna(utc_timestamp(tomorrow))
         bsd_utc = pd.to_datetime(
             bod_start_date
         )  # Store bod_start_date as pandas Timestamp
@@ -171,28 +176,14 @@ def get_bod_dataframe(bod_start_date):
         mid_delta = np.timedelta64(BOD_CUTOFF_1, "D")
         old_delta = np.timedelta64(BOD_CUTOFF_2, "D")
 
-        for start_of_day, values in results_df.iterrows():
-            end_of_day = start_of_day + np.timedelta64(1, "D") - np.timedelta64(1, "ns")
-            open_on_day_mask = (df.time_opened <= end_of_day) & (
-                df.time_closed > start_of_day
-            )
-            bod_age_on_date = start_of_day - df.bod_time_opened
-            bod_age_on_date_masked = bod_age_on_date.mask(open_on_day_mask == False)
-            values["total"] = open_on_day_mask.value_counts().get(True, 0)
-            values["young"] = (
-                (bod_age_on_date_masked < mid_delta).value_counts().get(True, 0)
-            )
-            values["mid"] = (
-                (
-                    (bod_age_on_date_masked >= mid_delta)
-                    & (bod_age_on_date_masked < old_delta)
-                )
-                .value_counts()
-                .get(True, 0)
-            )
-            values["old"] = (
-                (bod_age_on_date_masked >= old_delta).value_counts().get(True, 0)
-            )
+        results_df = daily_age_buckets(
+            days_of_the_bod,
+            df.time_opened,
+            df.time_closed,
+            [mid_delta, old_delta],
+            ["young", "mid", "old"],
+            age_from=df.bod_time_opened,
+        )
 
         if not df_backlog.empty:
             # combine previous calculations
@@ -200,7 +191,7 @@ def get_bod_dataframe(bod_start_date):
     return results_df
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_bod_open_tickets(bod_start_date):
     results_df = get_bod_open_tickets_dataframe(bod_start_date)
     results = results_df.to_dict("records")
@@ -222,9 +213,9 @@ def csv_get_bod_open_tickets(bod_start_date):
     return response
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_bod_data(bod_start_date):
-    results_df = get_bod_dataframe(bod_start_date)
+    results_df = process_pool.run(get_bod_dataframe, DB, bod_start_date)
     # create json output
     results = OrderedDict()  # the order matters to c3js
     results["x"] = [x.strftime("%Y-%m-%d") for x in results_df.index]
@@ -238,7 +229,7 @@ def json_get_bod_data(bod_start_date):
 
 @cache.memoize(timeout=REFRESH_INTERVAL)
 def csv_get_bod_data(bod_start_date):
-    results_df = get_bod_dataframe(bod_start_date)
+    results_df = process_pool.run(get_bod_dataframe, DB, bod_start_date)
     results_df.index.name = "date"
     results_df.columns = ["< 30 days", "30-60 days", "> 60 days", "total", "backlog"]
     response = Response(results_df.to_csv(), mimetype="text/csv")
@@ -246,11 +237,11 @@ def csv_get_bod_data(bod_start_date):
     return response
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_bod_histogram_data(bod_start_date):
     results_df = get_bod_open_tickets_dataframe(bod_start_date)
     if results_df.empty == True:
-        return {}
+        return json.dumps({"age": []})
     s = results_df.bod_age
     oldest = int(s.max())
     s2 = s.value_counts().reindex(range(oldest + 1)).fillna(0)
@@ -317,10 +308,7 @@ def broadcast_bod_update(broadcast=True):
     chart1_data = json_get_bod_data(BOD_START_DATE)
     chart2_data = json_get_bod_histogram_data(BOD_START_DATE)
     data = {"bod_chart1": chart1_data, "bod_chart2": chart2_data}
-    # Note: emit will json encode our object with json data.
-    # so we need to call JSON.parse on the json string
-    # to reconstitue the object client-side.
     if broadcast:
-        socketio.emit("bod_data_push", data, namespace="/cyhy", room="bod")
+        bod_broadcaster.publish(data)
     else:  # reply to latest request
-        emit("bod_data_push", data, namespace="/cyhy")
+        bod_broadcaster.resync(data)
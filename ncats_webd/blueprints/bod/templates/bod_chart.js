@@ -6,10 +6,10 @@
         socket.emit('bod_latest');
     });
 
-    socket.on('bod_data_push', function(msg) {
+    subscribe_versioned(socket, 'bod_data_push', 'bod_latest', function(msg) {
         console.log('recieved new bod data');
-        bod_chart1.load({json:JSON.parse(msg.bod_chart1)});
-        bod_chart2.load({json:JSON.parse(msg.bod_chart2)});
+        bod_chart1.load({json:msg.bod_chart1});
+        bod_chart2.load({json:msg.bod_chart2});
     })
     
     if (typeof is_printable_chart === 'undefined') {
@@ -1,13 +1,26 @@
-from flask import Blueprint, render_template, abort, current_app, request, Response
+from flask import (
+    Blueprint,
+    render_template,
+    abort,
+    current_app,
+    request,
+    Response,
+    stream_with_context,
+)
 from flask_socketio import send, emit
 from bson.objectid import ObjectId
 from dateutil import parser
 
 import datetime
+import os
 import schedule
 
 from cyhy.util import util
-from ncats_webd.common import cache, socketio, catch_exceptions
+from ncats_webd.common import cache, socketio, process_pool, catch_exceptions
+from ncats_webd.refresh import refresh_ahead
+from ncats_webd.broadcast import Broadcaster
+from ncats_webd.offload import DB
+from ncats_webd.leader import on_elected
 import ncats_webd.cybex_queries
 
 # from trepan.api import debug
@@ -26,7 +39,9 @@ CRITICAL_HISTOGRAM_CUTOFF_DAYS = 180
 HIGH_HISTOGRAM_CUTOFF_DAYS = 360
 CRITICAL_SEVERITY = 4
 HIGH_SEVERITY = 3
+HISTORY_DIR_NAME = "cybex_history"  # past age history counts, in the instance dir
 data_pusher = None
+cybex_broadcaster = Broadcaster("cybex_data_push", "cybex")
 
 # import IPython; IPython.embed() #<<< BREAKPOINT >>>
 
@@ -35,8 +50,9 @@ data_pusher = None
 ###############################################################################
 
 
-@bp.before_app_first_request
+@on_elected
 def schedule_broadcaster():
+    @catch_exceptions
     def job():
         broadcast_cybex_update()
 
@@ -48,14 +64,13 @@ def schedule_broadcaster():
 ###############################################################################
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_open_tickets(ticket_severity):
-    return ncats_webd.cybex_queries.json_get_open_tickets(
-        current_app.db, ticket_severity
+    return process_pool.run(
+        ncats_webd.cybex_queries.json_get_open_tickets, DB, ticket_severity
     )
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
 def csv_get_open_tickets(ticket_severity):
     if ticket_severity == CRITICAL_SEVERITY:
         severity_name = "_critical"
@@ -65,7 +80,7 @@ def csv_get_open_tickets(ticket_severity):
         severity_name = ""
 
     csv = ncats_webd.cybex_queries.csv_get_open_tickets(current_app.db, ticket_severity)
-    response = Response(csv, mimetype="text/csv")
+    response = Response(stream_with_context(csv), mimetype="text/csv")
     response.headers[
         "Content-Disposition"
     ] = "attachment; filename=cybex_open_tickets{!s}_{!s}.csv".format(
@@ -74,7 +89,6 @@ def csv_get_open_tickets(ticket_severity):
     return response
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
 def csv_get_closed_tickets(ticket_severity):
     if ticket_severity == CRITICAL_SEVERITY:
         severity_name = "_critical"
@@ -86,7 +100,7 @@ def csv_get_closed_tickets(ticket_severity):
     csv = ncats_webd.cybex_queries.csv_get_closed_tickets(
         current_app.db, ticket_severity
     )
-    response = Response(csv, mimetype="text/csv")
+    response = Response(stream_with_context(csv), mimetype="text/csv")
     response.headers[
         "Content-Disposition"
     ] = "attachment; filename=cybex_closed_tickets{!s}_past_{!s}_days_{!s}.csv".format(
@@ -97,10 +111,18 @@ def csv_get_closed_tickets(ticket_severity):
     return response
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+def history_dir():
+    return os.path.join(current_app.instance_path, HISTORY_DIR_NAME)
+
+
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_cybex_data(start_date, ticket_severity):
-    return ncats_webd.cybex_queries.json_get_cybex_data(
-        current_app.db, start_date, ticket_severity
+    return process_pool.run(
+        ncats_webd.cybex_queries.json_get_cybex_data,
+        DB,
+        start_date,
+        ticket_severity,
+        history_dir(),
     )
 
 
@@ -113,8 +135,12 @@ def csv_get_cybex_data(start_date, ticket_severity):
     else:
         severity_name = ""
 
-    csv = ncats_webd.cybex_queries.csv_get_cybex_data(
-        current_app.db, start_date, ticket_severity
+    csv = process_pool.run(
+        ncats_webd.cybex_queries.csv_get_cybex_data,
+        DB,
+        start_date,
+        ticket_severity,
+        history_dir(),
     )
     response = Response(csv, mimetype="text/csv")
     response.headers[
@@ -125,10 +151,13 @@ def csv_get_cybex_data(start_date, ticket_severity):
     return response
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_cybex_histogram_data(ticket_severity, max_age_cutoff=None):
-    return ncats_webd.cybex_queries.json_get_cybex_histogram_data(
-        current_app.db, ticket_severity, max_age_cutoff
+    return process_pool.run(
+        ncats_webd.cybex_queries.json_get_cybex_histogram_data,
+        DB,
+        ticket_severity,
+        max_age_cutoff,
     )
 
 
@@ -227,10 +256,7 @@ def broadcast_cybex_update(broadcast=True):
         "cybex_chart3": chart3_data,
         "cybex_chart4": chart4_data,
     }
-    # Note: emit will json encode our object with json data.
-    # so we need to call JSON.parse on the json string
-    # to reconstitue the object client-side.
     if broadcast:
-        socketio.emit("cybex_data_push", data, namespace="/cyhy", room="cybex")
+        cybex_broadcaster.publish(data)
     else:  # reply to latest request
-        emit("cybex_data_push", data, namespace="/cyhy")
+        cybex_broadcaster.resync(data)
@@ -6,12 +6,12 @@
         socket.emit('cybex_latest');
     });
 
-    socket.on('cybex_data_push', function(msg) {
+    subscribe_versioned(socket, 'cybex_data_push', 'cybex_latest', function(msg) {
         console.log('received new cybex data');
-        cybex_chart1.load({json:JSON.parse(msg.cybex_chart1)});
-        cybex_chart2.load({json:JSON.parse(msg.cybex_chart2)});
-        cybex_chart3.load({json:JSON.parse(msg.cybex_chart3)});
-        cybex_chart4.load({json:JSON.parse(msg.cybex_chart4)});
+        cybex_chart1.load({json:msg.cybex_chart1});
+        cybex_chart2.load({json:msg.cybex_chart2});
+        cybex_chart3.load({json:msg.cybex_chart3});
+        cybex_chart4.load({json:msg.cybex_chart4});
 		console.log(msg);
     })
     
@@ -1,8 +1,6 @@
 import json
 import re
 import time
-import datetime
-from collections import deque
 
 from flask import Blueprint, render_template, abort, current_app, request
 from flask_socketio import send, emit
@@ -12,7 +10,13 @@ import schedule
 from cyhy.util import util
 from cyhy.db import database
 from ncats_webd.common import cache, socketio, catch_exceptions
+from ncats_webd.refresh import refresh_ahead
+from ncats_webd.broadcast import Broadcaster
+from ncats_webd import feeds
+from ncats_webd.feeds import Feed
+from ncats_webd.leader import on_elected
 from ncats_webd.queries import DashboardQueries
+from ncats_webd import ticket_summary
 
 # import IPython; IPython.embed() #<<< BREAKPOINT >>>
 
@@ -26,53 +30,20 @@ OID_RE = re.compile(r"^[0-9a-f]{24}$")
 TID_RE = re.compile(r"^[/A-Za-z0-9]+$")
 SOURCE_ID_RE = re.compile(r"^nessus:[0-9]+$")
 ticket_feed = None
-
-
-class TicketFeed(object):
-    # TODO decrease sleep_time after testing query load on db
-    def __init__(self, db, emitter, logger, sleep_time=300, history_size=100):
-        self.__db = db
-        self.__emitter = emitter
-        self.__logger = logger
-        self.__sleep_time = sleep_time
-        self.__since = util.utcnow() - datetime.timedelta(minutes=30)
-        self.__history = deque(maxlen=history_size)
-        schedule.every(sleep_time).seconds.do(self.__work)
-
-    @catch_exceptions
-    def __work(self):
-        self.__logger.debug("checking for updated tickets")
-        new_tickets = self.__check_database()
-        if new_tickets:
-            self.__logger.debug("found %d updated tickets" % len(new_tickets))
-            self.__history.extend(new_tickets)
-            self.__emitter(new_tickets)
-        else:
-            self.__logger.debug("no updated tickets found")
-
-    def __check_database(self):
-        now = util.utcnow()
-        tickets = self.__db.tickets.find(
-            {"source": "nessus", "last_change": {"$gt": self.__since}},
-            {
-                "_id": 1,
-                "owner": 1,
-                "details": 1,
-                "events.action": 1,
-                "events": {"$slice": -1},
-            },
-        ).sort([("last_change", -1)])
-        tickets = list(tickets)
-        for (
-            x
-        ) in tickets:  # convert _ids to string since we can't set custom json handler
-            x["_id"] = str(x["_id"])
-        self.__since = now
-        return tickets
-
-    @property
-    def history(self):
-        return list(self.__history)
+# TODO decrease the poll interval after testing query load on db
+TICKET_FEED_POLL_INTERVAL = 300  # seconds, used when change streams aren't available
+TICKET_FEED_HISTORY_KEY = "ticket_feed_history"
+TICKET_FEED_PROJECTION = {
+    "_id": 1,
+    "owner": 1,
+    "details": 1,
+    "events.action": 1,
+    "events": {"$slice": -1},
+}
+overall_metrics_broadcaster = Broadcaster("overall_metrics", "overall_metrics")
+ticket_severity_counts_broadcaster = Broadcaster(
+    "ticket_severity_counts", "ticket_severity_counts"
+)
 
 
 ###############################################################################
@@ -80,12 +51,19 @@ class TicketFeed(object):
 ###############################################################################
 
 
-@bp.before_app_first_request
+@on_elected
 def start_background_thread():
     global ticket_feed
     if ticket_feed is None:
-        ticket_feed = TicketFeed(
-            current_app.db, broadcast_new_tickets, current_app.logger
+        ticket_feed = Feed(
+            current_app.db.tickets,
+            broadcast_new_tickets,
+            current_app.logger,
+            query={"source": "nessus"},
+            projection=TICKET_FEED_PROJECTION,
+            since_field="last_change",
+            poll_interval=TICKET_FEED_POLL_INTERVAL,
+            history_key=TICKET_FEED_HISTORY_KEY,
         )
     # TODO: Probably throwing exception quietly
     @catch_exceptions
@@ -97,6 +75,12 @@ def start_background_thread():
 
     schedule.every(60).seconds.do(job)
 
+    @catch_exceptions
+    def rebuild_ticket_summary():
+        ticket_summary.rebuild(current_app.db)
+
+    schedule.every(ticket_summary.REBUILD_INTERVAL).seconds.do(rebuild_ticket_summary)
+
 
 ###############################################################################
 #  Data Access
@@ -123,7 +107,7 @@ def first_seen_ticket_counts():
     )
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_first_seen_ticket_counts():
     cursor = database.run_pipeline_cursor(first_seen_ticket_counts(), current_app.db)
     counts = list(cursor)
@@ -131,7 +115,7 @@ def json_get_first_seen_ticket_counts():
     return counts
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_ticket_severity_counts():
     stakeholders = DashboardQueries.build_stakeholder_list(current_app.db)
     sorted_ticket_data = DashboardQueries.get_ticket_severity_counts(
@@ -140,21 +124,21 @@ def json_get_ticket_severity_counts():
     return json.dumps(sorted_ticket_data, default=util.custom_json_handler)
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_overall_metrics():
     stakeholders = DashboardQueries.build_stakeholder_list(current_app.db)
     results = DashboardQueries.get_overall_metrics(current_app.db, stakeholders)
     return json.dumps(results, default=util.custom_json_handler)
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_election_metrics():
     election_stakeholders = DashboardQueries.build_election_list(current_app.db)
     results = DashboardQueries.get_election_metrics(current_app.db)
     return json.dumps(results, default=util.custom_json_handler)
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_election_ticket_severity_counts():
     election_stakeholders = DashboardQueries.build_election_list(current_app.db)
     sorted_ticket_data = DashboardQueries.get_ticket_severity_counts(
@@ -288,19 +272,23 @@ def ticket_query_owner_source(owner_id, source_id):
 def history_event(count=100):
     print("Client requested history")
     # send(json, json=True) #unnamed event
-    emit("historic_tickets", ticket_feed.history[-count:])  # named event
+    # the feed runs in the leader process, which may not be this one
+    history = feeds.shared_history(TICKET_FEED_HISTORY_KEY)
+    emit("historic_tickets", history[-count:])  # named event
 
 
 @socketio.on("overall_metrics_latest", namespace="/cyhy")
 def latest_overall_metrics_event():
     current_app.logger.info("client requested overall metrics data")
-    emit("overall_metrics", {"data": json_get_overall_metrics()})
+    overall_metrics_broadcaster.resync({"data": json_get_overall_metrics()})
 
 
 @socketio.on("ticket_severity_counts_latest", namespace="/cyhy")
 def latest_ticket_severity_counts_event():
     current_app.logger.info("client requested ticket severity counts data")
-    emit("ticket_severity_counts", {"data": json_get_ticket_severity_counts()})
+    ticket_severity_counts_broadcaster.resync(
+        {"data": json_get_ticket_severity_counts()}
+    )
 
 
 @socketio.on("election_metrics_latest", namespace="/cyhy")
@@ -330,23 +318,13 @@ def broadcast_new_tickets(tickets):
 
 def broadcast_overall_metrics():
     current_app.logger.debug("broadcasting overall metrics")
-    overall_metrics = json_get_overall_metrics()
-    socketio.emit(
-        "overall_metrics",
-        {"data": overall_metrics},
-        namespace="/cyhy",
-        room="overall_metrics",
-    )
+    overall_metrics_broadcaster.publish({"data": json_get_overall_metrics()})
 
 
 def broadcast_ticket_severity_counts():
     current_app.logger.debug("broadcasting ticket severity counts")
-    ticket_severity_counts = json_get_ticket_severity_counts()
-    socketio.emit(
-        "ticket_severity_counts",
-        {"data": ticket_severity_counts},
-        namespace="/cyhy",
-        room="ticket_severity_counts",
+    ticket_severity_counts_broadcaster.publish(
+        {"data": json_get_ticket_severity_counts()}
     )
 
 
@@ -0,0 +1,38 @@
+import json
+
+from flask import Blueprint, Response
+
+from ncats_webd.cache_backends import shared_backend
+from ncats_webd.common import cache
+from ncats_webd import perf
+
+BLUEPRINT_NAME = "debug"
+bp = Blueprint(BLUEPRINT_NAME, __name__)
+
+###############################################################################
+#  Routes
+###############################################################################
+
+
+@bp.route("/cache")
+def cache_stats():
+    backend = cache.cache
+    result = {"type": type(backend).__name__}
+    if hasattr(backend, "stats"):
+        result.update(backend.stats())
+    return json.dumps(result)
+
+
+@bp.route("/perf")
+def perf_stats():
+    return json.dumps(
+        perf.snapshot(perf.worker_values(shared_backend(cache.cache))), sort_keys=True
+    )
+
+
+@bp.route("/perf/prometheus")
+def perf_prometheus():
+    return Response(
+        perf.prometheus_text(perf.worker_values(shared_backend(cache.cache))),
+        mimetype="text/plain; version=0.0.4",
+    )
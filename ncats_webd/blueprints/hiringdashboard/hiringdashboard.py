@@ -1,7 +1,5 @@
 import json
 import re
-import datetime
-from collections import deque
 
 from flask import Blueprint, render_template, abort, current_app, request, logging
 from flask_socketio import send, emit
@@ -15,6 +13,9 @@ import math
 from cyhy.util import util
 from cyhy.db import database
 from ncats_webd.common import cache, socketio, catch_exceptions
+from ncats_webd.broadcast import Broadcaster
+from ncats_webd.feeds import Feed
+from ncats_webd.leader import on_elected
 from ncats_webd.queries import HiringDashboardQueries
 
 # import IPython; IPython.embed() #<<< BREAKPOINT >>>
@@ -29,44 +30,8 @@ OID_RE = re.compile(r"^[0-9a-f]{24}$")
 TID_RE = re.compile(r"^[/A-Za-z0-9]+$")
 SOURCE_ID_RE = re.compile(r"^nessus:[0-9]+$")
 new_hire_feed = None
-
-
-class NewHireFeed(object):
-    # TODO decrease sleep_time after testing query load on db
-    def __init__(self, db, emitter, logger, sleep_time=3000, history_size=100):
-        self.__db = db
-        self.__emitter = emitter
-        self.__logger = logger
-        self.__sleep_time = sleep_time
-        self.__since = util.utcnow() - datetime.timedelta(minutes=30)
-        self.__history = deque(maxlen=history_size)
-        schedule.every(sleep_time).seconds.do(self.__work)
-
-    @catch_exceptions
-    def __work(self):
-        self.__logger.debug("checking for updated tickets")
-        new_tickets = self.__check_database()
-        if new_tickets:
-            self.__logger.debug("found %d updated tickets" % len(new_tickets))
-            self.__history.extend(new_tickets)
-            self.__emitter(new_tickets)
-        else:
-            self.__logger.debug("no updated tickets found")
-
-    def __check_database(self):
-        now = util.utcnow()
-        tickets = self.__db.new_hire.find({"latest": True})
-        tickets = list(tickets)
-        for (
-            x
-        ) in tickets:  # convert _ids to string since we can't set custom json handler
-            x["_id"] = str(x["_id"])
-        self.__since = now
-        return tickets
-
-    @property
-    def history(self):
-        return list(self.__history)
+NEW_HIRE_FEED_POLL_INTERVAL = 3000  # seconds, used when change streams aren't available
+new_hire_metrics_broadcaster = Broadcaster("new_hire_metrics", "new_hire_metrics")
 
 
 ###############################################################################
@@ -74,12 +39,16 @@ class NewHireFeed(object):
 ###############################################################################
 
 
-@bp.before_app_first_request
+@on_elected
 def start_background_thread():
     global new_hire_feed
     if new_hire_feed is None:
-        new_hire_feed = NewHireFeed(
-            current_app.new_hire_db, broadcast_new_hire_metrics(), current_app.logger
+        new_hire_feed = Feed(
+            current_app.new_hire_db.new_hire,
+            new_hire_changed,
+            current_app.logger,
+            query={"latest": True},
+            poll_interval=NEW_HIRE_FEED_POLL_INTERVAL,
         )
     # TODO: Probably throwing exception quietly
     @catch_exceptions
@@ -136,7 +105,7 @@ def json_get_hire_metrics():
 @socketio.on("new_hire_metrics_latest", namespace="/cyhy")
 def new_hire_metrics_latest_event():
     current_app.logger.info("client requested new hire metric data")
-    emit("new_hire_metrics", {"data": json_get_hire_metrics()})
+    new_hire_metrics_broadcaster.resync({"data": json_get_hire_metrics()})
 
 
 ###############################################################################
@@ -144,11 +113,11 @@ def new_hire_metrics_latest_event():
 ###############################################################################
 
 
+def new_hire_changed(docs):
+    current_app.logger.debug("new hire data changed")
+    cache.delete_memoized(json_get_hire_metrics)
+    broadcast_new_hire_metrics()
+
+
 def broadcast_new_hire_metrics():
-    new_hire_metrics = json_get_hire_metrics()
-    socketio.emit(
-        "new_hire_metrics",
-        {"data": new_hire_metrics},
-        namespace="/cyhy",
-        room="new_hire_metrics",
-    )
+    new_hire_metrics_broadcaster.publish({"data": json_get_hire_metrics()})
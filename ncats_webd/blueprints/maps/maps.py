@@ -1,4 +1,7 @@
 import json
+import math
+import zlib
+
 from flask import (
     Blueprint,
     render_template,
@@ -7,8 +10,11 @@ from flask import (
     redirect,
     url_for,
     request,
+    Response,
 )
+import numpy as np
 
+from cyhy.core import STAGE
 from cyhy.util import util
 from ncats_webd.common import cache
 from ncats_webd.queries import MapQueries
@@ -18,14 +24,25 @@ bp = Blueprint(
     BLUEPRINT_NAME, __name__, template_folder="templates", static_folder="static"
 )
 
+# uint8 codes for the stage column of packed running scan locations
+STAGE_CODES = [None, STAGE.NETSCAN1, STAGE.NETSCAN2, STAGE.PORTSCAN, STAGE.VULNSCAN]
+BIN_SHAPES = ("grid", "hex")
+MIN_BIN_RESOLUTION = 0.01  # degrees
+MAX_BIN_RESOLUTION = 45.0  # degrees
+
 ###############################################################################
 #  Data Access
 ###############################################################################
 
 
+@cache.memoize(timeout=300)
+def get_open_ticket_locs_by_severity():
+    return MapQueries.get_open_ticket_locs_by_severity(current_app.db)
+
+
 @cache.memoize(timeout=300)
 def json_get_loc_severity(severity=None):
-    results = MapQueries.get_open_ticket_loc_by_severity(current_app.db, severity)
+    results = get_open_ticket_locs_by_severity().get(severity, [])
     return json.dumps(results, default=util.custom_json_handler)
 
 
@@ -41,6 +58,206 @@ def json_get_ip_locs():
     return json.dumps(results, default=util.custom_json_handler)
 
 
+@cache.memoize(timeout=300)
+def packed_get_loc_severity(severity=None, compress=False):
+    return pack_locations(
+        get_open_ticket_locs_by_severity().get(severity, []), severity_code, compress
+    )
+
+
+@cache.memoize(timeout=30)
+def packed_get_running(compress=False):
+    return pack_locations(
+        MapQueries.find_running_ips(current_app.db), stage_code, compress
+    )
+
+
+@cache.memoize(timeout=3600)
+def packed_get_ip_locs(compress=False):
+    return pack_locations(
+        MapQueries.find_host_locations(current_app.db), None, compress
+    )
+
+
+@cache.memoize(timeout=300)
+def json_get_loc_severity_bins(severity, resolution, shape):
+    results = bin_locations(
+        get_open_ticket_locs_by_severity().get(severity, []),
+        resolution,
+        shape,
+        severity_code,
+    )
+    results["by"] = "severity"
+    return json.dumps(results)
+
+
+@cache.memoize(timeout=30)
+def json_get_running_bins(resolution, shape):
+    results = bin_locations(
+        MapQueries.find_running_ips(current_app.db), resolution, shape, stage_code
+    )
+    results["by"] = "stage"
+    results["labels"] = [stage or "" for stage in STAGE_CODES]
+    return json.dumps(results)
+
+
+@cache.memoize(timeout=3600)
+def json_get_ip_locs_bins(resolution, shape):
+    results = bin_locations(
+        MapQueries.find_host_locations(current_app.db), resolution, shape
+    )
+    return json.dumps(results)
+
+
+###############################################################################
+#  Utils
+###############################################################################
+
+
+def severity_code(doc):
+    return doc.get("details", {}).get("severity") or 0
+
+
+def stage_code(doc):
+    stage = doc.get("stage")
+    return STAGE_CODES.index(stage) if stage in STAGE_CODES else 0
+
+
+def location_table(docs, column=None):
+    """Returns an N x 3 array of the lon, lat and column code of each of docs
+    (a cursor or list) that has a location."""
+
+    def values():
+        for doc in docs:
+            loc = doc.get("loc")
+            if not loc or len(loc) < 2 or loc[0] is None or loc[1] is None:
+                continue
+            yield loc[0]
+            yield loc[1]
+            yield column(doc) if column else 0
+
+    return np.fromiter(values(), dtype=np.float64).reshape(-1, 3)
+
+
+def grid_centers(lon, lat, resolution):
+    """Snap points to the centers of a square grid of resolution degrees."""
+    return (
+        (np.floor(lon / resolution) + 0.5) * resolution,
+        (np.floor(lat / resolution) + 0.5) * resolution,
+    )
+
+
+def hex_centers(lon, lat, resolution):
+    """Snap points to the centers of pointy-top hexagons that are resolution
+    degrees wide, the layout d3.hexbin uses."""
+    size = resolution / math.sqrt(3)  # center to corner
+    # fractional axial coordinates, rounded through cube coordinates
+    q = (lon * math.sqrt(3) / 3 - lat / 3.0) / size
+    r = (lat * 2 / 3.0) / size
+    x, z = q, r
+    y = -x - z
+    rx, ry, rz = np.round(x), np.round(y), np.round(z)
+    dx, dy, dz = np.abs(rx - x), np.abs(ry - y), np.abs(rz - z)
+    fix_x = (dx > dy) & (dx > dz)
+    fix_z = ~fix_x & (dz >= dy)
+    rx = np.where(fix_x, -ry - rz, rx)
+    rz = np.where(fix_z, -rx - ry, rz)
+    return size * math.sqrt(3) * (rx + rz / 2.0), size * 1.5 * rz
+
+
+def bin_locations(docs, resolution, shape="grid", column=None):
+    """Count the locations of docs in grid or hex cells of resolution degrees.
+
+    Returns a dict whose cells are [lon, lat, total] rows, one per non-empty
+    cell center, followed by the count for each column code (0, 1, ...) when
+    a column function is given.
+    """
+    table = location_table(docs, column)
+    if shape == "hex":
+        cell_lon, cell_lat = hex_centers(table[:, 0], table[:, 1], resolution)
+    else:
+        cell_lon, cell_lat = grid_centers(table[:, 0], table[:, 1], resolution)
+    # round off the float noise so equal centers compare equal
+    centers = np.round(np.column_stack([cell_lon, cell_lat]), 6)
+    results = {"resolution": resolution, "shape": shape, "count": len(table)}
+    if not len(table):
+        results["cells"] = []
+        return results
+    centers, cell_index = np.unique(centers, axis=0, return_inverse=True)
+    cell_index = cell_index.ravel()
+    counts = [np.bincount(cell_index, minlength=len(centers))[:, None]]
+    if column:
+        codes = table[:, 2].astype(np.int64)
+        code_count = int(codes.max()) + 1
+        counts.append(
+            np.bincount(
+                cell_index * code_count + codes, minlength=len(centers) * code_count
+            ).reshape(-1, code_count)
+        )
+    results["cells"] = [
+        center + cell_counts
+        for center, cell_counts in zip(centers.tolist(), np.hstack(counts).tolist())
+    ]
+    return results
+
+
+def requested_bins():
+    """Returns the (resolution, shape) asked for with ?bins=resolution and an
+    optional &shape=grid|hex, or None if bins weren't asked for."""
+    if not request.args.has_key("bins"):
+        return None
+    try:
+        resolution = float(request.args.get("bins"))
+    except ValueError:
+        abort(400)
+    if not MIN_BIN_RESOLUTION <= resolution <= MAX_BIN_RESOLUTION:
+        abort(400)
+    shape = request.args.get("shape", "grid")
+    if shape not in BIN_SHAPES:
+        abort(400)
+    return resolution, shape
+
+
+def pack_locations(docs, column=None, compress=False):
+    """Packs the locations of docs (a cursor or list) into a binary payload.
+
+    The payload is the loc ([lon, lat]) of each doc that has a location as
+    little-endian float32 pairs, followed by one uint8 per doc from the column
+    function when one is given.  It is gzipped when compress is True.
+    Returns a (count, payload) tuple.
+    """
+    table = location_table(docs, column)
+    payload = table[:, :2].astype("<f4").tobytes()
+    if column:
+        payload += table[:, 2].astype(np.uint8).tobytes()
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip
+        payload = compressor.compress(payload) + compressor.flush()
+    return len(table), payload
+
+
+def wants_packed():
+    return request.args.has_key("b")
+
+
+def accepts_gzip():
+    return "gzip" in request.accept_encodings
+
+
+def packed_response(packed, compressed, column=None, labels=None):
+    count, payload = packed
+    response = Response(payload, mimetype="application/octet-stream")
+    response.headers["X-Loc-Count"] = str(count)
+    if column:
+        response.headers["X-Loc-Column"] = column
+    if labels:
+        response.headers["X-Loc-Column-Labels"] = ",".join(labels)
+    if compressed:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
 ###############################################################################
 #  Routes
 ###############################################################################
@@ -54,8 +271,19 @@ def root():
 @bp.route("/running")
 def running():
     # data request
-    if request.args.has_key("j"):
+    bins = requested_bins()
+    if bins:
+        return json_get_running_bins(*bins)
+    elif request.args.has_key("j"):
         return json_get_running()
+    elif wants_packed():
+        compress = accepts_gzip()
+        return packed_response(
+            packed_get_running(compress),
+            compress,
+            "stage",
+            [stage or "" for stage in STAGE_CODES],
+        )
     # template request
     return render_template("running.html")
 
@@ -63,10 +291,18 @@ def running():
 @bp.route("/active")
 def active():
     # data request
-    if request.args.has_key("j"):
+    bins = requested_bins()
+    if request.args.has_key("j") or wants_packed() or bins:
         level = int(request.args.get("level", 0))
         if level == 0:
             level = None
+        if bins:
+            return json_get_loc_severity_bins(level, *bins)
+        elif wants_packed():
+            compress = accepts_gzip()
+            return packed_response(
+                packed_get_loc_severity(level, compress), compress, "severity"
+            )
         return json_get_loc_severity(level)
     # template request
     return render_template("active.html")
@@ -75,7 +311,13 @@ def active():
 @bp.route("/hosts")
 def ips():
     # data request
-    if request.args.has_key("j"):
+    bins = requested_bins()
+    if bins:
+        return json_get_ip_locs_bins(*bins)
+    elif request.args.has_key("j"):
         return json_get_ip_locs()
+    elif wants_packed():
+        compress = accepts_gzip()
+        return packed_response(packed_get_ip_locs(compress), compress)
     # template request
     return render_template("hosts.html")
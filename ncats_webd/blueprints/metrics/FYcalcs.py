@@ -25,217 +25,167 @@ from cyhy.db import database
 from cyhy.util import util
 from cyhy.core.common import REPORT_TYPE, AGENCY_TYPE
 
+from ncats_webd.org_index import get_org_index
+from ncats_webd.counting import count_distinct
+
 # See categorize_orgs() for how these dicts are populated
 ALL_ORGS_BY_TYPE = dict()
 ALL_STAKEHOLDERS_BY_TYPE = dict()
 
 
-def vuln_ticket_counts(FY_START, FY_END, db, severity=0):
-    # TODO: Modify print statements to use format() named parameters
-    if severity == 0:
-        opened_before_and_still_open = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": False,
-                "time_opened": {"$lt": FY_START},
-                "open": True,
-            }
-        ).count()
-        opened_before_and_closed_during = db.TicketDoc.find(
+VULN_TICKET_SEVERITY_LEVELS = {0: "", 1: "Low ", 2: "Medium ", 3: "High ", 4: "Critical "}
+VULN_TICKET_BUCKETS = [
+    "opened_before_and_still_open",
+    "opened_before_and_closed_during",
+    "opened_during_and_still_open",
+    "opened_during_and_closed_during",
+    "opened_during_and_closed_after",
+    "fp_before",
+    "fp_during",
+    "fp_after",
+]
+
+
+def vuln_ticket_counts_by_severity(FY_START, FY_END, db, severities=(0,)):
+    """Returns a dict of each severity in severities to its vuln_ticket_counts()
+    output, computed with a single aggregation over the tickets.  Severity 0
+    covers all severities."""
+    severities = list(severities)
+
+    def both(*conditions):
+        return {"$and": list(conditions)}
+
+    # time_closed is null for open tickets, and null sorts before any date
+    has_closed = {"$gt": ["$time_closed", None]}
+    not_fp = {"$eq": ["$false_positive", False]}
+    fp = {"$eq": ["$false_positive", True]}
+    is_open = {"$eq": ["$open", True]}
+    opened_before = {"$lt": ["$time_opened", FY_START]}
+    opened_during = both(
+        {"$gte": ["$time_opened", FY_START]}, {"$lt": ["$time_opened", FY_END]}
+    )
+    opened_after = {"$gte": ["$time_opened", FY_END]}
+    closed_during = both(
+        has_closed,
+        {"$gte": ["$time_closed", FY_START]},
+        {"$lt": ["$time_closed", FY_END]},
+    )
+    closed_before_end = both(has_closed, {"$lt": ["$time_closed", FY_END]})
+    closed_after = {"$gte": ["$time_closed", FY_END]}
+    bucket_conditions = {
+        "opened_before_and_still_open": both(not_fp, opened_before, is_open),
+        "opened_before_and_closed_during": both(not_fp, opened_before, closed_during),
+        "opened_during_and_still_open": both(not_fp, opened_during, is_open),
+        "opened_during_and_closed_during": both(
+            not_fp, opened_during, closed_before_end
+        ),
+        "opened_during_and_closed_after": both(not_fp, opened_during, closed_after),
+        "fp_before": both(fp, opened_before),
+        "fp_during": both(fp, opened_during),
+        "fp_after": both(fp, opened_after),
+    }
+    count_group = {"_id": "$details.severity"}
+    for bucket, condition in bucket_conditions.items():
+        count_group[bucket] = {"$sum": {"$cond": [condition, 1, 0]}}
+
+    # tickets counted in the vulnerability buckets, false positive or not
+    vulnerable_host_match = {
+        "$or": [
+            {"time_opened": {"$lt": FY_START}, "open": True},
             {
-                "source": "nessus",
-                "false_positive": False,
                 "time_opened": {"$lt": FY_START},
                 "time_closed": {"$gte": FY_START, "$lt": FY_END},
-            }
-        ).count()
-        opened_during_and_still_open = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": False,
-                "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                "open": True,
-            }
-        ).count()
-        opened_during_and_closed_during = db.TicketDoc.find(
+            },
+            {"time_opened": {"$gte": FY_START, "$lt": FY_END}, "open": True},
             {
-                "source": "nessus",
-                "false_positive": False,
                 "time_opened": {"$gte": FY_START, "$lt": FY_END},
                 "time_closed": {"$lt": FY_END},
-            }
-        ).count()
-        opened_during_and_closed_after = db.TicketDoc.find(
+            },
             {
-                "source": "nessus",
-                "false_positive": False,
                 "time_opened": {"$gte": FY_START, "$lt": FY_END},
                 "time_closed": {"$gte": FY_END},
-            }
-        ).count()
-        fp_before = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": True,
-                "time_opened": {"$lt": FY_START},
-            }
-        ).count()
-        fp_during = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": True,
-                "time_opened": {"$gte": FY_START, "$lt": FY_END},
-            }
-        ).count()
-        fp_after = db.TicketDoc.find(
+            },
+        ]
+    }
+    facets = {
+        "counts": [{"$group": count_group}],
+        "hosts": [
+            {"$match": vulnerable_host_match},
             {
-                "source": "nessus",
-                "false_positive": True,
-                "time_opened": {"$gte": FY_END},
-            }
-        ).count()
-
-        vulnerable_host_count = len(
-            db.TicketDoc.find(
-                {
-                    "source": "nessus",
-                    "$or": [
-                        {"time_opened": {"$lt": FY_START}, "open": True},
-                        {
-                            "time_opened": {"$lt": FY_START},
-                            "time_closed": {"$gte": FY_START, "$lt": FY_END},
-                        },
-                        {
-                            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                            "open": True,
-                        },
-                        {
-                            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                            "time_closed": {"$lt": FY_END},
-                        },
-                        {
-                            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                            "time_closed": {"$gte": FY_END},
-                        },
-                    ],
+                "$group": {
+                    "_id": {"severity": "$details.severity", "ip_int": "$ip_int"}
                 }
-            ).distinct("ip_int")
-        )
-    else:
-        opened_before_and_still_open = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": False,
-                "time_opened": {"$lt": FY_START},
-                "open": True,
-                "details.severity": severity,
-            }
-        ).count()
-        opened_before_and_closed_during = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": False,
-                "time_opened": {"$lt": FY_START},
-                "time_closed": {"$gte": FY_START, "$lt": FY_END},
-                "details.severity": severity,
-            }
-        ).count()
-        opened_during_and_still_open = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": False,
-                "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                "open": True,
-                "details.severity": severity,
-            }
-        ).count()
-        opened_during_and_closed_during = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": False,
-                "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                "time_closed": {"$lt": FY_END},
-                "details.severity": severity,
-            }
-        ).count()
-        opened_during_and_closed_after = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": False,
-                "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                "time_closed": {"$gte": FY_END},
-                "details.severity": severity,
-            }
-        ).count()
-        fp_before = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": True,
-                "time_opened": {"$lt": FY_START},
-                "details.severity": severity,
-            }
-        ).count()
-        fp_during = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": True,
-                "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                "details.severity": severity,
-            }
-        ).count()
-        fp_after = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "false_positive": True,
-                "time_opened": {"$gte": FY_END},
-                "details.severity": severity,
-            }
-        ).count()
+            },
+            {"$group": {"_id": "$_id.severity", "count": {"$sum": 1}}},
+        ],
+    }
+    if 0 in severities:
+        facets["all_hosts"] = [
+            {"$match": vulnerable_host_match},
+            {"$group": {"_id": "$ip_int"}},
+            {"$count": "count"},
+        ]
 
-        vulnerable_host_count = len(
-            db.TicketDoc.find(
-                {
-                    "source": "nessus",
-                    "$or": [
-                        {
-                            "time_opened": {"$lt": FY_START},
-                            "open": True,
-                            "details.severity": severity,
-                        },
-                        {
-                            "time_opened": {"$lt": FY_START},
-                            "time_closed": {"$gte": FY_START, "$lt": FY_END},
-                            "details.severity": severity,
-                        },
-                        {
-                            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                            "open": True,
-                            "details.severity": severity,
-                        },
-                        {
-                            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                            "time_closed": {"$lt": FY_END},
-                            "details.severity": severity,
-                        },
-                        {
-                            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-                            "time_closed": {"$gte": FY_END},
-                            "details.severity": severity,
-                        },
-                    ],
-                }
-            ).distinct("ip_int")
+    # skip tickets that were closed before FY_START and can't be in any bucket
+    match = {
+        "source": "nessus",
+        "$or": [
+            {"time_opened": {"$gte": FY_START}},
+            {"open": True},
+            {"time_closed": {"$gte": FY_START}},
+            {"false_positive": True},
+        ],
+    }
+    if 0 not in severities:
+        match["details.severity"] = {"$in": severities}
+    pipeline = [{"$match": match}, {"$facet": facets}]
+    result = list(
+        db.TicketDoc.collection.aggregate(pipeline, allowDiskUse=True, cursor={})
+    )[0]
+
+    counts_by_severity = dict((x["_id"], x) for x in result["counts"])
+    hosts_by_severity = dict((x["_id"], x["count"]) for x in result["hosts"])
+    output = dict()
+    for severity in severities:
+        if severity == 0:
+            counts = dict(
+                (bucket, sum(x[bucket] for x in counts_by_severity.values()))
+                for bucket in VULN_TICKET_BUCKETS
+            )
+            all_hosts = result.get("all_hosts")
+            vulnerable_host_count = all_hosts[0]["count"] if all_hosts else 0
+        else:
+            counts = counts_by_severity.get(severity, {})
+            vulnerable_host_count = hosts_by_severity.get(severity, 0)
+        output[severity] = format_vuln_ticket_counts(
+            severity, counts, vulnerable_host_count
         )
+    return output
+
+
+def vuln_ticket_counts(FY_START, FY_END, db, severity=0):
+    return vuln_ticket_counts_by_severity(FY_START, FY_END, db, [severity])[severity]
 
-    sev_level = ""
-    if severity == 1:
-        sev_level = "Low "
-    elif severity == 2:
-        sev_level = "Medium "
-    elif severity == 3:
-        sev_level = "High "
-    elif severity == 4:
-        sev_level = "Critical "
+
+def vuln_ticket_counts_list(FY_START, FY_END, db, severities):
+    """Returns the vuln_ticket_counts() output of each of severities, in
+    order."""
+    output = vuln_ticket_counts_by_severity(FY_START, FY_END, db, severities)
+    return [output[severity] for severity in severities]
+
+
+def format_vuln_ticket_counts(severity, counts, vulnerable_host_count):
+    # TODO: Modify print statements to use format() named parameters
+    opened_before_and_still_open = counts.get("opened_before_and_still_open", 0)
+    opened_before_and_closed_during = counts.get("opened_before_and_closed_during", 0)
+    opened_during_and_still_open = counts.get("opened_during_and_still_open", 0)
+    opened_during_and_closed_during = counts.get("opened_during_and_closed_during", 0)
+    opened_during_and_closed_after = counts.get("opened_during_and_closed_after", 0)
+    fp_before = counts.get("fp_before", 0)
+    fp_during = counts.get("fp_during", 0)
+    fp_after = counts.get("fp_after", 0)
+
+    sev_level = VULN_TICKET_SEVERITY_LEVELS.get(severity, "")
 
     output = {"severity_level": sev_level}
     output["opened_before_and_still_open"] = "{:,d}".format(
@@ -801,52 +751,44 @@ Notes: None
     # +* This is the count of 'active hosts' (with at least one port open), at the time the report is generated.
     # +---""")
 
-    total_vuln_hosts = db.TicketDoc.find(
-        {
-            "source": "nessus",
-            "false_positive": False,
-            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-        }
-    ).distinct("ip_int")
-    fed_vuln_hosts = db.TicketDoc.find(
-        {
-            "source": "nessus",
-            "false_positive": False,
-            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-            "owner": {"$in": ALL_ORGS_BY_TYPE[AGENCY_TYPE.FEDERAL]},
-        }
-    ).distinct("ip_int")
-    sltt_vuln_hosts = db.TicketDoc.find(
-        {
-            "source": "nessus",
-            "false_positive": False,
-            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-            "owner": {"$in": ALL_ORGS_BY_TYPE["SLTT"]},
-        }
-    ).distinct("ip_int")
-    private_vuln_hosts = db.TicketDoc.find(
-        {
-            "source": "nessus",
-            "false_positive": False,
-            "time_opened": {"$gte": FY_START, "$lt": FY_END},
-            "owner": {"$in": ALL_ORGS_BY_TYPE[AGENCY_TYPE.PRIVATE]},
-        }
-    ).distinct("ip_int")
+    vuln_hosts_query = {
+        "source": "nessus",
+        "false_positive": False,
+        "time_opened": {"$gte": FY_START, "$lt": FY_END},
+    }
+    total_vuln_hosts = count_distinct(
+        db.TicketDoc.collection, "ip_int", vuln_hosts_query
+    )
+    fed_vuln_hosts = count_distinct(
+        db.TicketDoc.collection,
+        "ip_int",
+        dict(vuln_hosts_query, owner={"$in": ALL_ORGS_BY_TYPE[AGENCY_TYPE.FEDERAL]}),
+    )
+    sltt_vuln_hosts = count_distinct(
+        db.TicketDoc.collection,
+        "ip_int",
+        dict(vuln_hosts_query, owner={"$in": ALL_ORGS_BY_TYPE["SLTT"]}),
+    )
+    private_vuln_hosts = count_distinct(
+        db.TicketDoc.collection,
+        "ip_int",
+        dict(vuln_hosts_query, owner={"$in": ALL_ORGS_BY_TYPE[AGENCY_TYPE.PRIVATE]}),
+    )
 
     if total_vuln_hosts > 0:
         output["fed_vuln_hosts_pct"] = round(
-            (float(len(fed_vuln_hosts)) / len(total_vuln_hosts)) * 100, 1
+            (float(fed_vuln_hosts) / total_vuln_hosts) * 100, 1
         )
         output["sltt_vuln_hosts_pct"] = round(
-            (float(len(sltt_vuln_hosts)) / len(total_vuln_hosts)) * 100, 1
+            (float(sltt_vuln_hosts) / total_vuln_hosts) * 100, 1
         )
         output["private_vuln_hosts_pct"] = round(
-            (float(len(private_vuln_hosts)) / len(total_vuln_hosts)) * 100, 1
+            (float(private_vuln_hosts) / total_vuln_hosts) * 100, 1
         )
-    output["total_vuln_hosts"] = "{:,d}".format(len(total_vuln_hosts))
-    output["fed_vuln_hosts"] = "{:,d}".format(len(fed_vuln_hosts))
-    output["sltt_vuln_hosts"] = "{:,d}".format(len(sltt_vuln_hosts))
-    output["private_vuln_hosts"] = "{:,d}".format(len(private_vuln_hosts))
+    output["total_vuln_hosts"] = "{:,d}".format(total_vuln_hosts)
+    output["fed_vuln_hosts"] = "{:,d}".format(fed_vuln_hosts)
+    output["sltt_vuln_hosts"] = "{:,d}".format(sltt_vuln_hosts)
+    output["private_vuln_hosts"] = "{:,d}".format(private_vuln_hosts)
     output[
         "description4"
     ] = """---
@@ -1686,9 +1628,8 @@ def print_new_vuln_detections(FY_START, FY_END, obj):
 def categorize_orgs(db):
     global ALL_ORGS_BY_TYPE, ALL_STAKEHOLDERS_BY_TYPE
 
-    ALL_ORGS_BY_TYPE = db.RequestDoc.get_owner_types(
-        as_lists=True, stakeholders_only=False
-    )
+    org_index = get_org_index(db)
+    ALL_ORGS_BY_TYPE = org_index.get_owner_types(as_lists=True, stakeholders_only=False)
     ALL_ORGS_BY_TYPE["SLTT"] = (
         ALL_ORGS_BY_TYPE[AGENCY_TYPE.STATE]
         + ALL_ORGS_BY_TYPE[AGENCY_TYPE.LOCAL]
@@ -1696,7 +1637,7 @@ def categorize_orgs(db):
         + ALL_ORGS_BY_TYPE[AGENCY_TYPE.TERRITORIAL]
     )
 
-    ALL_STAKEHOLDERS_BY_TYPE = db.RequestDoc.get_owner_types(
+    ALL_STAKEHOLDERS_BY_TYPE = org_index.get_owner_types(
         as_lists=True, stakeholders_only=True
     )
     ALL_STAKEHOLDERS_BY_TYPE["ALL"] = list()
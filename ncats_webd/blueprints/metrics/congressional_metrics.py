@@ -25,7 +25,12 @@ from cyhy.core.common import AGENCY_TYPE
 from cyhy.db import database
 from cyhy.util import util
 from collections import defaultdict
-from pandas import DataFrame, isnull
+from pandas import isnull
+
+from ncats_webd.frames import Column, load_frame
+from ncats_webd.org_index import get_org_index
+
+SEVERITY_COLUMN = Column("severity", "int8", missing=0)
 
 
 def tickets_opened_count_pl(org_list, start_date, end_date):
@@ -184,9 +189,12 @@ def closed_in_date_range_closed_ticket_age_pl(org_list, start_date, end_date):
 #            ], database.TICKET_COLLECTION
 
 
-def run_pipeline((pipeline, collection), db):
-    results = db[collection].aggregate(
-        pipeline, allowDiskUse=True, explain=True, cursor={}
+def explain_pipeline((pipeline, collection), db):
+    """Returns how the server would run the (pipeline, collection) of one of
+    the *_pl functions: the plans and indexes it would use."""
+    # aggregate(explain=True) drops the explain output, which isn't a cursor
+    return db.command(
+        "aggregate", collection, pipeline=pipeline, allowDiskUse=True, explain=True
     )
 
 
@@ -200,9 +208,8 @@ def congressional_data(db, start_date, end_date):
     # start_date = parser.parse(start_date)
     # end_date = parser.parse(end_date)
 
-    all_stakeholders = db.RequestDoc.get_owner_types(
-        as_lists=True, stakeholders_only=True
-    )
+    org_index = get_org_index(db)
+    all_stakeholders = org_index.get_owner_types(as_lists=True, stakeholders_only=True)
 
     active_fed_stakeholders = db.ReportDoc.find(
         {
@@ -214,9 +221,9 @@ def congressional_data(db, start_date, end_date):
     active_fed_owners = list()
     for org in active_fed_stakeholders:
         active_fed_owners.append(org)
-        active_fed_owners += db.RequestDoc.get_all_descendants(org)
+        active_fed_owners += org_index.get_all_descendants(org)
 
-    fed_executive_stakeholders = db.RequestDoc.get_by_owner("EXECUTIVE")["children"]
+    fed_executive_stakeholders = org_index.get_children("EXECUTIVE")
     active_fed_executive_stakeholders = db.ReportDoc.find(
         {
             "owner": {"$in": fed_executive_stakeholders},
@@ -227,9 +234,9 @@ def congressional_data(db, start_date, end_date):
     active_fed_executive_owners = list()
     for org in active_fed_executive_stakeholders:
         active_fed_executive_owners.append(org)
-        active_fed_executive_owners += db.RequestDoc.get_all_descendants(org)
+        active_fed_executive_owners += org_index.get_all_descendants(org)
 
-    fed_cfo_stakeholders = db.RequestDoc.get_by_owner("FED_CFO_ACT")["children"]
+    fed_cfo_stakeholders = org_index.get_children("FED_CFO_ACT")
     active_fed_cfo_stakeholders = db.ReportDoc.find(
         {
             "owner": {"$in": fed_cfo_stakeholders},
@@ -240,7 +247,7 @@ def congressional_data(db, start_date, end_date):
     active_fed_cfo_owners = list()
     for org in active_fed_cfo_stakeholders:
         active_fed_cfo_owners.append(org)
-        active_fed_cfo_owners += db.RequestDoc.get_all_descendants(org)
+        active_fed_cfo_owners += org_index.get_all_descendants(org)
 
     fed_exec_non_cfo_stakeholders = list(
         set(fed_executive_stakeholders) - set(fed_cfo_stakeholders)
@@ -255,7 +262,7 @@ def congressional_data(db, start_date, end_date):
     active_fed_exec_non_cfo_owners = list()
     for org in active_fed_exec_non_cfo_stakeholders:
         active_fed_exec_non_cfo_owners.append(org)
-        active_fed_exec_non_cfo_owners += db.RequestDoc.get_all_descendants(org)
+        active_fed_exec_non_cfo_owners += org_index.get_all_descendants(org)
 
     SLTT_stakeholders = (
         all_stakeholders[AGENCY_TYPE.STATE]
@@ -273,7 +280,7 @@ def congressional_data(db, start_date, end_date):
     # active_SLTT_owners = list()
     # for org in active_SLTT_stakeholders:
     #     active_SLTT_owners.append(org)
-    #     active_SLTT_owners += db.RequestDoc.get_all_descendants(org)
+    #     active_SLTT_owners += org_index.get_all_descendants(org)
 
     active_private_stakeholders = db.ReportDoc.find(
         {
@@ -285,7 +292,7 @@ def congressional_data(db, start_date, end_date):
     # active_private_owners = list()
     # for org in active_private_stakeholders:
     #     active_private_owners.append(org)
-    #     active_private_owners += db.RequestDoc.get_all_descendants(org)
+    #     active_private_owners += org_index.get_all_descendants(org)
 
     print "Congressional Cyber Hygiene Metrics Report"
     mylist = {}
@@ -308,7 +315,7 @@ def congressional_data(db, start_date, end_date):
             stakeholder_list, start_date, end_date
         )
         output = db[collection].aggregate(pipeline, cursor={})
-        df = DataFrame(list(output))
+        df = load_frame(output, [SEVERITY_COLUMN, Column("duration_to_close", "float64")])
         median_days_to_mitigate_criticals = round(
             df.loc[df["severity"] == 4]["duration_to_close"].median()
             / (24 * 60 * 60 * 1000.0)
@@ -335,7 +342,9 @@ def congressional_data(db, start_date, end_date):
             stakeholder_list, start_date, end_date
         )
         output = db[collection].aggregate(pipeline, cursor={})
-        df = DataFrame(list(output))
+        df = load_frame(
+            output, [SEVERITY_COLUMN, Column("open_ticket_duration", "float64")]
+        )
         median_days_active_criticals = round(
             df.loc[df["severity"] == 4]["open_ticket_duration"].median()
             / (24 * 60 * 60 * 1000.0)
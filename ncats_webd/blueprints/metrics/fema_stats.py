@@ -22,19 +22,22 @@ from dateutil import parser
 from cyhy.util import util
 import StringIO
 
+from ncats_webd.org_index import get_org_index
+
 
 def build_customer_sector_map(db):
     customer_sector_map = dict()
-    CI_parent_node = db.RequestDoc.find_one({"_id": "CRITICAL_INFRASTRUCTURE"})
-    if CI_parent_node:
-        for CI_sector in CI_parent_node.get("children"):
-            for CI_org in db.RequestDoc.get_all_descendants(CI_sector):
+    org_index = get_org_index(db)
+    CI_sectors = org_index.get_children("CRITICAL_INFRASTRUCTURE")
+    if CI_sectors:
+        for CI_sector in CI_sectors:
+            for CI_org in org_index.get_all_descendants(CI_sector):
                 customer_sector_map[CI_org] = CI_sector
     else:
         print "WARNING: No CRITICAL_INFRASTRUCTURE request document found in DB!"
 
     for org_type in ("PRIVATE", "STATE", "LOCAL", "TRIBAL", "TERRITORIAL"):
-        for org in db.RequestDoc.get_all_descendants(org_type):
+        for org in org_index.get_all_descendants(org_type):
             if not customer_sector_map.get(org):
                 customer_sector_map[org] = org_type
 
@@ -1,5 +1,9 @@
 import sys
 import json
+import traceback
+
+import gevent
+from gevent.pool import Pool
 
 from flask import (
     Blueprint,
@@ -12,7 +16,8 @@ from flask import (
     Response,
 )
 from cyhy.util import util
-from ncats_webd.common import cache
+from ncats_webd.common import cache, process_pool
+from ncats_webd.offload import DB
 from dateutil import parser
 
 import FYcalcs
@@ -26,6 +31,22 @@ bp = Blueprint(
     BLUEPRINT_NAME, __name__, template_folder="templates", static_folder="static"
 )
 
+POOL_SIZE = 4  # metrics calculated at the same time for a single request
+TASK_TIMEOUT = 300  # seconds before a metric calculation is abandoned
+RESULT_NAMES = [
+    "VULN_TICKET",
+    "TOP_VULNS",
+    "TOP_OS",
+    "TOPVULNSERV",
+    "TOPSERV",
+    "NUMORGS",
+    "NUMADDRHOSTS",
+    "NUMREPORTS",
+    "AVGCVSS",
+    "UVULNS",
+    "NVULNDET",
+]
+
 ###############################################################################
 #  Data Access
 ###############################################################################
@@ -81,7 +102,46 @@ def fema_download():
 
 @cache.memoize(timeout=300)
 def congressional_metrics_pull(db, start_date, end_date):
-    return congressional_metrics.congressional_data(db, start_date, end_date)
+    return process_pool.run(
+        congressional_metrics.congressional_data, DB, start_date, end_date
+    )
+
+
+###############################################################################
+#  Utils
+###############################################################################
+
+
+def run_concurrently(tasks, pool_size=POOL_SIZE, timeout=TASK_TIMEOUT):
+    """Run the (name, function, args) tasks in a bounded gevent pool within
+    the current app context.
+
+    Returns a dict of name to result for the tasks that finished and a dict of
+    name to error message for the ones that failed or ran longer than timeout
+    seconds.
+    """
+    app = current_app._get_current_object()
+    finished = dict()
+    errors = dict()
+
+    def run(name, function, args):
+        with app.app_context():
+            try:
+                with gevent.Timeout(timeout):
+                    finished[name] = function(*args)
+            except gevent.Timeout:
+                errors[name] = "timed out after {!s} seconds".format(timeout)
+            except Exception as e:
+                app.logger.error(
+                    "%s failed:\n%s" % (function.__name__, traceback.format_exc())
+                )
+                errors[name] = str(e)
+
+    pool = Pool(pool_size)
+    for name, function, args in tasks:
+        pool.spawn(run, name, function, args)
+    pool.join()
+    return finished, errors
 
 
 ###############################################################################
@@ -158,98 +218,107 @@ def query_results():
             flash("Unsuccessful query. Check date format\n")
             return redirect(url_for(BLUEPRINT_NAME + ".root"))
 
-    # all vars are none
-    vuln_t_c = (
-        top_vul
-    ) = (
-        topOS
-    ) = (
-        topVulnServ
-    ) = (
-        topServ
-    ) = numOrgs = numAddrHostsScanned = numReports = avg_cvss = uVulns = nVulnDet = None
     # grab current FED SLTT PRIVATE from other main
     FYcalcs.categorize_orgs(current_app.db)
 
-    # call for relevant info
-    if request.form.get("vuln_ticket_count"):
-        vuln_t_c = FYcalcs.vuln_ticket_counts(
-            FY_START, FY_END, current_app.db, int(request.form.get("vuln_ticket_count"))
+    # queue up the relevant calcs
+    tasks = []
+    # any number of severities, counted in one pass over the tickets
+    severities = sorted(
+        set(
+            int(severity)
+            for severity in request.form.getlist("vuln_ticket_count")
+            if severity
+        )
+    )
+    if severities:
+        tasks.append(
+            (
+                "VULN_TICKET",
+                FYcalcs.vuln_ticket_counts_list,
+                (FY_START, FY_END, current_app.db, severities),
+            )
         )
 
     if request.form.get("top_vulns"):
-        top_vul = FYcalcs.top_vulns(
-            FY_START, FY_END, current_app.db, int(request.form.get("top_vulns"))
+        tasks.append(
+            (
+                "TOP_VULNS",
+                FYcalcs.top_vulns,
+                (FY_START, FY_END, current_app.db, int(request.form.get("top_vulns"))),
+            )
         )
 
     if request.form.get("top_OS"):
-        # topOS = FYcalcs.top_OS(FY_START, FY_END, current_app.db)
-        topOS = top_OS(FY_START, FY_END, current_app.db)
+        tasks.append(("TOP_OS", top_OS, (FY_START, FY_END, current_app.db)))
 
     if request.form.get("top_vuln_services"):
-        topVulnServ = FYcalcs.top_vuln_services(FY_START, FY_END, current_app.db)
+        tasks.append(
+            (
+                "TOPVULNSERV",
+                FYcalcs.top_vuln_services,
+                (FY_START, FY_END, current_app.db),
+            )
+        )
 
     if request.form.get("top_services"):
-        # topServ = FYcalcs.top_services(FY_START, FY_END, current_app.db)
-        topServ = top_services(FY_START, FY_END, current_app.db)
+        tasks.append(("TOPSERV", top_services, (FY_START, FY_END, current_app.db)))
 
     if request.form.get("num_orgs_scanned"):
-        numOrgs = FYcalcs.num_orgs_scanned(FY_START, FY_END, current_app.db)
+        tasks.append(
+            ("NUMORGS", FYcalcs.num_orgs_scanned, (FY_START, FY_END, current_app.db))
+        )
 
     if request.form.get("num_addresses_hosts_scanned"):
-        # numAddrHostsScanned = FYcalcs.num_addresses_hosts_scanned(FY_START, FY_END, current_app.db)
-        numAddrHostsScanned = num_addresses_hosts_scanned(
-            FY_START, FY_END, current_app.db
+        tasks.append(
+            (
+                "NUMADDRHOSTS",
+                num_addresses_hosts_scanned,
+                (FY_START, FY_END, current_app.db),
+            )
         )
 
     if request.form.get("num_reports_generated"):
-        numReports = FYcalcs.num_reports_generated(FY_START, FY_END, current_app.db)
+        tasks.append(
+            (
+                "NUMREPORTS",
+                FYcalcs.num_reports_generated,
+                (FY_START, FY_END, current_app.db),
+            )
+        )
 
     if request.form.get("avg_cvss_score"):
-        avg_cvss = FYcalcs.avg_cvss_score(FY_START, FY_END, current_app.db)
+        tasks.append(
+            ("AVGCVSS", FYcalcs.avg_cvss_score, (FY_START, FY_END, current_app.db))
+        )
 
     if request.form.get("unique_vulns"):
-        uVulns = FYcalcs.unique_vulns(FY_START, FY_END, current_app.db)
+        tasks.append(
+            ("UVULNS", FYcalcs.unique_vulns, (FY_START, FY_END, current_app.db))
+        )
 
     if request.form.get("new_vuln_detections"):
-        nVulnDet = FYcalcs.new_vuln_detections(FY_START, FY_END, current_app.db)
+        tasks.append(
+            (
+                "NVULNDET",
+                FYcalcs.new_vuln_detections,
+                (FY_START, FY_END, current_app.db),
+            )
+        )
+
+    # all results are none unless their calc was requested and finished
+    results = dict((name, None) for name in RESULT_NAMES)
+    finished, errors = run_concurrently(tasks)
+    results.update(finished)
 
     if request.args.has_key("j"):
+        results["START"] = FY_START
+        results["END"] = FY_END
         return json.dumps(
-            {
-                "success": True,
-                "results": {
-                    "START": FY_START,
-                    "END": FY_END,
-                    "VULN_TICKET": vuln_t_c,
-                    "TOP_VULNS": top_vul,
-                    "TOP_OS": topOS,
-                    "TOPVULNSERV": topVulnServ,
-                    "TOPSERV": topServ,
-                    "NUMORGS": numOrgs,
-                    "NUMADDRHOSTS": numAddrHostsScanned,
-                    "NUMREPORTS": numReports,
-                    "AVGCVSS": avg_cvss,
-                    "UVULNS": uVulns,
-                    "NVULNDET": nVulnDet,
-                },
-            },
+            {"success": True, "results": results, "errors": errors},
             default=util.custom_json_handler,
         )
     else:
-        return render_template(
-            "results.html",
-            START=FY_START,
-            END=FY_END,
-            VULN_TICKET=vuln_t_c,
-            TOP_VULNS=top_vul,
-            TOP_OS=topOS,
-            TOPVULNSERV=topVulnServ,
-            TOPSERV=topServ,
-            NUMORGS=numOrgs,
-            NUMADDRHOSTS=numAddrHostsScanned,
-            NUMREPORTS=numReports,
-            AVGCVSS=avg_cvss,
-            UVULNS=uVulns,
-            NVULNDET=nVulnDet,
-        )
+        for name, error in sorted(errors.items()):
+            flash("{!s} could not be calculated: {!s}".format(name, error))
+        return render_template("results.html", START=FY_START, END=FY_END, **results)
@@ -15,39 +15,24 @@ import os
 from docopt import docopt
 import netaddr
 import datetime
+from collections import defaultdict
 from cyhy.db import database
 from cyhy.util import util
 from cyhy.core.common import AGENCY_TYPE, REPORT_TYPE
-from dateutil.relativedelta import relativedelta
+
+from ncats_webd.org_index import get_org_index
 
 
 def get_owner_types_ci(db, as_lists=False, stakeholders_only=False):
     """returns a dict of types to owners.  The owners can be in a set or list depending on "as_lists" parameter.
        "stakeholders_only" parameter eliminates non-stakeholders from the dict."""
-    types = dict()
-    CI_CHILDREN = db.RequestDoc.find_one({"_id": "CRITICAL_INFRASTRUCTURE"})["children"]
-    for agency_type in CI_CHILDREN:
-        types[agency_type] = set()
-        all_agency_type_descendants = db.RequestDoc.get_all_descendants(agency_type)
-        if stakeholders_only:
-            for org in db.RequestDoc.find(
-                {"_id": {"$in": all_agency_type_descendants}}
-            ):
-                if org["stakeholder"]:
-                    types[agency_type].add(org["_id"])
-        else:
-            types[agency_type] = set(all_agency_type_descendants)
-    # convert to a dict of lists
-    if not as_lists:
-        return types
-    result = dict()
-    for k, v in types.items():
-        result[k] = list(v)
-    return result
+    return get_org_index(db).get_ci_sectors(
+        as_lists=as_lists, stakeholders_only=stakeholders_only
+    )
 
 
 def scanning_breakdown(db):
-    all_stakeholders_by_type = db.RequestDoc.get_owner_types(
+    all_stakeholders_by_type = get_org_index(db).get_owner_types(
         as_lists=True, stakeholders_only=True
     )
     fed = len(all_stakeholders_by_type["FEDERAL"])
@@ -117,90 +102,100 @@ def scanning_breakdown(db):
     return stakeholders_scanned
 
 
-def ticket_counts_by_fiscal_year(db, current_fy_start):
-    fy_ticket_counts_by_year = dict()
-    fy_ticket_count_totals = {"opened": 0, "closed": 0}
-
-    while True:
-        next_fy_start = current_fy_start + relativedelta(years=1)
-        # Tickets opened during the fiscal year
-        tix_opened = db.TicketDoc.find(
+def fiscal_year_expression(field, fy_start):
+    """Returns an aggregation expression for the fiscal year (named, like
+    ticket_counts_by_fiscal_year() does, by the calendar year it ends in) of
+    the date in field, or null when it is unset.  fy_start is the start of
+    any fiscal year."""
+    fy_start_day = fy_start.month * 100 + fy_start.day
+    return {
+        "$cond": [
+            {"$gt": [field, None]},
             {
-                "source": "nessus",
-                "time_opened": {"$gte": current_fy_start, "$lt": next_fy_start},
-                "false_positive": False,
-            }
-        ).count()
-        # Tickets open at any point during the fiscal year
-        open_tix = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "$or": [
+                "$add": [
+                    {"$year": field},
                     {
-                        "$and": [
+                        "$cond": [
                             {
-                                "time_opened": {
-                                    "$gte": current_fy_start,
-                                    "$lt": next_fy_start,
-                                }
+                                "$gte": [
+                                    {
+                                        "$add": [
+                                            {"$multiply": [{"$month": field}, 100]},
+                                            {"$dayOfMonth": field},
+                                        ]
+                                    },
+                                    fy_start_day,
+                                ]
                             },
-                            {"false_positive": False},
-                        ]
-                    },
-                    {
-                        "$and": [
-                            {
-                                "time_closed": {
-                                    "$gte": current_fy_start,
-                                    "$lt": next_fy_start,
-                                }
-                            },
-                            {"false_positive": False},
-                        ]
-                    },
-                    {
-                        "$and": [
-                            {"time_opened": {"$lt": current_fy_start}},
-                            {"open": True},
-                            {"false_positive": False},
+                            1,
+                            0,
                         ]
                     },
-                    {
-                        "$and": [
-                            {"time_opened": {"$lt": current_fy_start}},
-                            {"open": False},
-                            {"time_closed": {"$gte": next_fy_start}},
-                            {"false_positive": False},
-                        ]
-                    },
-                ],
-            }
-        ).count()
-        # Tickets closed during the fiscal year
-        tix_closed = db.TicketDoc.find(
-            {
-                "source": "nessus",
-                "time_closed": {"$gte": current_fy_start, "$lt": next_fy_start},
-                "false_positive": False,
-            }
-        ).count()
-
-        if tix_opened > 0:
-            current_fiscal_year = str(current_fy_start.year + 1)
-            fy_ticket_counts_by_year[current_fiscal_year] = dict()
-
-            fy_ticket_counts_by_year[current_fiscal_year]["opened"] = tix_opened
-            fy_ticket_count_totals["opened"] += tix_opened
+                ]
+            },
+            None,
+        ]
+    }
 
-            fy_ticket_counts_by_year[current_fiscal_year]["open"] = open_tix
 
-            fy_ticket_counts_by_year[current_fiscal_year]["closed"] = tix_closed
-            fy_ticket_count_totals["closed"] += tix_closed
+def ticket_counts_by_fiscal_year(db, current_fy_start):
+    """Returns the tickets opened, open at any point and closed during each
+    fiscal year, going back from the current one to the last with tickets
+    opened in it, and the totals opened and closed over those years."""
+    pipeline = [
+        {"$match": {"source": "nessus", "false_positive": False}},
+        {
+            "$group": {
+                "_id": {
+                    "opened": fiscal_year_expression("$time_opened", current_fy_start),
+                    "closed": fiscal_year_expression("$time_closed", current_fy_start),
+                    "open": "$open",
+                },
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    opened_by_year = defaultdict(int)
+    closed_by_year = defaultdict(int)
+    # Change in the number of open tickets at the start of each fiscal year
+    open_changes = defaultdict(int)
+    for bucket in db.TicketDoc.collection.aggregate(
+        pipeline, allowDiskUse=True, cursor={}
+    ):
+        opened = bucket["_id"].get("opened")
+        closed = bucket["_id"].get("closed")
+        count = bucket["count"]
+        if closed is not None:
+            closed_by_year[closed] += count
+        if opened is None:
+            continue
+        opened_by_year[opened] += count
+        open_changes[opened] += count
+        if not bucket["_id"].get("open"):
+            # Open from the year it was opened through the year it was closed
+            open_changes[(opened if closed is None else closed) + 1] -= count
+
+    current_fiscal_year = current_fy_start.year + 1
+    open_by_year = dict()
+    open_tix = 0
+    for fiscal_year in xrange(min(open_changes or [0]), current_fiscal_year + 1):
+        open_tix += open_changes[fiscal_year]
+        open_by_year[fiscal_year] = open_tix
 
-            # Go back to the previous fiscal year and try again...
-            current_fy_start = current_fy_start - relativedelta(years=1)
-        else:
-            return fy_ticket_counts_by_year, fy_ticket_count_totals
+    fy_ticket_counts_by_year = dict()
+    fy_ticket_count_totals = {"opened": 0, "closed": 0}
+    fiscal_year = current_fiscal_year
+    while opened_by_year[fiscal_year] > 0:
+        fy_ticket_counts_by_year[str(fiscal_year)] = {
+            "opened": opened_by_year[fiscal_year],
+            "open": open_by_year[fiscal_year],
+            "closed": closed_by_year[fiscal_year],
+        }
+        fy_ticket_count_totals["opened"] += opened_by_year[fiscal_year]
+        fy_ticket_count_totals["closed"] += closed_by_year[fiscal_year]
+        # Go back to the previous fiscal year and try again...
+        fiscal_year -= 1
+    return fy_ticket_counts_by_year, fy_ticket_count_totals
 
 
 def all_time_opened_and_closed_breakdown(db):
@@ -566,7 +561,7 @@ def return_activity(db, orgs, title, start, end):
 
 
 def get_stats(db):
-    orgs = db.RequestDoc.get_owner_types(
+    orgs = get_org_index(db).get_owner_types(
         as_lists=True, stakeholders_only=False, include_retired=True
     )
     orgs["SLTT"] = (
@@ -16,7 +16,12 @@ import schedule
 from cyhy.util import util
 from cyhy.db import database
 from cyhy.core import STAGE, STATUS
-from ncats_webd.common import cache, socketio, catch_exceptions
+from ncats_webd.common import cache, socketio, process_pool, catch_exceptions
+from ncats_webd.refresh import refresh_ahead
+from ncats_webd.broadcast import Broadcaster
+from ncats_webd.offload import DB
+from ncats_webd.frames import DATETIME, Column, load_frame, projection, utc_timestamp
+from ncats_webd.leader import on_elected
 from ncats_webd.queries import DashboardQueries
 
 BLUEPRINT_NAME = "queues"
@@ -25,13 +30,17 @@ bp = Blueprint(
 )
 
 REFRESH_INTERVAL = 300
+# stage isn't categorical, or grouping on it would add the unused stage and
+# age pairs
+RUNNING_TIME_COLUMNS = [Column("stage"), Column("last_change", DATETIME)]
+queues_broadcaster = Broadcaster("queues_data_push", "queues")
 
 ###############################################################################
 #  Server side event generation
 ###############################################################################
 
 
-@bp.before_app_first_request
+@on_elected
 def schedule_broadcaster():
     current_app.logger.info("setting up %s broadcast schedule" % BLUEPRINT_NAME)
 
@@ -55,18 +64,17 @@ def schedule_broadcaster():
 ###############################################################################
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
-def json_get_running_times():
+def get_running_times(db):
     now = util.utcnow()  # .replace(tzinfo=None) # everything is implicitly UTC
 
-    running_times = current_app.db.HostDoc.find(
-        {"status": "RUNNING"}, {"_id": False, "last_change": True, "stage": True}
+    running_times = db.HostDoc.find(
+        {"status": "RUNNING"}, projection(RUNNING_TIME_COLUMNS)
     )
 
-    running_times = list(running_times)
-
-    df = DataFrame(running_times)
-    df["age"] = ((now - df["last_change"]) / np.timedelta64(1, "s")).astype(
+    df = load_frame(running_times, RUNNING_TIME_COLUMNS)
+    df["age"] = (
+        (utc_timestamp(now) - df["last_change"]) / np.timedelta64(1, "s")
+    ).astype(
         int
     )  # timedelta to seconds
     df["tally"] = 1
@@ -83,11 +91,16 @@ def json_get_running_times():
     results["PORTSCAN"] = list(df2.loc["PORTSCAN"]["tally"].astype(int))
     results["VULNSCAN"] = list(df2.loc["VULNSCAN"]["tally"].astype(int))
     # import IPython; IPython.embed() #<<< BREAKPOINT >>>
+    return results
 
+
+@refresh_ahead(REFRESH_INTERVAL)
+def json_get_running_times():
+    results = process_pool.run(get_running_times, DB)
     return json.dumps(results, default=util.custom_json_handler)
 
 
-@cache.memoize(timeout=REFRESH_INTERVAL)
+@refresh_ahead(REFRESH_INTERVAL)
 def json_get_tally_details():
     results = DashboardQueries.get_tally_details(current_app.db)
     # import IPython; IPython.embed() #<<< BREAKPOINT >>>
@@ -126,7 +139,7 @@ def tally_priorities():
 @socketio.on("queues_latest", namespace="/cyhy")
 def latest_queues():
     current_app.logger.info("client requested latest queues data")
-    emit("queues_data_push", {"data": json_get_tally_details()})
+    queues_broadcaster.resync({"data": json_get_tally_details()})
 
 
 ###############################################################################
@@ -136,9 +149,4 @@ def latest_queues():
 
 def broadcast_queue_update():
     current_app.logger.debug("broadcasting queue data")
-    data = json_get_tally_details()
-    data = {"data": data}
-    # Note: emit will json encode our object with json data.
-    # so we need to call JSON.parse on the json string
-    # to reconstitue the object client-side.
-    socketio.emit("queues_data_push", data, namespace="/cyhy", room="queues")
+    queues_broadcaster.publish({"data": json_get_tally_details()})
@@ -9,9 +9,9 @@
         console.log('disconnected (queues)');
     });
 
-    socket.on('queues_data_push', function(msg) {
+    subscribe_versioned(socket, 'queues_data_push', 'queues_latest', function(msg) {
         console.log('new queue data');
-        update_all_charts(JSON.parse(msg.data));
+        update_all_charts(msg.data);
     })
     
     function make_chart(chart_id, colors) {
@@ -24,6 +24,8 @@ from bson import ObjectId
 import csv
 import StringIO
 
+from ncats_webd.org_index import get_org_index
+
 
 def get_first_snapshot_times(db, owners):
     first_snapshot_time_by_owner = list(
@@ -52,16 +54,17 @@ def get_first_snapshot_times(db, owners):
 
 
 def write_stakeholders_csv(db):
-    org_types = db.RequestDoc.get_owner_to_type_dict(stakeholders_only=True)
+    org_index = get_org_index(db)
+    org_types = org_index.get_owner_to_type_dict(stakeholders_only=True)
     stakeholder_ids = org_types.keys()
     first_snapshot_time_dict = get_first_snapshot_times(db, stakeholder_ids)
 
-    all_CI_orgs = db.RequestDoc.get_all_descendants("CRITICAL_INFRASTRUCTURE")
-    all_ELECTION_orgs = db.RequestDoc.get_all_descendants("ELECTION")
+    all_CI_orgs = set(org_index.get_all_descendants("CRITICAL_INFRASTRUCTURE"))
+    all_ELECTION_orgs = set(org_index.get_all_descendants("ELECTION"))
 
     CI_sectors = dict()
-    for sector in db.RequestDoc.get_by_owner("CRITICAL_INFRASTRUCTURE")["children"]:
-        CI_sectors[sector] = db.RequestDoc.get_by_owner(sector)["children"]
+    for sector in org_index.get_children("CRITICAL_INFRASTRUCTURE"):
+        CI_sectors[sector] = org_index.get_children(sector)
 
     csvrow = []
     new_csvfile = StringIO.StringIO()
@@ -124,16 +127,17 @@ def write_stakeholders_csv(db):
 
 
 def write_stakeholders(db):
-    org_types = db.RequestDoc.get_owner_to_type_dict(stakeholders_only=True)
+    org_index = get_org_index(db)
+    org_types = org_index.get_owner_to_type_dict(stakeholders_only=True)
     stakeholder_ids = org_types.keys()
     first_snapshot_time_dict = get_first_snapshot_times(db, stakeholder_ids)
 
-    all_CI_orgs = db.RequestDoc.get_all_descendants("CRITICAL_INFRASTRUCTURE")
-    all_ELECTION_orgs = db.RequestDoc.get_all_descendants("ELECTION")
+    all_CI_orgs = set(org_index.get_all_descendants("CRITICAL_INFRASTRUCTURE"))
+    all_ELECTION_orgs = set(org_index.get_all_descendants("ELECTION"))
 
     CI_sectors = dict()
-    for sector in db.RequestDoc.get_by_owner("CRITICAL_INFRASTRUCTURE")["children"]:
-        CI_sectors[sector] = db.RequestDoc.get_by_owner(sector)["children"]
+    for sector in org_index.get_children("CRITICAL_INFRASTRUCTURE"):
+        CI_sectors[sector] = org_index.get_children(sector)
 
     stakeholder_list = []
     stakeholder_list.append(
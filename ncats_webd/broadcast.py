@@ -0,0 +1,136 @@
+"""Versioned socket.io broadcasts.
+
+The broadcast payloads are dicts of JSON strings, as returned by the
+json_get_* functions.  A Broadcaster decodes each payload and names its
+version with a hash of its content, so a payload that hasn't changed since
+the last broadcast isn't sent at all.  A changed payload is sent to the room
+as a JSON patch (RFC 6902) against the previous version, or whole when that
+is smaller.  Clients ask for a whole copy with the *_latest events when they
+connect or find they have missed a version; those are answered by resync().
+Versions only depend on content, so any process can answer them.
+
+static/js/broadcast.js has the client side.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+from flask_socketio import emit
+
+from ncats_webd.common import socketio
+from ncats_webd import perf
+
+NAMESPACE = "/cyhy"
+PATCH_SUFFIX = "_patch"
+COMPACT_SEPARATORS = (",", ":")
+
+
+def decode(payload):
+    """returns payload with each JSON string value decoded, keeping the order
+    of the keys (it matters to c3js)"""
+    return dict(
+        (key, json.loads(value, object_pairs_hook=OrderedDict))
+        for key, value in payload.items()
+    )
+
+
+def content_version(doc):
+    """returns a hash of the content of doc and the length of its encoding"""
+    canonical = json.dumps(doc, sort_keys=True, separators=COMPACT_SEPARATORS)
+    return hashlib.sha1(canonical).hexdigest(), len(canonical)
+
+
+def escape_token(token):
+    return unicode(token).replace(u"~", u"~0").replace(u"/", u"~1")
+
+
+def make_patch(old, new, path=u"", patch=None):
+    """returns a list of JSON patch operations that turn old into new"""
+    if patch is None:
+        patch = list()
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                patch.append({"op": "remove", "path": path + u"/" + escape_token(key)})
+        for key, value in new.items():
+            child_path = path + u"/" + escape_token(key)
+            if key in old:
+                make_patch(old[key], value, child_path, patch)
+            else:
+                patch.append({"op": "add", "path": child_path, "value": value})
+    elif isinstance(old, list) and isinstance(new, list):
+        common = min(len(old), len(new))
+        for i in range(common):
+            make_patch(old[i], new[i], u"%s/%d" % (path, i), patch)
+        # remove from the end so the earlier indexes stay valid
+        for i in range(len(old) - 1, common - 1, -1):
+            patch.append({"op": "remove", "path": u"%s/%d" % (path, i)})
+        for value in new[common:]:
+            patch.append({"op": "add", "path": path + u"/-", "value": value})
+    elif type(old) is not type(new) or old != new:
+        patch.append({"op": "replace", "path": path, "value": new})
+    return patch
+
+
+class Broadcaster(object):
+    """Sends the versions of one payload to the clients in a room.
+
+    Whole copies are sent as event with {"version", "payload"}, and patches
+    as event + "_patch" with {"base", "version", "patch"}.
+    """
+
+    def __init__(self, event, room):
+        self.event = event
+        self.room = room
+        self.version = None
+        self.doc = None
+        self.__lock = threading.Lock()
+
+    def publish(self, payload):
+        """Send payload to the room unless it is unchanged.  Returns True if
+        anything was sent."""
+        start = time.time()
+        doc = decode(payload)
+        version, size = content_version(doc)
+        with self.__lock:
+            if version == self.version:
+                perf.increment("ncats_webd_broadcast_skipped_total", event=self.event)
+                return False
+            base, previous = self.version, self.doc
+            self.version, self.doc = version, doc
+            if previous is not None:
+                patch = make_patch(previous, doc)
+                patch_size = len(json.dumps(patch, separators=COMPACT_SEPARATORS))
+                if patch_size < size:
+                    socketio.emit(
+                        self.event + PATCH_SUFFIX,
+                        {"base": base, "version": version, "patch": patch},
+                        namespace=NAMESPACE,
+                        room=self.room,
+                    )
+                    self.__observe(start, "patch", patch_size)
+                    return True
+            socketio.emit(
+                self.event,
+                {"version": version, "payload": doc},
+                namespace=NAMESPACE,
+                room=self.room,
+            )
+            self.__observe(start, "full", size)
+            return True
+
+    def __observe(self, start, kind, size):
+        perf.observe(
+            "ncats_webd_broadcast_seconds", time.time() - start, event=self.event
+        )
+        perf.observe("ncats_webd_broadcast_bytes", size, event=self.event, kind=kind)
+
+    def resync(self, payload):
+        """Send the whole of payload to the client whose request is being
+        handled."""
+        doc = decode(payload)
+        version, size = content_version(doc)
+        emit(self.event, {"version": version, "payload": doc}, namespace=NAMESPACE)
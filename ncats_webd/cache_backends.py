@@ -0,0 +1,284 @@
+"""Flask-Caching backend that keeps recently used values in process memory.
+
+The memory tier is a least recently used cache bounded by the total size of
+the values it holds.  Misses fall through to a shared backend (filesystem,
+redis, or any other Flask-Caching backend) and are copied into memory on the
+way back, so repeated hits on large JSON payloads skip the unpickling and disk
+or network reads.  The memory tier is per process, so its entries live no
+longer than the refill timeout (or the timeout they were set with, if that is
+shorter): a value set or deleted by another process is seen within that time.
+"""
+
+from collections import OrderedDict
+import cPickle as pickle
+import threading
+import time
+
+from flask_caching import backends
+
+try:
+    from flask_caching.backends.base import BaseCache
+except ImportError:  # Flask-Caching < 1.5 uses the werkzeug caches
+    from werkzeug.contrib.cache import BaseCache
+
+DEFAULT_MEMORY_LIMIT = 128 * 1024 * 1024  # bytes
+DEFAULT_REFILL_TIMEOUT = 30  # seconds to keep values read from the shared tier
+
+
+class LRUMemoryCache(BaseCache):
+    """In-process cache that evicts the least recently used values once the
+    values it holds add up to more than memory_limit bytes.
+
+    Strings are kept as they are and everything else is kept pickled, so the
+    size of each entry is known and cached values can't be changed through
+    references held by callers.
+    """
+
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT, default_timeout=300):
+        super(LRUMemoryCache, self).__init__(default_timeout)
+        self.memory_limit = memory_limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()  # key -> (expires, pickled, value)
+        self.__lock = threading.Lock()
+
+    def __normalize_timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout > 0:
+            return time.time() + timeout
+        return 0
+
+    def __remove(self, key):
+        expires, pickled, value = self.__entries.pop(key)
+        self.size -= len(value)
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, pickled, value = entry
+            if expires != 0 and expires <= time.time():
+                self.__remove(key)
+                self.misses += 1
+                return None
+            # move the entry to the most recently used end
+            del self.__entries[key]
+            self.__entries[key] = entry
+            self.hits += 1
+        if pickled:
+            return pickle.loads(value)
+        return value
+
+    def set(self, key, value, timeout=None):
+        pickled = not isinstance(value, basestring)
+        if pickled:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            if len(value) > self.memory_limit:
+                # too big to ever fit; leave it to the shared backend
+                return False
+            self.__entries[key] = (self.__normalize_timeout(timeout), pickled, value)
+            self.size += len(value)
+            while self.size > self.memory_limit:
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                return False
+            self.__remove(key)
+        return True
+
+    def has(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return entry is not None and (entry[0] == 0 or entry[0] > time.time())
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+        return True
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.__entries),
+                "size": self.size,
+                "memory_limit": self.memory_limit,
+            }
+
+
+class TieredCache(BaseCache):
+    """An LRUMemoryCache in front of a shared Flask-Caching backend."""
+
+    def __init__(
+        self,
+        memory,
+        shared,
+        default_timeout=300,
+        refill_timeout=DEFAULT_REFILL_TIMEOUT,
+    ):
+        super(TieredCache, self).__init__(default_timeout)
+        self.memory = memory
+        self.shared = shared
+        self.refill_timeout = refill_timeout
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def memory_timeout(self, timeout):
+        """Returns how long a value set with timeout stays in memory."""
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout <= 0:  # no expiry
+            return self.refill_timeout
+        return min(timeout, self.refill_timeout)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        return self.get_shared(key)
+
+    def get_shared(self, key):
+        """Returns the value in the shared backend, replacing the one in
+        memory, for values another process may have just set."""
+        value = self.shared.get(key)
+        if value is None:
+            self.shared_misses += 1
+        else:
+            self.shared_hits += 1
+            # the shared backend doesn't say how long the value has left, so
+            # only keep it in memory briefly
+            self.memory.set(key, value, self.refill_timeout)
+        return value
+
+    def set(self, key, value, timeout=None):
+        result = self.shared.set(key, value, timeout)
+        self.memory.set(key, value, self.memory_timeout(timeout))
+        return result
+
+    def add(self, key, value, timeout=None):
+        result = self.shared.add(key, value, timeout)
+        if result:
+            self.memory.set(key, value, self.memory_timeout(timeout))
+        return result
+
+    def delete(self, key):
+        self.memory.delete(key)
+        return self.shared.delete(key)
+
+    def has(self, key):
+        return self.memory.has(key) or self.shared.has(key)
+
+    def clear(self):
+        self.memory.clear()
+        return self.shared.clear()
+
+    def stats(self):
+        result = {"memory": self.memory.stats()}
+        result["shared"] = {"hits": self.shared_hits, "misses": self.shared_misses}
+        return result
+
+
+def shared_backend(backend):
+    """Returns the backend all the processes see: the one behind the memory
+    tier of a TieredCache, or the backend itself."""
+    return getattr(backend, "shared", backend)
+
+
+class SharedSlots(object):
+    """Named values the processes publish to each other through a shared
+    backend.
+
+    Each name is a cache entry of its own, in the first of max_size slots that
+    was free when it was first published, so no process overwrites another's
+    values and none of them has to read, modify and write a shared index.
+    Values expire with the timeout they are published with; listing them
+    reads every slot.  Pass the methods the shared backend, not a TieredCache.
+    """
+
+    def __init__(self, prefix, max_size):
+        self.prefix = prefix
+        self.max_size = max_size
+        self.__slots = dict()  # name -> slot it was last published in
+
+    def __key(self, slot):
+        return "%s%d" % (self.prefix, slot)
+
+    def publish(self, backend, name, value, timeout):
+        """Publishes value under name for timeout seconds.  Returns False if
+        every slot is taken."""
+        entry = (name, time.time(), value)
+        slot = self.__slots.get(name)
+        if slot is not None:
+            current = backend.get(self.__key(slot))
+            if current is not None and current[0] == name:
+                return backend.set(self.__key(slot), entry, timeout)
+            # it expired, and the slot may have been taken since
+        for slot in range(self.max_size):
+            key = self.__key(slot)
+            if not backend.add(key, entry, timeout):
+                current = backend.get(key)
+                if current is None or current[0] != name:
+                    continue
+                backend.set(key, entry, timeout)
+            self.__slots[name] = slot
+            return True
+        return False
+
+    def values(self, backend):
+        """Returns name -> value for every value published and not expired."""
+        latest = dict()  # name -> (time published, value)
+        keys = [self.__key(slot) for slot in range(self.max_size)]
+        for entry in backend.get_many(*keys):
+            if entry is None:
+                continue
+            # a name is in two slots if its first expired while it was away
+            name, published, value = entry
+            if name not in latest or published > latest[name][0]:
+                latest[name] = (published, value)
+        return dict((name, value) for name, (published, value) in latest.items())
+
+
+def tiered(app, config, args, kwargs):
+    """Flask-Caching factory for a TieredCache.
+
+    CACHE_SHARED_TYPE names the Flask-Caching backend behind the memory tier
+    and is configured with the usual CACHE_* settings.  CACHE_MEMORY_LIMIT is
+    the size of the memory tier in bytes, and CACHE_MEMORY_REFILL_TIMEOUT
+    is how long values read back from the shared backend stay in memory.
+    """
+    shared_type = config.get("CACHE_SHARED_TYPE", "filesystem")
+    try:
+        shared_factory = getattr(backends, shared_type)
+    except AttributeError:
+        raise ImportError("%s is not a valid FlaskCache backend" % shared_type)
+    shared = shared_factory(app, config, list(args), dict(kwargs))
+    default_timeout = kwargs.get("default_timeout", 300)
+    memory = LRUMemoryCache(
+        config.get("CACHE_MEMORY_LIMIT", DEFAULT_MEMORY_LIMIT), default_timeout
+    )
+    return TieredCache(
+        memory,
+        shared,
+        default_timeout,
+        config.get("CACHE_MEMORY_REFILL_TIMEOUT", DEFAULT_REFILL_TIMEOUT),
+    )
@@ -1,10 +1,18 @@
-__ALL__ = ["cache", "socketio", "catch_exceptions"]
+__ALL__ = ["cache", "socketio", "process_pool", "catch_exceptions"]
 
 from flask_caching import Cache
 from flask_socketio import SocketIO
+import ConfigParser
 import functools
 import sys, logging  # flask_cache handler
 
+from ncats_webd.cache_backends import DEFAULT_MEMORY_LIMIT, DEFAULT_REFILL_TIMEOUT
+from ncats_webd.offload import ProcessPool
+from ncats_webd import perf
+
+DEFAULT_CONFIG_FILENAME = "/etc/cyhy/cyhy.conf"
+DEFAULT_CACHE_DIR = "/var/cyhy/web/c.cache"
+
 
 def add_flask_cache_handler():
     # get flask_cache logger
@@ -19,20 +27,92 @@ def add_flask_cache_handler():
     flask_cache_logger.addHandler(stderr_handler)
 
 
+class InstrumentedCache(Cache):
+    """Cache whose memoized functions record their timings and hit rates in
+    perf."""
+
+    def memoize(self, *args, **kwargs):
+        memoize = super(InstrumentedCache, self).memoize(*args, **kwargs)
+
+        def decorator(func):
+            return perf.instrument_memoized(func, memoize)
+
+        return decorator
+
+
 # TODO move cache to instance dir
-cache = Cache(config={"CACHE_TYPE": "filesystem", "CACHE_DIR": "/var/cyhy/web/c.cache"})
+cache = InstrumentedCache(
+    config={"CACHE_TYPE": "filesystem", "CACHE_DIR": DEFAULT_CACHE_DIR}
+)
 add_flask_cache_handler()
 socketio = SocketIO()
+process_pool = ProcessPool()
 
 
 def catch_exceptions(job_func):
+    name = perf.function_name(job_func)
+
     @functools.wraps(job_func)
     def wrapper(*args, **kwargs):
         try:
-            job_func(*args, **kwargs)
+            with perf.timer("ncats_webd_job_seconds", job=name):
+                job_func(*args, **kwargs)
         except:
             import traceback
 
+            perf.increment("ncats_webd_job_failures_total", job=name)
             print(traceback.format_exc())
 
     return wrapper
+
+
+def read_config_section(config_filename=None, section=None, yaml=False):
+    """Returns the settings in a section of the cyhy config file as a dict.
+
+    The section is chosen the same way as for the database connection: when
+    section is None, the file's default-section setting names it.
+    """
+    if config_filename is None:
+        config_filename = DEFAULT_CONFIG_FILENAME
+    if yaml:
+        import yaml as pyyaml
+
+        with open(config_filename) as f:
+            config = pyyaml.safe_load(f) or {}
+        if section is None:
+            section = config.get("default-section")
+        return dict(config.get(section) or {})
+    config = ConfigParser.RawConfigParser()
+    config.read([config_filename])
+    if section is None:
+        section = config.defaults().get("default-section")
+    if section is None or not config.has_section(section):
+        return dict(config.defaults())
+    return dict(config.items(section))
+
+
+def cache_config(settings):
+    """Returns the Flask-Caching config for the cache settings of a config file
+    section (see read_config_section).
+
+    cache-type            shared backend: filesystem (default), redis, simple, ...
+    cache-dir             directory for the filesystem backend
+    cache-redis-url       URL of the redis backend
+    cache-memory-limit    bytes held in each process's memory tier; 0 disables it
+    cache-memory-refill   seconds values read from the shared backend stay in memory
+    """
+    cache_type = settings.get("cache-type", "filesystem")
+    config = {"CACHE_DIR": settings.get("cache-dir", DEFAULT_CACHE_DIR)}
+    if settings.get("cache-redis-url"):
+        config["CACHE_REDIS_URL"] = settings["cache-redis-url"]
+    memory_limit = int(settings.get("cache-memory-limit", DEFAULT_MEMORY_LIMIT))
+    if memory_limit > 0:
+        config["CACHE_TYPE"] = "ncats_webd.cache_backends.tiered"
+        config["CACHE_SHARED_TYPE"] = cache_type
+        config["CACHE_MEMORY_LIMIT"] = memory_limit
+        config["CACHE_MEMORY_REFILL_TIMEOUT"] = int(
+            settings.get("cache-memory-refill", DEFAULT_REFILL_TIMEOUT)
+        )
+    else:
+        config["CACHE_TYPE"] = cache_type
+    return config
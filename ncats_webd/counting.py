@@ -0,0 +1,30 @@
+"""Distinct value counts computed by the server.
+
+len(collection.find(query).distinct(field)) returns every distinct value in
+one BSON document, which fails once the values add up to 16MB, only for the
+caller to take its length.  count_distinct() groups on the field and counts
+the groups in an aggregation instead, spilling to disk when needed, so only
+the count comes back.
+"""
+
+
+def count_distinct(collection, field, query=None):
+    """Returns the number of distinct values of field in the documents of
+    collection matching query.  Like distinct(), documents without the field
+    are ignored; unlike it, an array value counts as one value rather than
+    one for each of its elements."""
+    exists = {field: {"$exists": True}}
+    if query:
+        match = {"$and": [query, exists]}
+    else:
+        match = exists
+    result = list(
+        collection.aggregate(
+            [{"$match": match}, {"$group": {"_id": "$" + field}}, {"$count": "count"}],
+            allowDiskUse=True,
+            cursor={},
+        )
+    )
+    if not result:
+        return 0
+    return result[0]["count"]
@@ -1,14 +1,39 @@
 from collections import OrderedDict
+import csv
 import datetime
+import io
 import json
+import os
+import tempfile
+import threading
 
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
 from cyhy.util import util
+from ncats_webd.age_buckets import daily_age_buckets
+from ncats_webd.frames import DATETIME, Column, load_frame, projection, utc_timestamp
+from ncats_webd.org_index import get_org_index
 
 TICKETS_CLOSED_PAST_DAYS = 30
+# days after a day ends before its counts are stored; late imports, reopened
+# tickets and false positive changes can still alter them until then
+CYBEX_HISTORY_GRACE_DAYS = TICKETS_CLOSED_PAST_DAYS
+CSV_BATCH_SIZE = 1000  # tickets per chunk of the streamed CSV exports
+# snapshot ids per report lookup, to keep each command well under 16MB
+REPORT_LOOKUP_BATCH_SIZE = 10000
+CSV_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+CYBEX_HISTORY_COLUMNS = ["young", "old", "total"]
+AGE_COLUMNS = [Column("time_opened", DATETIME), Column("time_closed", DATETIME)]
+
+# generated_time of the first report for each snapshot id, least recently
+# used first.  Report times never change once written, so entries are only
+# evicted to keep the cache to FIRST_REPORT_TIME_CACHE_SIZE; only snapshots
+# that have been reported are cached, since a report may come later.
+FIRST_REPORT_TIME_CACHE_SIZE = 100000  # snapshot ids, about 20MB
+first_report_time_cache = OrderedDict()
+first_report_time_lock = threading.Lock()
 
 # For BOD 23-02, the Cyber Hygiene team defined a list of services that may
 # indicate potential publicly-accessible network management interfaces that
@@ -41,13 +66,46 @@ def get_hostnames_of_tickets(db, tickets):
     return ip_to_hostname
 
 
-def get_open_tickets_dataframe(db, ticket_severity):
-    now = util.utcnow()
-    first_report_time_cache = (
-        dict()
-    )  # Cache generated_time of first report for each ticket
-
-    fed_executive_owners = db.RequestDoc.get_all_descendants("EXECUTIVE")
+def get_first_report_times(db, snapshot_ids):
+    """Given snapshot ids, return a dict mapping each snapshot id that has been
+    reported to the generated_time of its first report."""
+    result = dict()
+    missing = list()
+    with first_report_time_lock:
+        for x in set(snapshot_ids):
+            if x in first_report_time_cache:
+                # move it to the most recently used end
+                result[x] = first_report_time_cache.pop(x)
+                first_report_time_cache[x] = result[x]
+            else:
+                missing.append(x)
+    for batch in batches(missing, REPORT_LOOKUP_BATCH_SIZE):
+        for report in db.reports.aggregate(
+            [
+                {"$match": {"snapshot_oid": {"$in": batch}}},
+                {
+                    "$group": {
+                        "_id": "$snapshot_oid",
+                        "generated_time": {"$min": "$generated_time"},
+                    }
+                },
+            ],
+            allowDiskUse=True,
+            cursor={},
+        ):
+            if report["generated_time"]:
+                result[report["_id"]] = report["generated_time"]
+                with first_report_time_lock:
+                    first_report_time_cache[report["_id"]] = report["generated_time"]
+                    if len(first_report_time_cache) > FIRST_REPORT_TIME_CACHE_SIZE:
+                        first_report_time_cache.popitem(last=False)
+    return result
+
+
+def find_open_tickets(db, ticket_severity, fields=None):
+    """Returns a cursor over the open FED EXECUTIVE tickets for ticket_severity,
+    with fields if given instead of those the JSON and CSV exports need."""
+    fed_executive_owners = get_org_index(db).get_all_descendants("EXECUTIVE")
 
     PORT_TICKET_PROJECTION = {
         "_id": True,
@@ -84,7 +142,7 @@ def get_open_tickets_dataframe(db, ticket_severity):
                 "owner": {"$in": fed_executive_owners},
                 "source": "nmap",
             },
-            PORT_TICKET_PROJECTION,
+            fields or PORT_TICKET_PROJECTION,
          )
     elif ticket_severity == "urgent":
         # "urgent" tickets meet at least one of the following criteria:
@@ -99,7 +157,7 @@ def get_open_tickets_dataframe(db, ticket_severity):
                 "owner": {"$in": fed_executive_owners},
                 "source": "nessus",
             },
-            VULN_TICKET_PROJECTION,
+            fields or VULN_TICKET_PROJECTION,
         )
     else:
         # Treat ticket_severity normally
@@ -111,11 +169,19 @@ def get_open_tickets_dataframe(db, ticket_severity):
                 "owner": {"$in": fed_executive_owners},
                 "source": "nessus",
             },
-            VULN_TICKET_PROJECTION,
+            fields or VULN_TICKET_PROJECTION,
         )
+    return tix
+
 
-    tix = list(tix)
-    ip_to_hostname = get_hostnames_of_tickets(db, tix)
+def annotate_open_tickets(db, tix, ticket_severity, now):
+    """Flatten the details of each open ticket in tix and add its age and
+    report timing fields, plus category and hostname for risky services."""
+    if ticket_severity == "risky_services":
+        ip_to_hostname = get_hostnames_of_tickets(db, tix)
+    first_report_times = get_first_report_times(
+        db, [snap_id for x in tix for snap_id in x.get("snapshots", [])]
+    )
     for x in tix:
         x.update(x["details"])
         del x["details"]
@@ -127,17 +193,9 @@ def get_open_tickets_dataframe(db, ticket_severity):
         x["days_to_report"] = None
 
         for snap_id in x.get("snapshots", []):
-            x["first_reported"] = first_report_time_cache.get(snap_id)
+            x["first_reported"] = first_report_times.get(snap_id)
             if x["first_reported"]:
-                # Found this snapshot's report time in the cache
                 break
-            else:
-                # Not found in the cache, so make a database call
-                first_report = db.reports.find_one({"snapshot_oid": snap_id})
-                if first_report:
-                    x["first_reported"] = first_report.get("generated_time")
-                    first_report_time_cache[snap_id] = x["first_reported"]
-                    break
 
         if x["first_reported"]:
             x["days_since_first_reported"] = (
@@ -154,6 +212,12 @@ def get_open_tickets_dataframe(db, ticket_severity):
         if ticket_severity == "risky_services":
             x["category"] = RISKY_SERVICES_MAP[x["service"]]
             x["hostname"] = ip_to_hostname.get(x["ip"], None)
+    return tix
+
+
+def get_open_tickets_dataframe(db, ticket_severity):
+    tix = list(find_open_tickets(db, ticket_severity))
+    annotate_open_tickets(db, tix, ticket_severity, util.utcnow())
 
     df = DataFrame(tix)
     if not df.empty:
@@ -161,12 +225,14 @@ def get_open_tickets_dataframe(db, ticket_severity):
     return df
 
 
-def get_closed_tickets_dataframe(db, ticket_severity):
+def find_closed_tickets(db, ticket_severity):
+    """Returns a cursor over the FED EXECUTIVE tickets for ticket_severity
+    closed in the past TICKETS_CLOSED_PAST_DAYS days."""
     closed_since_date = util.utcnow() - datetime.timedelta(
         days=TICKETS_CLOSED_PAST_DAYS
     )
 
-    fed_executive_owners = db.RequestDoc.get_all_descendants("EXECUTIVE")
+    fed_executive_owners = get_org_index(db).get_all_descendants("EXECUTIVE")
 
     PORT_TICKET_PROJECTION = {
         "_id": True,
@@ -232,9 +298,14 @@ def get_closed_tickets_dataframe(db, ticket_severity):
             },
             VULN_TICKET_PROJECTION,
         )
+    return tix
 
-    tix = list(tix)
-    ip_to_hostname = get_hostnames_of_tickets(db, tix)
+
+def annotate_closed_tickets(db, tix, ticket_severity):
+    """Flatten the details of each closed ticket in tix, plus category and
+    hostname for risky services."""
+    if ticket_severity == "risky_services":
+        ip_to_hostname = get_hostnames_of_tickets(db, tix)
     for x in tix:
         x.update(x["details"])
         del x["details"]
@@ -243,6 +314,12 @@ def get_closed_tickets_dataframe(db, ticket_severity):
         if ticket_severity == "risky_services":
             x["category"] = RISKY_SERVICES_MAP[x["service"]]
             x["hostname"] = ip_to_hostname.get(x["ip"], None)
+    return tix
+
+
+def get_closed_tickets_dataframe(db, ticket_severity):
+    tix = list(find_closed_tickets(db, ticket_severity))
+    annotate_closed_tickets(db, tix, ticket_severity)
 
     df = DataFrame(tix)
     if not df.empty:
@@ -255,52 +332,121 @@ def get_closed_tickets_dataframe(db, ticket_severity):
     return df
 
 
-def get_cybex_dataframe(db, start_date, ticket_severity):
+def compute_cybex_days(db, days, ticket_severity):
+    """Count the young/old/total tickets open on each of days from the raw tickets."""
+    if len(days) == 0:
+        return DataFrame(0, index=days, columns=CYBEX_HISTORY_COLUMNS)
     now = util.utcnow()
     tomorrow = now + datetime.timedelta(days=1)
-    days_to_graph = pd.to_datetime(pd.date_range(start_date, now), utc=True)
 
-    fed_executive_owners = db.RequestDoc.get_all_descendants("EXECUTIVE")
+    fed_executive_owners = get_org_index(db).get_all_descendants("EXECUTIVE")
 
-    # Calculate Buckets
+    # only tickets still open at the start of the first day can be counted
+    first_day = days[0].to_pydatetime()
     tix = db.TicketDoc.find(
         {
             "source": "nessus",
             "details.severity": ticket_severity,
             "false_positive": False,
             "owner": {"$in": fed_executive_owners},
-            "$or": [{"time_closed": {"$gte": start_date}}, {"time_closed": None}],
+            "$or": [{"time_closed": {"$gte": first_day}}, {"time_closed": None}],
         },
-        {"_id": False, "time_opened": True, "time_closed": True},
+        projection(AGE_COLUMNS),
     )
 
-    tix = list(tix)
-    df = DataFrame(tix)
-    results_df = DataFrame(index=days_to_graph, columns=["young", "old", "total"])
+    df = load_frame(tix, AGE_COLUMNS)
+    results_df = DataFrame(0, index=days, columns=CYBEX_HISTORY_COLUMNS)
     if not df.empty:
-        df.time_closed = df.time_closed.fillna(
-            tomorrow
-        )  # for accounting purposes, say all open tix will close tomorrow
-        # convert times to datetime64
-        df.time_closed = pd.to_datetime(df.time_closed, utc=True)
-        df.time_opened = pd.to_datetime(df.time_opened, utc=True)
+        # for accounting purposes, say all open tix will close tomorrow
+        df.time_closed = df.time_closed.fillna(utc_timestamp(tomorrow))
 
         old_delta = np.timedelta64(TICKETS_CLOSED_PAST_DAYS, "D")
 
-        for start_of_day, values in results_df.iterrows():
-            end_of_day = start_of_day + np.timedelta64(1, "D") - np.timedelta64(1, "ns")
-            open_on_day_mask = (df.time_opened <= end_of_day) & (
-                df.time_closed > start_of_day
-            )
-            age_on_date = start_of_day - df.time_opened
-            age_on_date_masked = age_on_date.mask(open_on_day_mask == False)
-            values["total"] = open_on_day_mask.value_counts().get(True, 0)
-            values["young"] = (
-                (age_on_date_masked < old_delta).value_counts().get(True, 0)
-            )
-            values["old"] = (
-                (age_on_date_masked >= old_delta).value_counts().get(True, 0)
-            )
+        results_df = daily_age_buckets(
+            days, df.time_opened, df.time_closed, [old_delta], ["young", "old"]
+        )
+    return results_df
+
+
+def cybex_history_path(history_dir, start_date, ticket_severity):
+    return os.path.join(
+        history_dir,
+        # named after the grace period too, so days stored under a shorter
+        # one are recomputed
+        "cybex_{!s}_{!s}_{!s}d_{!s}g.json".format(
+            ticket_severity,
+            start_date.strftime("%Y%m%d"),
+            TICKETS_CLOSED_PAST_DAYS,
+            CYBEX_HISTORY_GRACE_DAYS,
+        ),
+    )
+
+
+def load_cybex_history(path):
+    """Returns the stored {"YYYY-MM-DD": [young, old, total]} counts in path."""
+    try:
+        with open(path) as f:
+            return json.load(f)["days"]
+    except (IOError, ValueError, KeyError):
+        return dict()
+
+
+def save_cybex_history(path, history):
+    """Atomically replace the stored counts in path with history."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".cybex_history")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"days": history}, f, sort_keys=True)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def get_cybex_dataframe(db, start_date, ticket_severity, history_dir=None):
+    """Returns the daily young/old/total counts from start_date through today.
+
+    When history_dir is given, the counts for days that ended more than
+    CYBEX_HISTORY_GRACE_DAYS days ago are kept there, so only the days since
+    then are computed from the tickets.
+    """
+    now = util.utcnow()
+    days_to_graph = pd.to_datetime(pd.date_range(start_date, now), utc=True)
+    if history_dir is None:
+        return compute_cybex_days(db, days_to_graph, ticket_severity)
+
+    path = cybex_history_path(history_dir, start_date, ticket_severity)
+    history = load_cybex_history(path)
+    day_keys = [x.strftime("%Y-%m-%d") for x in days_to_graph]
+    # the days whose counts will no longer change
+    final = max(0, len(day_keys) - 1 - CYBEX_HISTORY_GRACE_DAYS)
+    stored = 0
+    while stored < final and day_keys[stored] in history:
+        stored += 1
+
+    results_df = compute_cybex_days(db, days_to_graph[stored:], ticket_severity)
+    if stored:
+        stored_df = DataFrame(
+            [history[k] for k in day_keys[:stored]],
+            index=days_to_graph[:stored],
+            columns=CYBEX_HISTORY_COLUMNS,
+        )
+        results_df = pd.concat([stored_df, results_df])
+
+    if stored < final:
+        for day_key, values in zip(
+            day_keys[stored:final],
+            results_df[CYBEX_HISTORY_COLUMNS].values[stored:final],
+        ):
+            history[day_key] = [int(x) for x in values]
+        save_cybex_history(path, history)
     return results_df
 
 
@@ -310,129 +456,129 @@ def json_get_open_tickets(db, ticket_severity):
     return json.dumps(results, default=util.custom_json_handler)
 
 
-def csv_get_open_tickets(db, ticket_severity):
-    results_df = get_open_tickets_dataframe(db, ticket_severity)
-    if not results_df.empty:
-        # TODO date_format param not getting picked up.  Processing manually with apply
-        results_df["time_opened"] = results_df["time_opened"].apply(
-            lambda x: x.strftime("%Y-%m-%d %H:%M:%S")
-        )  # excel crap
-        results_df["first_reported"] = results_df["first_reported"].apply(
-            lambda x: x.strftime("%Y-%m-%d %H:%M:%S")
-            if type(x) == pd.tslib.Timestamp
-            else None
-        )
-        # Round values for 'days' fields to 1 decimal place
-        results_df["days_since_first_detected"] = results_df[
-            "days_since_first_detected"
-        ].round(decimals=1)
-        results_df["days_since_first_reported"] = results_df[
-            "days_since_first_reported"
-        ].apply(lambda x: round(x, 1) if type(x) == float else None)
-        results_df["days_to_report"] = results_df["days_to_report"].apply(
-            lambda x: round(x, 1) if type(x) == float else None
-        )
+def csv_value(value):
+    """Format a ticket field the way the CSV exports always have."""
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.strftime(CSV_TIME_FORMAT)  # excel crap
+    if isinstance(value, float):
+        # all the float fields are days, shown to 1 decimal place
+        return round(value, 1)
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def csv_rows(rows, columns):
+    """Returns rows (a list of dicts) formatted as CSV lines of columns."""
+    output = io.BytesIO()
+    writer = csv.writer(output, lineterminator="\n")
+    for row in rows:
+        writer.writerow([csv_value(row.get(column)) for column in columns])
+    return output.getvalue()
+
+
+def batches(cursor, size):
+    batch = list()
+    for x in cursor:
+        batch.append(x)
+        if len(batch) == size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
 
-        if ticket_severity == "risky_services":
-            response = results_df.to_csv(
-                index=False,
-                date_format="%Y-%m-%d %H:%M:%S",
-                columns=[
-                    "_id",
-                    "owner",
-                    "ip",
-                    "hostname",
-                    "port",
-                    "service",
-                    "category",
-                    "time_opened",
-                    "days_since_first_detected",
-                    "first_reported",
-                    "days_since_first_reported",
-                    "days_to_report",
-                ]
-             )
-        else:
-            response = results_df.to_csv(
-                index=False,
-                date_format="%Y-%m-%d %H:%M:%S",
-                columns=[
-                    "_id",
-                    "owner",
-                    "ip",
-                    "port",
-                    "name",
-                    "cve",
-                    "kev",
-                    "kev_ransomware",
-                    "severity",
-                    "time_opened",
-                    "days_since_first_detected",
-                    "first_reported",
-                    "days_since_first_reported",
-                    "days_to_report",
-                ]
-            )
+
+def csv_get_open_tickets(db, ticket_severity):
+    """Generates the open tickets CSV in chunks of CSV_BATCH_SIZE tickets,
+    oldest tickets first."""
+    if ticket_severity == "risky_services":
+        columns = [
+            "_id",
+            "owner",
+            "ip",
+            "hostname",
+            "port",
+            "service",
+            "category",
+            "time_opened",
+            "days_since_first_detected",
+            "first_reported",
+            "days_since_first_reported",
+            "days_to_report",
+        ]
     else:
-        response = ""
-    return response
+        columns = [
+            "_id",
+            "owner",
+            "ip",
+            "port",
+            "name",
+            "cve",
+            "kev",
+            "kev_ransomware",
+            "severity",
+            "time_opened",
+            "days_since_first_detected",
+            "first_reported",
+            "days_since_first_reported",
+            "days_to_report",
+        ]
+    now = util.utcnow()
+    yield csv_rows([dict(zip(columns, columns))], columns)
+    tix = find_open_tickets(db, ticket_severity)
+    tix = tix.sort("time_opened", 1).batch_size(CSV_BATCH_SIZE)
+    for batch in batches(tix, CSV_BATCH_SIZE):
+        annotate_open_tickets(db, batch, ticket_severity, now)
+        yield csv_rows(batch, columns)
 
 
 def csv_get_closed_tickets(db, ticket_severity):
-    results_df = get_closed_tickets_dataframe(db, ticket_severity)
-    if not results_df.empty:
-        # TODO date_format param not getting picked up.  Processing manually with apply
-        results_df["time_opened"] = results_df["time_opened"].apply(
-            lambda x: x.strftime("%Y-%m-%d %H:%M:%S")
-        )  # excel crap
-        results_df["time_closed"] = results_df["time_closed"].apply(
-            lambda x: x.strftime("%Y-%m-%d %H:%M:%S")
-        )  # excel crap
-
-
-        if ticket_severity == "risky_services":
-            response = results_df.to_csv(
-                index=False,
-                date_format="%Y-%m-%d %H:%M:%S",
-                columns=[
-                    "_id",
-                    "owner",
-                    "ip",
-                    "hostname",
-                    "port",
-                    "service",
-                    "category",
-                    "time_opened",
-                    "time_closed",
-                    "days_to_close",
-                ],
-            )
-        else:
-            response = results_df.to_csv(
-                index=False,
-                date_format="%Y-%m-%d %H:%M:%S",
-                columns=[
-                    "_id",
-                    "owner",
-                    "ip",
-                    "port",
-                    "name",
-                    "cve",
-                    "kev",
-                    "kev_ransomware",
-                    "severity",
-                    "time_opened",
-                    "time_closed",
-                    "days_to_close",
-                ],
-            )
+    """Generates the closed tickets CSV in chunks of CSV_BATCH_SIZE tickets,
+    earliest closed first."""
+    if ticket_severity == "risky_services":
+        columns = [
+            "_id",
+            "owner",
+            "ip",
+            "hostname",
+            "port",
+            "service",
+            "category",
+            "time_opened",
+            "time_closed",
+            "days_to_close",
+        ]
     else:
-        response = ""
-    return response
-
-
-def json_get_cybex_data(db, start_date, ticket_severity):
-    results_df = get_cybex_dataframe(db, start_date, ticket_severity)
+        columns = [
+            "_id",
+            "owner",
+            "ip",
+            "port",
+            "name",
+            "cve",
+            "kev",
+            "kev_ransomware",
+            "severity",
+            "time_opened",
+            "time_closed",
+            "days_to_close",
+        ]
+    yield csv_rows([dict(zip(columns, columns))], columns)
+    tix = find_closed_tickets(db, ticket_severity)
+    tix = tix.sort("time_closed", 1).batch_size(CSV_BATCH_SIZE)
+    for batch in batches(tix, CSV_BATCH_SIZE):
+        annotate_closed_tickets(db, batch, ticket_severity)
+        for x in batch:
+            x["days_to_close"] = (
+                x["time_closed"] - x["time_opened"]
+            ).total_seconds() / 86400.0
+        yield csv_rows(batch, columns)
+
+
+def json_get_cybex_data(db, start_date, ticket_severity, history_dir=None):
+    results_df = get_cybex_dataframe(db, start_date, ticket_severity, history_dir)
     # create json output
     results = OrderedDict()  # the order matters to c3js
     results["x"] = [x.strftime("%Y-%m-%d") for x in results_df.index]
@@ -442,8 +588,8 @@ def json_get_cybex_data(db, start_date, ticket_severity):
     return json.dumps(results, default=util.custom_json_handler)
 
 
-def csv_get_cybex_data(db, start_date, ticket_severity):
-    results_df = get_cybex_dataframe(db, start_date, ticket_severity)
+def csv_get_cybex_data(db, start_date, ticket_severity, history_dir=None):
+    results_df = get_cybex_dataframe(db, start_date, ticket_severity, history_dir)
     results_df.index.name = "date"
     results_df.columns = ["< 30 days", "> 30 days", "total"]
     response = results_df.to_csv()
@@ -451,12 +597,20 @@ def csv_get_cybex_data(db, start_date, ticket_severity):
 
 
 def json_get_cybex_histogram_data(db, ticket_severity, max_age_cutoff=None):
-    results_df = get_open_tickets_dataframe(db, ticket_severity)
+    # only the ages are needed, so skip the details and report lookups
+    now = util.utcnow()
+    columns = [Column("time_opened", DATETIME)]
+    results_df = load_frame(
+        find_open_tickets(db, ticket_severity, projection(columns)), columns
+    )
     if results_df.empty == True:
         results = {"age": []}
         return json.dumps(results, default=util.custom_json_handler)
+    days_since_first_detected = (
+        utc_timestamp(now) - results_df.time_opened
+    ) / np.timedelta64(1, "D")
     s = np.floor(
-        results_df.days_since_first_detected
+        days_since_first_detected
     )  # lop off any decimals so we can bucket appropriately
     oldest = int(s.max())
     s2 = s.value_counts().reindex(range(oldest + 1)).fillna(0)
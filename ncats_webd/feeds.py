@@ -0,0 +1,231 @@
+"""Feeds of recently changed documents for the socket.io rooms.
+
+A Feed passes batches of changed documents from a collection to an emitter.
+When the server supports change streams (a MongoDB 3.6+ replica set) it
+tails one in a background thread, gathering the changes made within
+batch_window seconds of each other into one batch, and resumes from the last
+resume token it saw after errors.  Otherwise, or if the change stream is
+rejected, it polls the collection every poll_interval seconds from the
+scheduler, as the feeds always used to.
+
+Either way, batches are read with the same query and projection, so the
+emitter sees the same documents in both modes.
+
+Only the worker process elected to run the background jobs has the feeds.
+Given a history_key, a feed also keeps its history in the shared cache,
+where shared_history() reads it from any worker.
+"""
+
+from collections import deque
+import datetime
+import threading
+import time
+import traceback
+
+from flask import current_app
+import pymongo
+from pymongo.errors import OperationFailure, PyMongoError
+import schedule
+
+from cyhy.util import util
+
+from ncats_webd.common import cache, catch_exceptions
+
+CHANGE_STREAM_PIPELINE = [
+    {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}},
+    {"$project": {"documentKey": True}},
+]
+DEFAULT_BATCH_WINDOW = 2  # seconds to gather changes before emitting them
+INITIAL_LOOKBACK = datetime.timedelta(minutes=30)
+RETRY_DELAY = 10  # seconds to wait before reopening a failed change stream
+
+
+def shared_history(key):
+    """Returns the history kept in the cache by the feed with history_key key."""
+    return cache.get(key) or list()
+
+
+def change_streams_available():
+    # ChangeStream.try_next() is needed to end a batch without a new change,
+    # and ChangeStream.resume_token to resume after the last batch emitted
+    return pymongo.version_tuple >= (3, 9)
+
+
+class Feed(object):
+    """Emits the documents of collection that match query as they change.
+
+    since_field is a field holding the time each document last changed; only
+    documents changed since the last batch are read, whatever else the change
+    stream reports.  Without it, every matching document is read on each
+    poll, and every changed one with a change stream.
+    """
+
+    def __init__(
+        self,
+        collection,
+        emitter,
+        logger,
+        query=None,
+        projection=None,
+        since_field=None,
+        poll_interval=300,
+        batch_window=DEFAULT_BATCH_WINDOW,
+        history_size=100,
+        history_key=None,
+    ):
+        self.__collection = collection
+        self.__emitter = emitter
+        self.__logger = logger
+        self.__query = query or {}
+        self.__projection = projection
+        self.__since_field = since_field
+        self.__poll_interval = poll_interval
+        self.__batch_window = batch_window
+        self.__since = util.utcnow() - INITIAL_LOOKBACK
+        self.__history = deque(maxlen=history_size)
+        self.__history_key = history_key
+        self.__resume_token = None
+        if change_streams_available():
+            self.__start_tailing()
+        else:
+            self.__start_polling()
+
+    @property
+    def history(self):
+        return list(self.__history)
+
+    def __publish(self, docs):
+        if docs:
+            self.__logger.debug("found %d updated documents" % len(docs))
+            self.__history.extend(docs)
+            if self.__history_key is not None:
+                cache.set(self.__history_key, self.history, timeout=0)
+            self.__emitter(docs)
+        else:
+            self.__logger.debug("no updated documents found")
+
+    def __find(self, query):
+        cursor = self.__collection.find(query, self.__projection)
+        if self.__since_field is not None:
+            cursor = cursor.sort([(self.__since_field, pymongo.DESCENDING)])
+        docs = list(cursor)
+        # convert _ids to string since we can't set custom json handler
+        for doc in docs:
+            doc["_id"] = str(doc["_id"])
+        return docs
+
+    def __find_changed_since(self):
+        now = util.utcnow()
+        query = dict(self.__query)
+        if self.__since_field is not None:
+            query[self.__since_field] = {"$gt": self.__since}
+        docs = self.__find(query)
+        self.__since = now
+        return docs
+
+    def __find_by_ids(self, ids):
+        now = util.utcnow()
+        query = dict(self.__query)
+        query["_id"] = {"$in": list(set(ids))}
+        if self.__since_field is not None:
+            # writes that don't move since_field aren't emitted when polling
+            query[self.__since_field] = {"$gt": self.__since}
+        docs = self.__find(query)
+        self.__since = now
+        return docs
+
+    ###########################################################################
+    #  Polling
+    ###########################################################################
+
+    def __start_polling(self):
+        self.__logger.info(
+            "polling %s every %d seconds"
+            % (self.__collection.full_name, self.__poll_interval)
+        )
+        schedule.every(self.__poll_interval).seconds.do(self.__poll)
+
+    @catch_exceptions
+    def __poll(self):
+        self.__logger.debug("checking for updated %s" % self.__collection.name)
+        self.__publish(self.__find_changed_since())
+
+    ###########################################################################
+    #  Change stream
+    ###########################################################################
+
+    def __start_tailing(self):
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                self.__tail()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def __tail(self):
+        caught_up = False
+        while True:
+            try:
+                with self.__collection.watch(
+                    CHANGE_STREAM_PIPELINE,
+                    resume_after=self.__resume_token,
+                    max_await_time_ms=int(self.__batch_window * 1000),
+                ) as stream:
+                    if not caught_up:
+                        # the stream is open, so nothing changed after this
+                        # read can be missed
+                        self.__publish(self.__find_changed_since())
+                        caught_up = True
+                        self.__logger.info(
+                            "following %s with a change stream"
+                            % self.__collection.full_name
+                        )
+                    self.__follow(stream)
+            except OperationFailure:
+                if not caught_up:
+                    self.__logger.warning(
+                        "change stream on %s rejected, falling back to polling:\n%s"
+                        % (self.__collection.full_name, traceback.format_exc())
+                    )
+                    self.__start_polling()
+                    return
+                # most likely the token fell off the oplog; start over and
+                # read whatever changed since the last batch
+                self.__logger.warning(
+                    "could not resume change stream on %s:\n%s"
+                    % (self.__collection.full_name, traceback.format_exc())
+                )
+                self.__resume_token = None
+                caught_up = False
+            except PyMongoError:
+                self.__logger.error(
+                    "change stream on %s failed, retrying in %d seconds:\n%s"
+                    % (self.__collection.full_name, RETRY_DELAY, traceback.format_exc())
+                )
+                time.sleep(RETRY_DELAY)
+
+    @catch_exceptions
+    def __publish_quietly(self, docs):
+        # don't lose the change stream to a failing emitter
+        self.__publish(docs)
+
+    def __follow(self, stream):
+        """Emit the changes from stream in batches until it closes."""
+        ids = list()
+        deadline = None
+        while stream.alive:
+            change = stream.try_next()
+            if change is not None:
+                ids.append(change["documentKey"]["_id"])
+                if deadline is None:
+                    deadline = time.time() + self.__batch_window
+            if ids and (change is None or time.time() >= deadline):
+                self.__publish_quietly(self.__find_by_ids(ids))
+                ids = list()
+                deadline = None
+            if not ids:
+                # only move past changes once they have been emitted
+                self.__resume_token = stream.resume_token
@@ -0,0 +1,172 @@
+"""Loads query results into DataFrames column by column.
+
+DataFrame(list(cursor)) holds every document as a dict at once, then has
+pandas infer a type for each column from Python objects; nested fields have
+to be flattened by hand first, and datetimes converted afterwards.
+load_frame() instead reads the cursor BATCH_SIZE documents at a time into
+typed NumPy arrays for the declared columns, so only one batch of documents
+is alive at a time and each column gets its final type as it is read:
+
+    columns = [
+        Column("owner", CATEGORY),
+        Column("severity", "int8", path="details.severity"),
+        Column("time_opened", DATETIME),
+    ]
+    df = load_frame(db.tickets.find(query, projection(columns)), columns)
+
+A column's path names the (possibly nested) field it is read from, so the
+projection flattens the documents.  Datetime columns are UTC; fields that are
+missing or None become NaT in them, NaN in categorical and float columns, and
+the column's missing value otherwise.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+BATCH_SIZE = 10000  # documents read before they are added to the columns
+CATEGORY = "category"
+DATETIME = "datetime"
+OBJECT = "object"
+
+
+class Column(object):
+    """A column named name, of kind CATEGORY, DATETIME, OBJECT or a NumPy
+    dtype, read from the field at path (name by default)."""
+
+    def __init__(self, name, kind=OBJECT, path=None, missing=None):
+        self.name = name
+        self.kind = kind
+        self.path = path or name
+        self.keys = self.path.split(".")
+        self.missing = missing
+
+    def values(self, docs):
+        """Returns the values of this column's field in docs."""
+        values = list()
+        for doc in docs:
+            value = doc
+            for key in self.keys:
+                value = value.get(key) if isinstance(value, dict) else None
+            values.append(self.missing if value is None else value)
+        return values
+
+
+def projection(columns):
+    """Returns the projection of the fields read by columns."""
+    fields = dict((column.path, True) for column in columns)
+    fields.setdefault("_id", False)
+    return fields
+
+
+def _naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        return (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
+
+def utc_timestamp(value):
+    """Returns the datetime value (naive ones are taken to be UTC) as a
+    Timestamp in the same timezone as the datetime columns."""
+    return pd.Timestamp(_naive_utc(value)).tz_localize("UTC")
+
+
+class _CategoryBuilder(object):
+    def __init__(self, column):
+        self.column = column
+        self.codes = list()
+        self.categories = dict()
+
+    def add(self, docs):
+        categories = self.categories
+        codes = [
+            -1 if value is None else categories.setdefault(value, len(categories))
+            for value in self.column.values(docs)
+        ]
+        self.codes.append(np.array(codes, dtype=np.int32))
+
+    def result(self):
+        categories = sorted(self.categories, key=self.categories.get)
+        return pd.Categorical.from_codes(_concatenate(self.codes, np.int32), categories)
+
+
+class _DatetimeBuilder(object):
+    def __init__(self, column):
+        self.column = column
+        self.chunks = list()
+
+    def add(self, docs):
+        values = [_naive_utc(value) for value in self.column.values(docs)]
+        self.chunks.append(np.array(values, dtype="datetime64[us]"))
+
+    def result(self):
+        values = _concatenate(self.chunks, "datetime64[us]")
+        return pd.DatetimeIndex(values.astype("datetime64[ns]")).tz_localize("UTC")
+
+
+class _ObjectBuilder(object):
+    def __init__(self, column):
+        self.column = column
+        self.values = list()
+
+    def add(self, docs):
+        self.values.extend(self.column.values(docs))
+
+    def result(self):
+        # built by hand so list values aren't taken for another dimension
+        values = np.empty(len(self.values), dtype=object)
+        for i, value in enumerate(self.values):
+            values[i] = value
+        return values
+
+
+class _ArrayBuilder(object):
+    def __init__(self, column):
+        self.column = column
+        self.chunks = list()
+
+    def add(self, docs):
+        self.chunks.append(np.array(self.column.values(docs), dtype=self.column.kind))
+
+    def result(self):
+        return _concatenate(self.chunks, self.column.kind)
+
+
+def _concatenate(chunks, dtype):
+    if not chunks:
+        return np.array([], dtype=dtype)
+    return np.concatenate(chunks)
+
+
+def _builder(column):
+    if column.kind == CATEGORY:
+        return _CategoryBuilder(column)
+    if column.kind == DATETIME:
+        return _DatetimeBuilder(column)
+    if column.kind == OBJECT:
+        return _ObjectBuilder(column)
+    return _ArrayBuilder(column)
+
+
+def load_frame(cursor, columns, batch_size=BATCH_SIZE):
+    """Returns a DataFrame of columns read from the documents of cursor."""
+    builders = [_builder(column) for column in columns]
+    batch = list()
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            for builder in builders:
+                builder.add(batch)
+            batch = list()
+    if batch:
+        for builder in builders:
+            builder.add(batch)
+    return DataFrame(
+        OrderedDict(
+            (column.name, builder.result())
+            for column, builder in zip(columns, builders)
+        ),
+        columns=[column.name for column in columns],
+    )
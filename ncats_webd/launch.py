@@ -13,6 +13,7 @@ Options:
   -c --config=CONFIG_FILE        Configuration file to use.
   -s --section=SECTION           Configuration section to use.
   -n --new_hire_section=HIRE_SECTION  Configuration new hire section.
+  -w --workers=COUNT             Number of worker processes [default: 1].
   --version                      Show version.
 
 """
@@ -22,15 +23,22 @@ monkey.patch_all()
 async_mode = "gevent"
 
 from docopt import docopt
-import os, shlex, subprocess
+import os, shlex, subprocess, sys
 
 
 def main():
     global __doc__
     args = docopt(__doc__, version="v0.0.2")
+    try:
+        workers = int(args["--workers"])
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        print("--workers must be a positive integer")
+        sys.exit(-1)
 
-    command = "gunicorn --bind '[::]:5000' --log-level=debug --timeout=90 -k {!s} --worker-class geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 \"".format(
-        async_mode
+    command = "gunicorn --bind '[::]:5000' --log-level=debug --timeout=90 -k {!s} --worker-class geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w {:d} \"".format(
+        async_mode, workers
     )
     command += "ncats_webd.ncats_webd:create_app("
 
@@ -48,6 +56,8 @@ def main():
         arg_list.append("section='" + args["--section"] + "'")
     if args["--new_hire_section"]:
         arg_list.append("new_hire_section='" + args["--new_hire_section"] + "'")
+    if workers > 1:
+        arg_list.append("workers=" + str(workers))
     command += ",".join(arg_list) + ')"'
 
     if args["--debug"]:
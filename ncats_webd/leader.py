@@ -0,0 +1,84 @@
+"""Election of the worker process that runs the background jobs.
+
+The scheduled broadcasts, the feeds and the refresh-ahead recomputations
+only need to run once per host, however many worker processes serve
+requests.  The workers share a lock file, and the one holding an exclusive
+flock() on it is the leader.  The kernel releases the lock when the leader
+exits, and another worker takes over within RETRY_INTERVAL seconds.
+
+Background jobs are set up by functions decorated with on_elected, which
+lead() calls from the scheduler thread of the process once it is elected.
+"""
+
+import fcntl
+import os
+import time
+import traceback
+
+from flask import current_app
+
+LOCK_FILENAME = "scheduler.lock"  # in the instance dir
+RETRY_INTERVAL = 10  # seconds between attempts to become the leader
+
+_elected_callbacks = list()
+
+
+def on_elected(func):
+    """Decorator registering func to be called, within the app context, in the
+    process that becomes the leader."""
+    _elected_callbacks.append(func)
+    return func
+
+
+def run_elected_callbacks():
+    for func in _elected_callbacks:
+        try:
+            func()
+        except Exception:
+            current_app.logger.error(
+                "setting up %s.%s failed:\n%s"
+                % (func.__module__, func.__name__, traceback.format_exc())
+            )
+
+
+def lead(lock):
+    """Waits until this process holds lock, then runs the on_elected
+    callbacks.  Called within the app context."""
+    while not lock.try_acquire():
+        time.sleep(RETRY_INTERVAL)
+    current_app.logger.info("process %d is running the background jobs" % os.getpid())
+    run_elected_callbacks()
+
+
+class LeaderLock(object):
+    """An exclusive lock on the file at path, held until the process exits."""
+
+    def __init__(self, path):
+        self.path = path
+        self.__fd = None
+
+    @property
+    def is_leader(self):
+        return self.__fd is not None
+
+    def try_acquire(self):
+        """Returns True if this process is, or has just become, the leader."""
+        if self.__fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return False
+        # note who the leader is for anyone looking
+        os.ftruncate(fd, 0)
+        os.write(fd, "%d\n" % os.getpid())
+        self.__fd = fd
+        return True
+
+    def release(self):
+        """Gives up the lock, which otherwise lasts until the process exits."""
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
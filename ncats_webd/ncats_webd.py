@@ -13,7 +13,11 @@ import logging
 
 from cyhy.core import *
 from cyhy.db import database
-from common import cache, socketio
+from cache_backends import shared_backend
+from common import cache, socketio, process_pool, cache_config, read_config_section
+import refresh
+import leader
+import perf
 
 
 def create_app(
@@ -24,12 +28,17 @@ def create_app(
     config_filename=None,
     section=None,
     new_hire_section=None,
+    workers=1,
 ):
     app = Flask(__name__, instance_path="/var/cyhy/web")
     gunicorn_logger = logging.getLogger("gunicorn.error")
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
-    cache.init_app(app)
+    using_yaml = str(config_filename).lower().endswith((".yml", ".yaml"))
+    settings = read_config_section(config_filename, section, yaml=using_yaml)
+    cache.init_app(app, config=cache_config(settings))
+    with app.app_context():
+        perf.start_publishing(shared_backend(cache.cache), app.logger)
 
     # Manually setting cors_allowed_origins to allow all due to a change in July
     # (2019) per https://github.com/miguelgrinberg/python-engineio/commit/7548f704a0a3000b7ac8a6c88796c4ae58aa9c37
@@ -38,11 +47,35 @@ def create_app(
     # application does not work with this change so I am forcing an equivalent to
     # the old behavior. We may want to look into providing CORS for websocket
     # connections in the future.
-    socketio.init_app(app, async_mode=async_mode, cors_allowed_origins="*")
+    #
+    # With more than one worker, emits have to go through a message queue to
+    # reach clients connected to the other workers, and clients have to stick
+    # to one worker, which only the websocket transport does under gunicorn.
+    message_queue = settings.get("socketio-message-queue")
+    if workers > 1 and not message_queue:
+        print >> sys.stderr, (
+            "Error: %d workers need a socketio-message-queue setting." % workers
+        )
+        sys.exit(1)
+    socketio.init_app(
+        app,
+        async_mode=async_mode,
+        cors_allowed_origins="*",
+        message_queue=message_queue,
+    )
+    if workers > 1:
+        app.config["SOCKETIO_TRANSPORTS"] = ["websocket"]
+    else:
+        app.config["SOCKETIO_TRANSPORTS"] = ["polling", "websocket"]
+
+    @app.context_processor
+    def socketio_settings():
+        return {"socketio_transports": app.config["SOCKETIO_TRANSPORTS"]}
 
     install_secret_key(app, secret_key)
     register_blueprints(app)
-    using_yaml = str(config_filename).lower().endswith((".yml", ".yaml"))
+    # before the database clients are created, so their commands are timed
+    perf.register_mongo_listener()
     app.db = database.db_from_config(
         section, config_filename=config_filename, yaml=using_yaml
     )
@@ -50,6 +83,10 @@ def create_app(
     app.new_hire_db = database.db_from_config(
         new_hire_section, config_filename=config_filename, yaml=using_yaml
     )
+    process_pool.configure(
+        settings,
+        {"section": section, "config_filename": config_filename, "yaml": using_yaml},
+    )
     app.logger.debug(app.new_hire_db)
     app.logger.debug(app.db)
     start_scheduler(app)
@@ -117,14 +154,24 @@ def register_blueprints(app):
     from blueprints.hiringdashboard import hiringdashboard
 
     app.register_blueprint(hiringdashboard.bp, url_prefix="/hiringdashboard")
+    from blueprints.debug import debug
+
+    app.register_blueprint(debug.bp, url_prefix="/debug")
 
 
 def start_scheduler(app):
+    leader_lock = leader.LeaderLock(
+        os.path.join(app.instance_path, leader.LOCK_FILENAME)
+    )
+
     def scheduler_loop(app):
         # run scheduler within the app context so jobs have access to caches, etc...
         with app.app_context():
             app.logger.debug("scheduler daemon thread started")
             current_app.logger.debug("scheduler daemon thread started")
+            # only one worker process runs the background jobs
+            leader.lead(leader_lock)
+            refresh.start()
             while True:
                 schedule.run_pending()
                 time.sleep(1)
@@ -0,0 +1,222 @@
+"""Runs CPU-bound computations in a pool of worker processes.
+
+The server runs under gevent, so a long pandas computation in one greenlet
+stops all the others, websocket heartbeats included, until it finishes.
+ProcessPool.run() sends the function and its arguments to one of a bounded
+set of persistent worker processes instead, and the calling greenlet waits
+for the pickled result without blocking the rest of the server.
+
+Functions and their arguments are pickled, so the functions must be defined
+at the top level of a module (and not wrapped by a decorator) to be found in
+the worker.  Fetching the tickets is usually as much of the work as
+transforming them, so rather than shipping the documents to the worker the
+function is given the database: an argument of DB is replaced, in the
+worker, with the worker's own connection to the application's database.
+
+A call that runs longer than the pool's timeout raises TaskTimeout.  A call
+that times out or whose greenlet is killed has its worker process killed, so
+abandoned computations don't keep running; a new worker replaces it.  With a
+pool size of 0, functions run in the calling greenlet as before.
+"""
+
+import cPickle as pickle
+import os
+import struct
+import sys
+import traceback
+
+from flask import current_app
+import gevent
+from gevent.lock import BoundedSemaphore
+from gevent import subprocess
+
+DEFAULT_SIZE = 2  # worker processes
+DEFAULT_TIMEOUT = 300  # seconds before a call is abandoned
+WORKER_COMMAND = "from ncats_webd.offload import serve; serve()"
+_HEADER = struct.Struct("!I")
+
+
+class DB(object):
+    """Stands for the application's main database in the arguments of
+    ProcessPool.run()."""
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class OffloadError(Exception):
+    """The worker process failed, or an error it raised can't be sent back."""
+
+
+def _bind(args, kwargs, db):
+    args = [db if arg is DB else arg for arg in args]
+    kwargs = dict((k, db if v is DB else v) for k, v in kwargs.items())
+    return args, kwargs
+
+
+def _uses_db(args, kwargs):
+    return any(arg is DB for arg in args) or any(v is DB for v in kwargs.values())
+
+
+def _read_exactly(stream, size):
+    chunks = list()
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def _read_frame(stream):
+    (size,) = _HEADER.unpack(_read_exactly(stream, _HEADER.size))
+    return pickle.loads(_read_exactly(stream, size))
+
+
+def _write_frame(stream, data):
+    stream.write(_HEADER.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+###############################################################################
+#  Worker process
+###############################################################################
+
+
+def serve():
+    """Main loop of a worker process: answer calls read from stdin on stdout
+    until stdin is closed."""
+    requests = os.fdopen(os.dup(0), "rb")
+    replies = os.fdopen(os.dup(1), "wb")
+    # anything the functions print goes to stderr, out of the way of replies
+    os.dup2(2, 1)
+    db_config = _read_frame(requests)
+    db = None
+    while True:
+        try:
+            function, args, kwargs = _read_frame(requests)
+        except EOFError:
+            return
+        try:
+            if db is None and _uses_db(args, kwargs):
+                from cyhy.db import database
+
+                db = database.db_from_config(
+                    db_config["section"],
+                    config_filename=db_config["config_filename"],
+                    yaml=db_config["yaml"],
+                )
+            args, kwargs = _bind(args, kwargs, db)
+            reply = ("ok", function(*args, **kwargs), None)
+        except Exception as e:
+            reply = ("error", e, traceback.format_exc())
+        try:
+            data = pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = pickle.dumps(
+                ("error", OffloadError("unpicklable result"), traceback.format_exc()),
+                pickle.HIGHEST_PROTOCOL,
+            )
+        _write_frame(replies, data)
+
+
+###############################################################################
+#  Server side
+###############################################################################
+
+
+class Worker(object):
+    """A worker process and the pipes to it."""
+
+    def __init__(self, db_config):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+        self.__process = subprocess.Popen(
+            [sys.executable, "-c", WORKER_COMMAND],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            close_fds=True,
+        )
+        _write_frame(
+            self.__process.stdin, pickle.dumps(db_config, pickle.HIGHEST_PROTOCOL)
+        )
+
+    def call(self, function, args, kwargs):
+        """Returns the (status, value, traceback) reply to the call."""
+        _write_frame(
+            self.__process.stdin,
+            pickle.dumps((function, args, kwargs), pickle.HIGHEST_PROTOCOL),
+        )
+        try:
+            return _read_frame(self.__process.stdout)
+        except EOFError:
+            raise OffloadError("worker process exited with %s" % self.__process.poll())
+        except (pickle.UnpicklingError, AttributeError, ImportError, TypeError):
+            # an exception type that can't be rebuilt on this side
+            raise OffloadError("unreadable reply:\n%s" % traceback.format_exc())
+
+    def kill(self):
+        try:
+            self.__process.kill()
+        except OSError:
+            pass  # already gone
+        self.__process.wait()
+
+
+class ProcessPool(object):
+    """A bounded pool of worker processes, started as they are needed."""
+
+    def __init__(self):
+        self.size = 0
+        self.timeout = DEFAULT_TIMEOUT
+        self.__db_config = None
+        self.__idle = list()
+        self.__slots = None
+
+    def configure(self, settings, db_config):
+        """Size the pool from the process-pool-size and process-pool-timeout
+        settings.  db_config holds the section, config_filename and yaml
+        arguments of database.db_from_config() for the workers."""
+        self.size = int(settings.get("process-pool-size", DEFAULT_SIZE))
+        self.timeout = int(settings.get("process-pool-timeout", DEFAULT_TIMEOUT))
+        self.__db_config = db_config
+        self.__slots = BoundedSemaphore(self.size) if self.size > 0 else None
+
+    def run(self, function, *args, **kwargs):
+        """Returns function(*args, **kwargs), computed in a worker process.
+        Errors raised by function are raised again here."""
+        if self.__slots is None:
+            args, kwargs = _bind(args, kwargs, current_app.db)
+            return function(*args, **kwargs)
+
+        timeout = TaskTimeout(
+            "%s timed out after %d seconds" % (function.__name__, self.timeout)
+        )
+        # waiting for a free worker counts towards the timeout
+        with gevent.Timeout(self.timeout, timeout):
+            with self.__slots:
+                if self.__idle:
+                    worker = self.__idle.pop()
+                else:
+                    worker = Worker(self.__db_config)
+                try:
+                    status, value, remote_traceback = worker.call(
+                        function, args, kwargs
+                    )
+                except BaseException:
+                    # timed out, cancelled or broken: the worker may still be
+                    # busy, so it can't be reused
+                    worker.kill()
+                    raise
+                self.__idle.append(worker)
+        if status == "error":
+            current_app.logger.error(
+                "%s failed in a worker process:\n%s"
+                % (function.__name__, remote_traceback)
+            )
+            raise value
+        return value
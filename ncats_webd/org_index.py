@@ -0,0 +1,251 @@
+"""In-process index of the organization hierarchy stored in the requests
+collection.
+
+The index is loaded with a single query and answers the descendant and
+organization type lookups that used to be made through RequestDoc on every
+page load.  It is reloaded when it gets older than MAX_AGE, or sooner when the
+requests collection has changed: a change stream on the collection reports
+every change where the server supports them (a replica set), and otherwise
+the number of requests and the greatest _id show organizations being added
+or removed.  Neither check reads the requests or locks the database.
+"""
+
+import threading
+import time
+
+import pymongo
+
+from cyhy.core.common import AGENCY_TYPE
+
+MAX_AGE = 60 * 60  # seconds before the index is reloaded unconditionally
+CHECK_INTERVAL = 60  # seconds between checks for changes to the collection
+CHANGE_STREAM_WAIT = 10  # milliseconds to wait for a change on each check
+AGENCY_TYPES = (
+    AGENCY_TYPE.FEDERAL,
+    AGENCY_TYPE.STATE,
+    AGENCY_TYPE.LOCAL,
+    AGENCY_TYPE.TRIBAL,
+    AGENCY_TYPE.TERRITORIAL,
+    AGENCY_TYPE.PRIVATE,
+)
+SLTT_TYPES = (
+    AGENCY_TYPE.STATE,
+    AGENCY_TYPE.LOCAL,
+    AGENCY_TYPE.TRIBAL,
+    AGENCY_TYPE.TERRITORIAL,
+)
+CRITICAL_INFRASTRUCTURE = "CRITICAL_INFRASTRUCTURE"
+REQUEST_PROJECTION = {"children": True, "retired": True, "stakeholder": True}
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+class OrgIndex(object):
+    def __init__(self, db, max_age=MAX_AGE, check_interval=CHECK_INTERVAL):
+        self.__db = db
+        self.__max_age = max_age
+        self.__check_interval = check_interval
+        self.__lock = threading.Lock()
+        self.__loaded_at = None
+        self.__checked_at = None
+        self.__fingerprint = None
+        self.__stream = None
+        self.__children = dict()
+        self.__stakeholders = list()
+        self.__stakeholder_set = frozenset()
+        # descendants[include_retired][owner] -> list of descendants
+        self.__descendants = {False: dict(), True: dict()}
+        self.__descendant_sets = {False: dict(), True: dict()}
+
+    def __collection_fingerprint(self):
+        # both come from the collection's metadata and the _id index
+        requests = self.__db.requests
+        try:
+            last = list(requests.find({}, {"_id": True}).sort("_id", -1).limit(1))
+            # estimated_document_count() replaces count() in pymongo 3.7
+            count = getattr(requests, "estimated_document_count", requests.count)()
+            return (count, last[0]["_id"] if last else None)
+        except Exception:
+            return None
+
+    def __open_change_stream(self):
+        # ChangeStream.try_next() is needed to check without blocking
+        if pymongo.version_tuple < (3, 9):
+            return None
+        try:
+            return self.__db.requests.watch(max_await_time_ms=CHANGE_STREAM_WAIT)
+        except Exception:
+            return None  # not a replica set, or not allowed
+
+    def __has_changed(self):
+        if self.__stream is not None:
+            try:
+                changed = False
+                while self.__stream.try_next() is not None:
+                    changed = True
+                return changed
+            except Exception:
+                self.__stream.close()
+                self.__stream = None  # reopened by the next load
+        fingerprint = self.__collection_fingerprint()
+        return fingerprint is None or fingerprint != self.__fingerprint
+
+    def __load(self):
+        if self.__stream is None:
+            # before reading, so no change made after the read is missed
+            self.__stream = self.__open_change_stream()
+        fingerprint = self.__collection_fingerprint()
+        requests = dict()
+        stakeholders = list()
+        for r in self.__db.requests.find({}, REQUEST_PROJECTION):
+            requests[r["_id"]] = r
+            if r.get("stakeholder"):
+                stakeholders.append(r["_id"])
+
+        descendants = {False: dict(), True: dict()}
+
+        def descendants_of(owner, include_retired, visiting):
+            known = descendants[include_retired]
+            if owner in known:
+                return known[owner]
+            result = list()
+            visiting.add(owner)
+            for child_id in requests.get(owner, {}).get("children") or []:
+                child = requests.get(child_id)
+                if child is None or child_id in visiting:
+                    continue
+                if not include_retired and child.get("retired"):
+                    continue
+                result.append(child_id)
+                result += descendants_of(child_id, include_retired, visiting)
+            visiting.discard(owner)
+            known[owner] = result
+            return result
+
+        for include_retired in (False, True):
+            for owner in requests:
+                descendants_of(owner, include_retired, set())
+
+        self.__children = dict(
+            (owner, list(r.get("children") or [])) for owner, r in requests.items()
+        )
+        self.__stakeholders = stakeholders
+        self.__stakeholder_set = frozenset(stakeholders)
+        self.__descendants = descendants
+        self.__descendant_sets = dict(
+            (include_retired, dict((k, frozenset(v)) for k, v in d.items()))
+            for include_retired, d in descendants.items()
+        )
+        self.__fingerprint = fingerprint
+        self.__loaded_at = self.__checked_at = time.time()
+
+    def refresh(self):
+        with self.__lock:
+            self.__load()
+
+    def refresh_if_stale(self):
+        now = time.time()
+        if (
+            self.__loaded_at is not None
+            and now - self.__loaded_at < self.__max_age
+            and now - self.__checked_at < self.__check_interval
+        ):
+            return
+        with self.__lock:
+            now = time.time()
+            if self.__loaded_at is None or now - self.__loaded_at >= self.__max_age:
+                self.__load()
+            elif now - self.__checked_at >= self.__check_interval:
+                if self.__has_changed():
+                    self.__load()
+                else:
+                    self.__checked_at = now
+
+    ###########################################################################
+    #  Lookups
+    ###########################################################################
+
+    def get_children(self, owner):
+        """returns the direct children of owner (including retired ones)"""
+        self.refresh_if_stale()
+        return list(self.__children.get(owner, []))
+
+    def get_all_descendants(self, owner, include_retired=False):
+        """same result as RequestDoc.get_all_descendants()"""
+        self.refresh_if_stale()
+        return list(self.__descendants[include_retired].get(owner, []))
+
+    def is_descendant(self, owner, ancestor, include_retired=False):
+        self.refresh_if_stale()
+        return owner in self.__descendant_sets[include_retired].get(
+            ancestor, frozenset()
+        )
+
+    def is_stakeholder(self, owner):
+        self.refresh_if_stale()
+        return owner in self.__stakeholder_set
+
+    def get_stakeholders(self):
+        self.refresh_if_stale()
+        return list(self.__stakeholders)
+
+    def get_owner_types(
+        self, as_lists=False, stakeholders_only=False, include_retired=False
+    ):
+        """same result as RequestDoc.get_owner_types()"""
+        self.refresh_if_stale()
+        types = dict()
+        for agency_type in AGENCY_TYPES:
+            owners = self.__descendant_sets[include_retired].get(
+                agency_type, frozenset()
+            )
+            if stakeholders_only:
+                owners = owners & self.__stakeholder_set
+            types[agency_type] = list(owners) if as_lists else set(owners)
+        return types
+
+    def get_owner_to_type_dict(self, stakeholders_only=False, include_retired=False):
+        """same result as RequestDoc.get_owner_to_type_dict()"""
+        result = dict()
+        for agency_type, owners in self.get_owner_types(
+            stakeholders_only=stakeholders_only, include_retired=include_retired
+        ).items():
+            for owner in owners:
+                result[owner] = agency_type
+        return result
+
+    def get_sltt(self, stakeholders_only=False, include_retired=False):
+        types = self.get_owner_types(
+            as_lists=True,
+            stakeholders_only=stakeholders_only,
+            include_retired=include_retired,
+        )
+        result = list()
+        for agency_type in SLTT_TYPES:
+            result += types[agency_type]
+        return result
+
+    def get_ci_sectors(self, as_lists=False, stakeholders_only=False):
+        """returns a dict of critical infrastructure sectors to their descendant
+        orgs, like RequestDoc.get_owner_types() does for agency types"""
+        self.refresh_if_stale()
+        sectors = dict()
+        for sector in self.__children.get(CRITICAL_INFRASTRUCTURE, []):
+            owners = self.__descendant_sets[False].get(sector, frozenset())
+            if stakeholders_only:
+                owners = owners & self.__stakeholder_set
+            sectors[sector] = list(owners) if as_lists else set(owners)
+        return sectors
+
+
+def get_org_index(db):
+    """returns the shared OrgIndex for db, creating it on first use"""
+    index = _indexes.get(id(db))
+    if index is None:
+        with _indexes_lock:
+            if id(db) not in _indexes:
+                # keep a reference to db so its id can't be reused
+                _indexes[id(db)] = (db, OrgIndex(db))
+            index = _indexes[id(db)]
+    return index[1]
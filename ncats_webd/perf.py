@@ -0,0 +1,358 @@
+"""Timings and sizes of the work the server does, for /debug/perf.
+
+The cached data functions, MongoDB commands, socket.io broadcasts and
+scheduled jobs record their latencies (and result sizes) here in histograms,
+labelled with the function, command, event or job.  snapshot() returns them
+as a dict for the JSON endpoint, and prometheus_text() in the Prometheus text
+exposition format.
+
+Each worker process records its own figures, and start_publishing() has it
+copy them to the shared cache backend every PUBLISH_INTERVAL seconds, each
+worker to a cache entry of its own that expires if it stops.  The outputs
+cover every worker that has published lately, whichever of them serves the
+request, with each figure labelled with the pid of its worker, so the series
+of each process stay monotonic.
+"""
+
+from contextlib import contextmanager
+import copy
+import functools
+import os
+import threading
+import time
+import traceback
+
+try:
+    from pymongo import monitoring
+except ImportError:  # pymongo < 3.1
+    monitoring = None
+
+from ncats_webd.cache_backends import SharedSlots
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26)
+PUBLISH_INTERVAL = 15  # seconds between copies of a worker's figures
+WORKER_TIMEOUT = 4 * PUBLISH_INTERVAL  # seconds before a silent worker is left out
+MAX_WORKERS = 64  # workers whose figures are published at once
+
+# name -> (type, help, buckets)
+METRICS = {
+    "ncats_webd_data_function_seconds": (
+        "histogram",
+        "Time to return the result of a cached data function, by whether it "
+        "came from the cache (hit), was computed for the caller (miss) or was "
+        "recomputed ahead of time (refresh).",
+        TIME_BUCKETS,
+    ),
+    "ncats_webd_data_function_bytes": (
+        "histogram",
+        "Size of the results of the cached data functions.",
+        SIZE_BUCKETS,
+    ),
+    "ncats_webd_mongo_command_seconds": (
+        "histogram",
+        "Time for MongoDB to answer a command, by command and collection.",
+        TIME_BUCKETS,
+    ),
+    "ncats_webd_mongo_command_failures_total": (
+        "counter",
+        "MongoDB commands that failed, by command and collection.",
+        None,
+    ),
+    "ncats_webd_broadcast_seconds": (
+        "histogram",
+        "Time to diff and emit a socket.io broadcast.",
+        TIME_BUCKETS,
+    ),
+    "ncats_webd_broadcast_bytes": (
+        "histogram",
+        "Size of the socket.io broadcasts sent, as whole copies or patches.",
+        SIZE_BUCKETS,
+    ),
+    "ncats_webd_broadcast_skipped_total": (
+        "counter",
+        "Broadcasts not sent because their content hadn't changed.",
+        None,
+    ),
+    "ncats_webd_job_seconds": (
+        "histogram",
+        "Time taken by the scheduled jobs.",
+        TIME_BUCKETS,
+    ),
+    "ncats_webd_job_failures_total": (
+        "counter",
+        "Scheduled jobs that raised an exception.",
+        None,
+    ),
+}
+
+_lock = threading.Lock()
+_values = dict()  # (name, sorted label items) -> Histogram or counter value
+_workers = SharedSlots("perf_worker:", MAX_WORKERS)  # pid -> _values
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)  # not cumulative
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        counts = list()
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def observe(name, value, **labels):
+    """Add value to the histogram name for labels."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _values.get(key)
+        if histogram is None:
+            histogram = _values[key] = Histogram(METRICS[name][2])
+        histogram.observe(value)
+
+
+def increment(name, amount=1, **labels):
+    """Add amount to the counter name for labels."""
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+@contextmanager
+def timer(name, **labels):
+    """Context manager adding the time taken by its block to the histogram
+    name, whether or not the block raises."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def payload_size(value):
+    """Returns the size in bytes of a string or response result, or None."""
+    if isinstance(value, basestring):
+        return len(value)
+    content_length = getattr(value, "content_length", None)
+    if isinstance(content_length, (int, long)):
+        return content_length
+    return None
+
+
+def function_name(func):
+    return "%s.%s" % (func.__module__, func.__name__)
+
+
+###############################################################################
+#  Memoized functions
+###############################################################################
+
+_calls = threading.local()  # greenlet local under gevent
+
+
+def instrument_memoized(func, memoize):
+    """Returns func memoized with the memoize decorator, recording whether
+    each call was answered from the cache."""
+    name = function_name(func)
+
+    @functools.wraps(func)
+    def compute(*args, **kwargs):
+        _calls.computed = True
+        return func(*args, **kwargs)
+
+    memoized = memoize(compute)
+
+    @functools.wraps(memoized)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_calls, "computed", False)
+        _calls.computed = False
+        start = time.time()
+        try:
+            value = memoized(*args, **kwargs)
+            result = "miss" if _calls.computed else "hit"
+        finally:
+            _calls.computed = outer
+        observe(
+            "ncats_webd_data_function_seconds",
+            time.time() - start,
+            function=name,
+            result=result,
+        )
+        size = payload_size(value)
+        if size is not None:
+            observe("ncats_webd_data_function_bytes", size, function=name)
+        return value
+
+    return wrapper
+
+
+###############################################################################
+#  MongoDB commands
+###############################################################################
+
+if monitoring is not None:
+
+    class CommandTimer(monitoring.CommandListener):
+        """Records the time taken by each command sent to MongoDB."""
+
+        def __init__(self):
+            self.__collections = dict()  # (connection, request id) -> collection
+
+        def started(self, event):
+            collection = event.command.get(event.command_name)
+            if not isinstance(collection, basestring):
+                # getMore and the like name it separately
+                collection = event.command.get("collection", "")
+            self.__collections[(event.connection_id, event.request_id)] = collection
+
+        def __labels(self, event):
+            collection = self.__collections.pop(
+                (event.connection_id, event.request_id), ""
+            )
+            return {"command": event.command_name, "collection": collection}
+
+        def succeeded(self, event):
+            observe(
+                "ncats_webd_mongo_command_seconds",
+                event.duration_micros / 1e6,
+                **self.__labels(event)
+            )
+
+        def failed(self, event):
+            increment("ncats_webd_mongo_command_failures_total", **self.__labels(event))
+
+
+def register_mongo_listener():
+    """Time the commands of the MongoClients created from now on."""
+    if monitoring is not None:
+        monitoring.register(CommandTimer())
+
+
+###############################################################################
+#  Sharing between workers
+###############################################################################
+
+
+def local_values():
+    """Returns a copy of the figures of this process."""
+    with _lock:
+        return copy.deepcopy(_values)
+
+
+def publish(backend):
+    """Copy the figures of this process to backend, the shared cache backend
+    (not a TieredCache, whose memory tier the other processes can't see)."""
+    if not _workers.publish(backend, os.getpid(), local_values(), WORKER_TIMEOUT):
+        raise RuntimeError("more than %d workers are publishing" % MAX_WORKERS)
+
+
+def start_publishing(backend, logger):
+    """Start the thread copying the figures of this process to backend."""
+
+    def run():
+        while True:
+            try:
+                publish(backend)
+            except Exception:
+                logger.error("publishing timings failed:\n%s" % traceback.format_exc())
+            time.sleep(PUBLISH_INTERVAL)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
+def worker_values(backend):
+    """Returns a dict of pid to the figures of each worker that has published
+    to backend lately, and of this process."""
+    result = _workers.values(backend)
+    result[os.getpid()] = local_values()
+    return result
+
+
+###############################################################################
+#  Output
+###############################################################################
+
+
+def _labelled_items(workers):
+    items = list()
+    for pid, values in workers.items():
+        for (name, labels), value in values.items():
+            items.append(((name, labels + (("pid", str(pid)),)), value))
+    return sorted(items)
+
+
+def snapshot(workers):
+    """Returns the metrics of workers (see worker_values) as a dict of name to
+    a list of the labels and values recorded for it."""
+    result = dict()
+    for (name, labels), value in _labelled_items(workers):
+        entry = {"labels": dict(labels)}
+        if isinstance(value, Histogram):
+            entry["count"] = value.count
+            entry["sum"] = value.sum
+            entry["buckets"] = [
+                [bound, count]
+                for bound, count in zip(value.buckets, value.cumulative_counts())
+            ]
+        else:
+            entry["value"] = value
+        result.setdefault(name, list()).append(entry)
+    return result
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (k, unicode(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+
+
+def prometheus_text(workers):
+    """Returns the metrics of workers (see worker_values) in the Prometheus
+    text exposition format."""
+    lines = list()
+    previous = None
+    for (name, labels), value in _labelled_items(workers):
+        if name != previous:
+            metric_type, help_text, buckets = METRICS[name]
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            previous = name
+        if isinstance(value, Histogram):
+            for bound, count in zip(value.buckets, value.cumulative_counts()):
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (name, _format_labels(labels + (("le", repr(bound)),)), count)
+                )
+            lines.append(
+                "%s_bucket%s %d"
+                % (name, _format_labels(labels + (("le", "+Inf"),)), value.count)
+            )
+            lines.append("%s_sum%s %r" % (name, _format_labels(labels), value.sum))
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), value.count))
+        else:
+            lines.append("%s%s %r" % (name, _format_labels(labels), value))
+    return "\n".join(lines) + "\n"
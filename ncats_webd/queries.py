@@ -1,40 +1,48 @@
 from cyhy.core import STAGE, STATUS
 from cyhy.core.common import REPORT_TYPE
 
+from ncats_webd.org_index import get_org_index
+from ncats_webd import ticket_summary
+from ncats_webd.counting import count_distinct
+
+OPEN_TICKET_SEVERITY_NAMES = ((1, "low"), (2, "medium"), (3, "high"), (4, "critical"))
+
 
 class MapQueries:
     @staticmethod
-    def get_open_ticket_loc_by_severity(db, severity=None):
-        if severity != None:
-            tickets = db.TicketDoc.collection.find(
-                {
-                    "open": True,
-                    "source": "nessus",
-                    "details.severity": severity,
-                    "loc.0": {"$ne": None},
-                },
-                {"_id": 0, "loc": 1, "details.severity": 1},
-            )
-        else:
-            tickets = db.TicketDoc.collection.find(
-                {"open": True, "source": "nessus", "loc.0": {"$ne": None}},
-                {"_id": 0, "loc": 1, "details.severity": 1},
-            )
-        return list(tickets)
+    def get_open_ticket_locs_by_severity(db):
+        """Returns a dict of severity (1-4) to the locations of open tickets of
+        that severity, plus all open ticket locations under None, from a single
+        scan of the tickets."""
+        tickets = db.TicketDoc.collection.find(
+            {"open": True, "source": "nessus", "loc.0": {"$ne": None}},
+            {"_id": 0, "loc": 1, "details.severity": 1},
+        )
+        results = {None: [], 1: [], 2: [], 3: [], 4: []}
+        for ticket in tickets:
+            results[None].append(ticket)
+            severity = ticket.get("details", {}).get("severity")
+            if severity is not None and severity in results:
+                results[severity].append(ticket)
+        return results
 
     @staticmethod
-    def get_running_ips(db):
-        running_ips = db.HostDoc.collection.find(
+    def find_running_ips(db):
+        return db.HostDoc.collection.find(
             {"status": "RUNNING"}, {"_id": 0, "loc": 1, "stage": 1}
         )
-        return list(running_ips)
+
+    @staticmethod
+    def get_running_ips(db):
+        return list(MapQueries.find_running_ips(db))
+
+    @staticmethod
+    def find_host_locations(db):
+        return db.HostDoc.collection.find({"state.up": True}, {"_id": 0, "loc": 1})
 
     @staticmethod
     def get_host_locations(db):
-        host_locations = db.HostDoc.collection.find(
-            {"state.up": True}, {"_id": 0, "loc": 1}
-        )
-        return list(host_locations)
+        return list(MapQueries.find_host_locations(db))
 
 
 class HiringDashboardQueries:
@@ -60,73 +68,76 @@ class HiringDashboardQueries:
 class DashboardQueries:
     @staticmethod
     def build_stakeholder_list(db):
-        stakeholders = []
-        for r in db.requests.find({"stakeholder": True}):
-            stakeholders.append(r["_id"])
-        return stakeholders
+        return get_org_index(db).get_stakeholders()
+
+    @staticmethod
+    def scan_owner_severity_counts(db):
+        """Returns a dict of owner to its open critical and high ticket counts,
+        counted from the tickets in one pass."""
+        owner_counts = dict()
+        for owner in db.tickets.aggregate(
+            [
+                {
+                    "$match": {
+                        "open": True,
+                        "source": "nessus",
+                        "false_positive": False,
+                        "details.severity": {"$in": [3, 4]},
+                    }
+                },
+                {
+                    "$group": {
+                        "_id": "$owner",
+                        "critical_tix_open": {
+                            "$sum": {"$cond": [{"$eq": ["$details.severity", 4]}, 1, 0]}
+                        },
+                        "high_tix_open": {
+                            "$sum": {"$cond": [{"$eq": ["$details.severity", 3]}, 1, 0]}
+                        },
+                    }
+                },
+            ],
+            cursor={},
+        ):
+            owner_counts[owner["_id"]] = owner
+        return owner_counts
+
+    @staticmethod
+    def get_owner_severity_counts(db):
+        if not ticket_summary.is_fresh(db):
+            return DashboardQueries.scan_owner_severity_counts(db)
+        owner_counts = dict()
+        for owner, counts in ticket_summary.owner_severity_counts(db, (3, 4)).items():
+            owner_counts[owner] = {
+                "critical_tix_open": counts.get(4, 0),
+                "high_tix_open": counts.get(3, 0),
+            }
+        return owner_counts
 
     @staticmethod
     def get_ticket_severity_counts(db, stakeholders):
+        # Get the open critical/high ticket counts for every owner at once,
+        # then roll them up to each stakeholder and its descendants
+        org_index = get_org_index(db)
+        owner_counts = DashboardQueries.get_owner_severity_counts(db)
+
         results = dict()
         results["ticket_data"] = dict()
         for org in stakeholders:  # db.requests.find({'stakeholder':True}):
+            current_org_set = set([org["_id"]])
             if org.get("children"):
-                current_org_list = [org["_id"]] + db.RequestDoc.get_all_descendants(
-                    org["_id"]
-                )
-            else:
-                current_org_list = [org["_id"]]
-            tix = list(
-                db.tickets.aggregate(
-                    [
-                        {
-                            "$match": {
-                                "open": True,
-                                "source": "nessus",
-                                "owner": {"$in": current_org_list},
-                                "false_positive": False,
-                            }
-                        },
-                        {
-                            "$group": {
-                                "_id": {},
-                                "critical_tix_open": {
-                                    "$sum": {
-                                        "$cond": [
-                                            {"$eq": ["$details.severity", 4]},
-                                            1,
-                                            0,
-                                        ]
-                                    }
-                                },
-                                "high_tix_open": {
-                                    "$sum": {
-                                        "$cond": [
-                                            {"$eq": ["$details.severity", 3]},
-                                            1,
-                                            0,
-                                        ]
-                                    }
-                                },
-                            }
-                        },
-                    ],
-                    cursor={},
-                )
-            )
-
-            if len(tix) > 0:
-                results["ticket_data"][org["_id"]] = {
-                    "org_name": org["agency"]["name"],
-                    "critical_open": tix[0].get("critical_tix_open", 0),
-                    "high_open": tix[0].get("high_tix_open", 0),
-                }
-            else:
-                results["ticket_data"][org["_id"]] = {
-                    "org_name": org["agency"]["name"],
-                    "critical_open": 0,
-                    "high_open": 0,
-                }
+                current_org_set.update(org_index.get_all_descendants(org["_id"]))
+            critical_open = high_open = 0
+            for owner in current_org_set:
+                counts = owner_counts.get(owner)
+                if counts:
+                    critical_open += counts["critical_tix_open"]
+                    high_open += counts["high_tix_open"]
+            results["ticket_data"][org["_id"]] = {
+                "org_name": org["agency"]["name"],
+                "critical_open": critical_open,
+                "high_open": high_open,
+            }
 
         # Reverse sort on critical_open, then high_open, then normal (alphabetical) sort on org_name
         sorted_ticket_data = sorted(
@@ -141,62 +152,48 @@ class DashboardQueries:
         results["stakeholders"] = len(stakeholders)
         results["addresses"] = db.hosts.count()
         results["hosts"] = db.hosts.find({"state.up": True}).count()
-        results["vulnerable_hosts"] = len(
-            db.tickets.find({"open": True, "false_positive": False}).distinct("ip_int")
-        )
-
-        tix = list(
-            db.tickets.aggregate(
-                [
-                    {
-                        "$match": {
-                            "open": True,
-                            "source": "nessus",
-                            "false_positive": False,
-                        }
-                    },
-                    {
-                        "$group": {
-                            "_id": {},
-                            "low_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 1]}, 1, 0]
-                                }
-                            },
-                            "medium_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 2]}, 1, 0]
-                                }
-                            },
-                            "high_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 3]}, 1, 0]
-                                }
-                            },
-                            "critical_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 4]}, 1, 0]
-                                }
-                            },
-                            "total_tix_open": {"$sum": 1},
-                        }
-                    },
-                ],
-                cursor={},
+        if ticket_summary.is_fresh(db):
+            results["vulnerable_hosts"] = ticket_summary.vulnerable_host_count(db)
+            results["open_tickets"] = DashboardQueries.name_open_ticket_counts(
+                ticket_summary.severity_counts(db)
             )
-        )
-
-        results["open_tickets"] = {
-            "low": tix[0]["low_tix_open"],
-            "medium": tix[0]["medium_tix_open"],
-            "high": tix[0]["high_tix_open"],
-            "critical": tix[0]["critical_tix_open"],
-            "total": tix[0]["total_tix_open"],
-        }
+        else:
+            results["vulnerable_hosts"] = count_distinct(
+                db.tickets, "ip_int", {"open": True, "false_positive": False}
+            )
+            results["open_tickets"] = DashboardQueries.scan_open_ticket_counts(db)
 
         results["reports"] = db.reports.find({"report_types": REPORT_TYPE.CYHY}).count()
         return results
 
+    @staticmethod
+    def name_open_ticket_counts(severity_counts):
+        """Returns the open ticket counts in a dict of severity to count, keyed
+        by severity name and with a total."""
+        open_tickets = dict()
+        for severity, name in OPEN_TICKET_SEVERITY_NAMES:
+            open_tickets[name] = severity_counts.get(severity, 0)
+        open_tickets["total"] = sum(severity_counts.values())
+        return open_tickets
+
+    @staticmethod
+    def scan_open_ticket_counts(db, owners=None):
+        """Counts the open tickets of owners (all owners when None) by severity
+        from the tickets."""
+        match = {"open": True, "source": "nessus", "false_positive": False}
+        if owners is not None:
+            match["owner"] = {"$in": owners}
+        severity_counts = dict()
+        for severity in db.tickets.aggregate(
+            [
+                {"$match": match},
+                {"$group": {"_id": "$details.severity", "count": {"$sum": 1}}},
+            ],
+            cursor={},
+        ):
+            severity_counts[severity["_id"]] = severity["count"]
+        return DashboardQueries.name_open_ticket_counts(severity_counts)
+
     @staticmethod
     def get_tally_details(db):
         results = dict()
@@ -253,94 +250,52 @@ class DashboardQueries:
 
     @staticmethod
     def build_election_list(db):
-        all_stakeholders = []
-        for r in db.requests.find({"stakeholder": True}):
-            all_stakeholders.append(r["_id"])
-
-        election_orgs = db.RequestDoc.get_all_descendants("ELECTION")
+        org_index = get_org_index(db)
+        election_orgs = org_index.get_all_descendants("ELECTION")
         # NOTE: Includes all orgs, not just stakeholders
 
-        election_stakeholders = list(set(all_stakeholders) & set(election_orgs))
+        election_stakeholders = list(
+            set(org_index.get_stakeholders()) & set(election_orgs)
+        )
 
         return election_stakeholders
 
     @staticmethod
     def get_election_metrics(db):
         results = dict()
-        all_stakeholders = []
-        for r in db.requests.find({"stakeholder": True}):
-            all_stakeholders.append(r["_id"])
-
-        election_orgs = db.RequestDoc.get_all_descendants("ELECTION")
+        org_index = get_org_index(db)
+        election_orgs = org_index.get_all_descendants("ELECTION")
         # NOTE: Includes all orgs, not just stakeholders
 
-        election_stakeholders = list(set(all_stakeholders) & set(election_orgs))
+        election_stakeholders = list(
+            set(org_index.get_stakeholders()) & set(election_orgs)
+        )
 
         results["stakeholders"] = len(election_stakeholders)
         results["addresses"] = db.hosts.find({"owner": {"$in": election_orgs}}).count()
         results["hosts"] = db.hosts.find(
             {"state.up": True, "owner": {"$in": election_orgs}}
         ).count()
-        results["vulnerable_hosts"] = len(
-            db.tickets.find(
-                {
-                    "open": True,
-                    "source": "nessus",
-                    "owner": {"$in": election_orgs},
-                    "false_positive": False,
-                }
-            ).distinct("ip_int")
+        # the summary can't tell how many of the addresses of several owners
+        # are distinct
+        results["vulnerable_hosts"] = count_distinct(
+            db.tickets,
+            "ip_int",
+            {
+                "open": True,
+                "source": "nessus",
+                "owner": {"$in": election_orgs},
+                "false_positive": False,
+            },
         )
-
-        tix = list(
-            db.tickets.aggregate(
-                [
-                    {
-                        "$match": {
-                            "open": True,
-                            "source": "nessus",
-                            "owner": {"$in": election_orgs},
-                            "false_positive": False,
-                        }
-                    },
-                    {
-                        "$group": {
-                            "_id": {},
-                            "low_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 1]}, 1, 0]
-                                }
-                            },
-                            "medium_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 2]}, 1, 0]
-                                }
-                            },
-                            "high_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 3]}, 1, 0]
-                                }
-                            },
-                            "critical_tix_open": {
-                                "$sum": {
-                                    "$cond": [{"$eq": ["$details.severity", 4]}, 1, 0]
-                                }
-                            },
-                            "total_tix_open": {"$sum": 1},
-                        }
-                    },
-                ],
-                cursor={},
+        if ticket_summary.is_fresh(db):
+            results["open_tickets"] = DashboardQueries.name_open_ticket_counts(
+                ticket_summary.severity_counts(db, election_orgs)
+            )
+        else:
+            results["open_tickets"] = DashboardQueries.scan_open_ticket_counts(
+                db, election_orgs
             )
-        )
-
-        results["open_tickets"] = {
-            "low": tix[0]["low_tix_open"],
-            "medium": tix[0]["medium_tix_open"],
-            "high": tix[0]["high_tix_open"],
-            "critical": tix[0]["critical_tix_open"],
-            "total": tix[0]["total_tix_open"],
-        }
 
         results["reports"] = db.reports.find({"owner": {"$in": election_orgs}}).count()
         return results
@@ -0,0 +1,302 @@
+"""Refresh-ahead caching for the expensive data functions.
+
+A function decorated with refresh_ahead(interval) keeps its last good result
+in the shared cache.  Callers always get that result; only the very first
+call for a set of arguments waits for a computation.  Every set of arguments
+a function is called with is registered, and the thread start() runs
+recomputes each one shortly before it is interval seconds old.  Only one
+computation of a given function and arguments runs at a time; callers that
+arrive while it runs wait for it and share its result.
+
+With several worker processes only the one running the background jobs
+refreshes.  The others share the keys they are called with, and when they
+last read them, through the shared backend (at most once per lead time, one
+cache entry per key), and the refresh thread picks those keys up as if they
+had been called there.  A result that is due is read from the shared backend
+rather than from the process's memory tier, so the other processes see the
+refreshed result as soon as it is stored.
+
+A set of arguments that hasn't been read in any process for IDLE_INTERVALS
+intervals is no longer refreshed, and its result is dropped, so the next call
+computes it afresh.  A result older than that, say because the refreshing
+process died, is never served either.  Use it for functions called with a
+small fixed set of arguments whose results are read often, such as the
+broadcast data; rarely viewed reports are better off memoized.
+"""
+
+import functools
+import threading
+import time
+import traceback
+
+from flask import current_app
+
+from ncats_webd.cache_backends import SharedSlots, shared_backend
+from ncats_webd.common import cache
+from ncats_webd import perf
+
+KEY_PREFIX = "refresh_ahead:"
+LEAD_FRACTION = 0.1  # refresh this fraction of the interval before it's due
+MIN_LEAD = 5  # seconds
+IDLE_INTERVALS = 3  # stop refreshing results not read for this many intervals
+POLL_INTERVAL = 1  # seconds between checks for due refreshes
+SHARED_KEYS_INTERVAL = MIN_LEAD  # seconds between reads of the shared keys
+MAX_SHARED_KEYS = 256
+
+_functions = dict()  # function name -> function, for the shared keys
+_registry = dict()  # cache key -> Registration
+_registry_lock = threading.Lock()
+# cache key -> (function, args, kwargs, interval, time last read)
+_shared_keys = SharedSlots("refresh_ahead_read:", MAX_SHARED_KEYS)
+_shared_keys_read_at = None
+
+
+class Registration(object):
+    """A function and the arguments it is refreshed with."""
+
+    def __init__(self, key, func, args, kwargs, interval):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.lead = max(MIN_LEAD, interval * LEAD_FRACTION)
+        self.computed_at = None
+        self.read_at = time.time()
+        self.shared_at = None  # when read_at was last shared
+        self.checked_at = None  # when the shared backend was last checked
+        self.lock = threading.Lock()
+
+    def is_due(self, now):
+        return self.computed_at is None or now >= (
+            self.computed_at + self.interval - self.lead
+        )
+
+    def is_overdue(self, now):
+        return self.computed_at is None or now >= self.computed_at + self.interval
+
+    def is_idle(self, now):
+        # read_at includes the reads the other processes shared
+        return now >= self.read_at + self.interval * IDLE_INTERVALS
+
+    def is_stale(self, now):
+        return now >= self.computed_at + self.interval * IDLE_INTERVALS
+
+    def read(self, now):
+        """Note a read at now, sharing it and the key with the other processes
+        if it hasn't been for a while."""
+        self.read_at = now
+        if self.shared_at is not None and now < self.shared_at + self.lead:
+            return
+        self.shared_at = now
+        shared = (
+            perf.function_name(self.func),
+            self.args,
+            self.kwargs,
+            self.interval,
+            now,
+        )
+        # it is idle, and need not be shared, once it expires
+        if not _shared_keys.publish(
+            shared_backend(cache.cache),
+            self.key,
+            shared,
+            self.interval * IDLE_INTERVALS,
+        ):
+            current_app.logger.warning(
+                "more than %d refresh-ahead keys; %s is only refreshed when "
+                "read" % (MAX_SHARED_KEYS, self.key)
+            )
+
+    def check_shared(self, now):
+        """Whether to look for a newer result in the shared backend; at most
+        once every POLL_INTERVAL."""
+        if self.checked_at is not None and now < self.checked_at + POLL_INTERVAL:
+            return False
+        self.checked_at = now
+        return True
+
+    def saw(self, computed_at):
+        """Note a result computed at computed_at, possibly by another process."""
+        if self.computed_at is None or computed_at > self.computed_at:
+            self.computed_at = computed_at
+
+    def compute(self):
+        """Compute and store the result, or if a computation is already running,
+        wait for it and return its result."""
+        started = time.time()
+        with self.lock:
+            if self.computed_at is not None and self.computed_at >= started:
+                entry = cache.get(self.key)
+                if entry is not None:
+                    return entry[1]
+            value = self.func(*self.args, **self.kwargs)
+            computed_at = time.time()
+            # keep the result until it is replaced, not just for the interval
+            cache.set(self.key, (computed_at, value), timeout=0)
+            self.saw(computed_at)
+            return value
+
+    def compute_quietly(self):
+        """Compute the result, logging any failure and keeping the last good one."""
+        try:
+            with perf.timer(
+                "ncats_webd_data_function_seconds",
+                function=perf.function_name(self.func),
+                result="refresh",
+            ):
+                self.compute()
+        except Exception:
+            current_app.logger.error(
+                "refresh of %s failed:\n%s" % (self.key, traceback.format_exc())
+            )
+
+    def compute_in_background(self):
+        if self.lock.locked():
+            return  # already being computed
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                self.compute_quietly()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+def make_key(func, args, kwargs):
+    return "%s%s.%s%r%r" % (
+        KEY_PREFIX,
+        func.__module__,
+        func.__name__,
+        args,
+        sorted(kwargs.items()),
+    )
+
+
+def register(func, args, kwargs, interval):
+    key = make_key(func, args, kwargs)
+    registration = _registry.get(key)
+    if registration is None:
+        with _registry_lock:
+            registration = _registry.get(key)
+            if registration is None:
+                registration = Registration(key, func, args, kwargs, interval)
+                _registry[key] = registration
+    return registration
+
+
+def get_shared(key):
+    """Returns the result in the shared backend, which may be newer than the
+    one in this process's memory tier."""
+    backend = cache.cache
+    return getattr(backend, "get_shared", backend.get)(key)
+
+
+def observe_call(func, seconds, result, value):
+    name = perf.function_name(func)
+    perf.observe(
+        "ncats_webd_data_function_seconds", seconds, function=name, result=result
+    )
+    size = perf.payload_size(value)
+    if size is not None:
+        perf.observe("ncats_webd_data_function_bytes", size, function=name)
+
+
+def refresh_ahead(interval):
+    """Decorator that serves the last good result of the function and has the
+    refresh thread recompute it every interval seconds while it is read."""
+
+    def decorator(func):
+        _functions[perf.function_name(func)] = func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            registration = register(func, args, kwargs, interval)
+            registration.read(start)
+            entry = cache.get(registration.key)
+            if entry is not None:
+                registration.saw(entry[0])
+                if registration.is_due(start) and registration.check_shared(start):
+                    # another process may have refreshed it
+                    entry = get_shared(registration.key)
+                    if entry is not None:
+                        registration.saw(entry[0])
+            if entry is None or registration.is_stale(start):
+                value = registration.compute()
+                result = "miss"
+            else:
+                computed_at, value = entry
+                if registration.is_overdue(time.time()):
+                    # the refresh thread hasn't kept up (or has only just started)
+                    registration.compute_in_background()
+                result = "hit"
+            observe_call(func, time.time() - start, result, value)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
+
+
+def unregister(registration):
+    with _registry_lock:
+        if _registry.get(registration.key) is registration:
+            del _registry[registration.key]
+    # its shared key has expired, as it is idle
+    cache.delete(registration.key)
+
+
+def register_shared():
+    """Register the keys the other processes have shared, and note when they
+    last read them."""
+    shared = _shared_keys.values(shared_backend(cache.cache))
+    for key, (name, args, kwargs, interval, read_at) in shared.items():
+        if name not in _functions:
+            continue
+        registration = _registry.get(key)
+        if registration is None:
+            registration = register(_functions[name], args, kwargs, interval)
+            registration.read_at = read_at
+        elif read_at > registration.read_at:
+            registration.read_at = read_at
+
+
+def run_pending():
+    """Recompute every registered result that is due, and drop those that are
+    idle.  Called from the refresh thread, within the app context."""
+    global _shared_keys_read_at
+    now = time.time()
+    if (
+        _shared_keys_read_at is None
+        or now >= _shared_keys_read_at + SHARED_KEYS_INTERVAL
+    ):
+        _shared_keys_read_at = now
+        register_shared()
+    for registration in list(_registry.values()):
+        now = time.time()
+        if registration.is_idle(now):
+            current_app.logger.debug("no longer refreshing %s" % registration.key)
+            unregister(registration)
+        elif registration.is_due(now):
+            registration.compute_quietly()
+
+
+def start():
+    """Start the thread that refreshes the registered results, apart from the
+    scheduler so the scheduled jobs don't wait for the refreshes.  Called
+    within the app context."""
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            while True:
+                run_pending()
+                time.sleep(POLL_INTERVAL)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
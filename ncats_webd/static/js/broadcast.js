@@ -0,0 +1,74 @@
+// Client side of the versioned broadcasts in ncats_webd/broadcast.py.
+//
+// subscribe_versioned(socket, event, latest_event, callback) calls callback
+// with the decoded payload whenever a whole copy (event) or a patch against
+// the copy this client holds (event + '_patch') arrives.  Patches against a
+// version this client doesn't have are dropped and a whole copy is requested
+// with latest_event.
+
+function apply_json_patch(doc, patch) {
+    patch.forEach(function(operation) {
+        var tokens = operation.path.split('/').slice(1).map(function(token) {
+            return token.replace(/~1/g, '/').replace(/~0/g, '~');
+        });
+        var key = tokens.pop();
+        var parent = doc;
+        tokens.forEach(function(token) {
+            parent = parent[token];
+        });
+        if (Array.isArray(parent)) {
+            if (operation.op === 'add') {
+                if (key === '-') {
+                    parent.push(operation.value);
+                } else {
+                    parent.splice(+key, 0, operation.value);
+                }
+            } else if (operation.op === 'remove') {
+                parent.splice(+key, 1);
+            } else {
+                parent[+key] = operation.value;
+            }
+        } else if (operation.op === 'remove') {
+            delete parent[key];
+        } else {
+            parent[key] = operation.value;
+        }
+    });
+}
+
+function subscribe_versioned(socket, event, latest_event, callback) {
+    var version = null;
+    var payload = null;
+
+    function deliver() {
+        // the callback gets its own copy so it can't corrupt the one we patch
+        callback(JSON.parse(JSON.stringify(payload)));
+    }
+
+    socket.on(event, function(msg) {
+        version = msg.version;
+        payload = msg.payload;
+        deliver();
+    });
+
+    socket.on(event + '_patch', function(msg) {
+        if (version === null || version === msg.version) {
+            return;  // a whole copy is on its way, or we already have this one
+        }
+        if (version !== msg.base) {
+            console.log('missed a version of ' + event + ', resyncing');
+            socket.emit(latest_event);
+            return;
+        }
+        try {
+            apply_json_patch(payload, msg.patch);
+        } catch (e) {
+            console.log('could not patch ' + event + ', resyncing', e);
+            version = null;
+            socket.emit(latest_event);
+            return;
+        }
+        version = msg.version;
+        deliver();
+    });
+}
@@ -0,0 +1,198 @@
+"""Materialized summary of the open tickets for the dashboards.
+
+rebuild() groups the open, non-false-positive tickets by owner, source,
+severity, kev and address into a scratch collection in one pass over the
+tickets, then counts each kind of row from that in a pass of its own.  The
+rows are gathered in a second scratch collection that replaces the
+ticket_summary collection once complete, so readers never see a partial
+summary and no stage has to fit all the rows in one document.  The collection
+holds a few rows per owner, so the dashboard queries read it instead of
+scanning tickets, and their cost doesn't grow with the number of tickets.
+Rows have a kind:
+
+    "counts"  open tickets and distinct addresses for each
+              (owner, source, severity, kev)
+    "owner"   distinct addresses for each (owner, source), and for each owner
+              over all sources (source None)
+    "all"     distinct addresses over all owners, for each source and over all
+              sources (source None)
+    "meta"    when the summary was built
+
+The scratch collections are named for each rebuild, so rebuilds that overlap
+(from two servers, say) don't write to each other's, and are dropped even if
+the rebuild fails.
+
+It is rebuilt as often as the dashboards refresh.  A summary older than
+MAX_AGE, or missing because rebuild() can't write to the database, is ignored
+and the callers fall back to scanning tickets.
+"""
+
+import time
+import uuid
+
+SUMMARY_COLLECTION = "ticket_summary"
+ADDRESSES_COLLECTION = "ticket_summary_addresses"  # scratch, + "_" + run id
+BUILD_COLLECTION = "ticket_summary_build"  # scratch, + "_" + run id
+REBUILD_INTERVAL = 30 * 60  # seconds, as the dashboards refresh
+MAX_AGE = 3 * REBUILD_INTERVAL  # seconds
+INSERT_BATCH_SIZE = 1000  # rows
+
+
+def addresses_pipeline(addresses_collection):
+    """pipeline grouping the open tickets by owner, source, severity, kev and
+    address into addresses_collection"""
+    return [
+        {"$match": {"open": True, "false_positive": False}},
+        {
+            "$group": {
+                "_id": {
+                    "owner": "$owner",
+                    "source": "$source",
+                    "severity": "$details.severity",
+                    "kev": {"$eq": ["$details.kev", True]},
+                    "ip": "$ip_int",
+                },
+                "open": {"$sum": 1},
+            }
+        },
+        {"$out": addresses_collection},
+    ]
+
+
+def counts_pipeline():
+    """pipeline of the "counts" rows, over the addresses collection"""
+    return [
+        {
+            "$group": {
+                "_id": {
+                    "owner": "$_id.owner",
+                    "source": "$_id.source",
+                    "severity": "$_id.severity",
+                    "kev": "$_id.kev",
+                },
+                "open": {"$sum": "$open"},
+                "ips": {"$sum": 1},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "kind": {"$literal": "counts"},
+                "owner": "$_id.owner",
+                "source": "$_id.source",
+                "severity": "$_id.severity",
+                "kev": "$_id.kev",
+                "open": 1,
+                "ips": 1,
+            }
+        },
+    ]
+
+
+def address_count_pipeline(kind, group_fields):
+    """pipeline of the kind rows counting distinct addresses for each
+    group_fields value, over the addresses collection"""
+    key = dict((field, "$_id." + field) for field in group_fields)
+    key["ip"] = "$_id.ip"
+    project = {"_id": 0, "kind": {"$literal": kind}, "ips": 1}
+    for field in ("owner", "source"):
+        if field in group_fields:
+            project[field] = "$_id." + field
+        else:
+            project[field] = {"$literal": None}
+    return [
+        {"$group": {"_id": key}},
+        {
+            "$group": {
+                "_id": dict((field, "$_id." + field) for field in group_fields),
+                "ips": {"$sum": 1},
+            }
+        },
+        {"$project": project},
+    ]
+
+
+def row_pipelines():
+    return [
+        counts_pipeline(),
+        address_count_pipeline("owner", ["owner", "source"]),
+        address_count_pipeline("owner", ["owner"]),
+        address_count_pipeline("all", ["source"]),
+        address_count_pipeline("all", []),
+    ]
+
+
+def rebuild(db):
+    """Replace the summary with one built from the current tickets."""
+    started = time.time()
+    run_id = uuid.uuid4().hex
+    addresses = db["%s_%s" % (ADDRESSES_COLLECTION, run_id)]
+    build = db["%s_%s" % (BUILD_COLLECTION, run_id)]
+    try:
+        # drain the (empty) cursor so the $out has completed
+        list(
+            db.tickets.aggregate(
+                addresses_pipeline(addresses.name), allowDiskUse=True, cursor={}
+            )
+        )
+        for pipeline in row_pipelines():
+            rows = list()
+            for row in addresses.aggregate(pipeline, allowDiskUse=True, cursor={}):
+                rows.append(row)
+                if len(rows) == INSERT_BATCH_SIZE:
+                    build.insert_many(rows)
+                    rows = list()
+            if rows:
+                build.insert_many(rows)
+        build.insert_one({"kind": "meta", "built": started})
+        build.create_index([("kind", 1), ("source", 1), ("owner", 1)])
+        build.rename(SUMMARY_COLLECTION, dropTarget=True)
+    finally:
+        addresses.drop()
+        build.drop()  # nothing left to drop once renamed
+
+
+def is_fresh(db):
+    meta = db[SUMMARY_COLLECTION].find_one({"kind": "meta"})
+    return meta is not None and time.time() - meta["built"] < MAX_AGE
+
+
+def _owner_query(query, owners):
+    if owners is not None:
+        query["owner"] = {"$in": list(owners)}
+    return query
+
+
+def owner_severity_counts(db, severities, source="nessus"):
+    """returns a dict of owner to a dict of severity to open ticket count"""
+    results = dict()
+    for row in db[SUMMARY_COLLECTION].find(
+        {"kind": "counts", "source": source, "severity": {"$in": list(severities)}}
+    ):
+        counts = results.setdefault(row["owner"], dict())
+        counts[row["severity"]] = counts.get(row["severity"], 0) + row["open"]
+    return results
+
+
+def severity_counts(db, owners=None, source="nessus"):
+    """returns a dict of severity to open ticket count, over owners (all owners
+    when None)"""
+    results = dict()
+    for row in db[SUMMARY_COLLECTION].find(
+        _owner_query({"kind": "counts", "source": source}, owners)
+    ):
+        results[row["severity"]] = results.get(row["severity"], 0) + row["open"]
+    return results
+
+
+def vulnerable_host_count(db, owner=None, source=None):
+    """returns the number of distinct addresses with open tickets from source
+    (any source when None), of owner (all owners when None).  There are no
+    rows for other sets of owners, as an address can have tickets under
+    several of them."""
+    if owner is None:
+        query = {"kind": "all", "source": source}
+    else:
+        query = {"kind": "owner", "owner": owner, "source": source}
+    row = db[SUMMARY_COLLECTION].find_one(query)
+    return row["ips"] if row else 0
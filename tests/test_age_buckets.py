@@ -0,0 +1,104 @@
+"""daily_age_buckets() against the per-day loop it replaced."""
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from ncats_webd.age_buckets import daily_age_buckets
+
+START = pd.Timestamp("2019-01-01", tz="UTC")
+DAYS = pd.date_range(START, periods=120, freq="D")
+NOW = START + pd.Timedelta(days=119, hours=13)
+
+
+def random_tickets(seed, count=500):
+    """Returns the open and close times of count tickets, some opened before
+    the first day and a quarter still open (closed "tomorrow", as the callers
+    account for them)."""
+    rng = np.random.RandomState(seed)
+    opened = START + pd.to_timedelta(rng.uniform(-60, 119, count), unit="D")
+    closed = opened + pd.to_timedelta(rng.uniform(0, 90, count), unit="D")
+    still_open = rng.uniform(size=count) < 0.25
+    closed = closed.where(~still_open, NOW + pd.Timedelta(days=1))
+    return DataFrame({"time_opened": opened, "time_closed": closed})
+
+
+def loop_age_buckets(days, df, cutoffs, labels, age_from):
+    """The per-day loop daily_age_buckets() replaced."""
+    results_df = DataFrame(0, index=days, columns=list(labels) + ["total"])
+    for start_of_day in days:
+        end_of_day = start_of_day + np.timedelta64(1, "D") - np.timedelta64(1, "ns")
+        open_on_day_mask = (df.time_opened <= end_of_day) & (
+            df.time_closed > start_of_day
+        )
+        age_on_date = (start_of_day - age_from)[open_on_day_mask]
+        results_df.loc[start_of_day, "total"] = open_on_day_mask.sum()
+        bounds = [None] + list(cutoffs) + [None]
+        for i, label in enumerate(labels):
+            in_bucket = np.ones(len(age_on_date), dtype=bool)
+            if bounds[i] is not None:
+                in_bucket &= (age_on_date >= bounds[i]).values
+            if bounds[i + 1] is not None:
+                in_bucket &= (age_on_date < bounds[i + 1]).values
+            results_df.loc[start_of_day, label] = in_bucket.sum()
+    return results_df
+
+
+def check(df, cutoffs, labels, age_from=None):
+    expected = loop_age_buckets(
+        DAYS,
+        df,
+        cutoffs,
+        labels,
+        df.time_opened if age_from is None else age_from,
+    )
+    result = daily_age_buckets(
+        DAYS, df.time_opened, df.time_closed, cutoffs, labels, age_from=age_from
+    )
+    assert list(result.columns) == list(labels) + ["total"]
+    assert (result.values == expected.values).all()
+
+
+def test_two_buckets_as_cybex():
+    for seed in range(5):
+        check(random_tickets(seed), [np.timedelta64(30, "D")], ["young", "old"])
+
+
+def test_three_buckets_from_another_time_as_bod():
+    for seed in range(5):
+        df = random_tickets(seed)
+        # the BOD age counts from the later of the open time and the BOD start
+        bod_time_opened = df.time_opened.where(
+            df.time_opened > START + pd.Timedelta(days=10),
+            START + pd.Timedelta(days=10),
+        )
+        check(
+            df,
+            [np.timedelta64(15, "D"), np.timedelta64(30, "D")],
+            ["young", "mid", "old"],
+            age_from=bod_time_opened,
+        )
+
+
+def test_times_on_day_boundaries():
+    for seed in range(5):
+        df = random_tickets(seed)
+        df["time_opened"] = df.time_opened.dt.floor("D")
+        # at midnight, or a nanosecond before it
+        df["time_closed"] = df.time_closed.dt.floor("D") - pd.to_timedelta(
+            np.random.RandomState(seed).randint(0, 2, len(df)), unit="ns"
+        )
+        df["time_closed"] = df.time_closed.where(
+            df.time_closed > df.time_opened, df.time_opened
+        )
+        check(df, [np.timedelta64(30, "D")], ["young", "old"])
+
+
+def test_no_tickets():
+    df = DataFrame(
+        {
+            "time_opened": pd.DatetimeIndex([], tz="UTC"),
+            "time_closed": pd.DatetimeIndex([], tz="UTC"),
+        }
+    )
+    check(df, [np.timedelta64(30, "D")], ["young", "old"])
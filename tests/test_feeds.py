@@ -0,0 +1,263 @@
+"""Feeds of changed documents: polling on an in-memory database, and a change
+stream on a local replica set when there is one."""
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from flask import Flask
+import pymongo
+from pymongo.errors import PyMongoError
+import schedule
+
+from ncats_webd import feeds
+
+LOGGER = logging.getLogger(__name__)
+START = datetime.datetime(2020, 1, 1, 12)
+
+
+class Clock(object):
+    """Stands in for util.utcnow()."""
+
+    def __init__(self):
+        self.now = START
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, **kwargs):
+        self.now += datetime.timedelta(**kwargs)
+
+
+class Emitter(object):
+    def __init__(self):
+        self.batches = list()
+
+    def __call__(self, docs):
+        self.batches.append(docs)
+
+    def names(self):
+        return [[doc["name"] for doc in batch] for batch in self.batches]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(feeds.util, "utcnow", clock)
+    return clock
+
+
+@pytest.fixture
+def polling(monkeypatch):
+    """Runs the polling jobs the feeds schedule."""
+    monkeypatch.setattr(feeds, "change_streams_available", lambda: False)
+    schedule.clear()
+    yield schedule.run_all
+    schedule.clear()
+
+
+def polled_feed(collection, emitter, **kwargs):
+    return feeds.Feed(
+        collection,
+        emitter,
+        LOGGER,
+        query={"open": True},
+        projection={"name": True, "last_change": True},
+        poll_interval=60,
+        **kwargs
+    )
+
+
+def test_polling_emits_what_changed_in_one_batch(clock, polling):
+    tickets = mongomock.MongoClient().db.tickets
+    tickets.insert_many(
+        [
+            {
+                "name": "old",
+                "open": True,
+                "last_change": START - feeds.INITIAL_LOOKBACK,
+            },
+            {"name": "a", "open": True, "last_change": START - datetime.timedelta(1)},
+            {
+                "name": "b",
+                "open": True,
+                "last_change": START - datetime.timedelta(0, 60),
+            },
+            {
+                "name": "c",
+                "open": True,
+                "last_change": START - datetime.timedelta(0, 30),
+            },
+            {"name": "closed", "open": False, "last_change": START},
+        ]
+    )
+    # a and old changed before the first lookback
+    emitter = Emitter()
+    feed = polled_feed(tickets, emitter, since_field="last_change")
+    clock.advance(minutes=1)
+    polling()
+    # newest first, with _ids as strings
+    assert emitter.names() == [["c", "b"]]
+    assert all(isinstance(doc["_id"], str) for doc in emitter.batches[0])
+    assert feed.history == emitter.batches[0]
+
+    clock.advance(minutes=1)
+    polling()
+    assert len(emitter.batches) == 1  # nothing changed, nothing emitted
+
+    # only writes that move since_field are emitted
+    clock.advance(seconds=1)
+    tickets.update_one({"name": "a"}, {"$set": {"last_change": clock.now}})
+    tickets.update_one({"name": "b"}, {"$set": {"details": "unchanged"}})
+    tickets.update_one({"name": "closed"}, {"$set": {"last_change": clock.now}})
+    clock.advance(seconds=1)
+    tickets.update_one({"name": "c"}, {"$set": {"last_change": clock.now}})
+    clock.advance(minutes=1)
+    polling()
+    assert emitter.names() == [["c", "b"], ["c", "a"]]
+    assert [doc["name"] for doc in feed.history] == ["c", "b", "c", "a"]
+
+
+def test_polling_without_since_field_emits_every_match(clock, polling):
+    tickets = mongomock.MongoClient().db.tickets
+    tickets.insert_many(
+        [
+            {"name": "a", "open": True, "last_change": START - datetime.timedelta(1)},
+            {"name": "b", "open": False, "last_change": START},
+        ]
+    )
+    emitter = Emitter()
+    polled_feed(tickets, emitter)
+    polling()
+    polling()
+    assert emitter.names() == [["a"], ["a"]]
+
+
+def test_history_is_bounded(clock, polling):
+    tickets = mongomock.MongoClient().db.tickets
+    emitter = Emitter()
+    feed = polled_feed(tickets, emitter, since_field="last_change", history_size=3)
+    for name in "abcde":
+        clock.advance(seconds=1)
+        tickets.insert_one({"name": name, "open": True, "last_change": clock.now})
+        clock.advance(seconds=1)
+        polling()
+    assert emitter.names() == [[name] for name in "abcde"]
+    assert [doc["name"] for doc in feed.history] == ["c", "d", "e"]
+
+
+###############################################################################
+#  Change stream
+###############################################################################
+
+
+@pytest.fixture
+def replica_set_collection():
+    """A collection on the replica set at NCATS_WEBD_TEST_MONGODB_URI (or on
+    localhost), skipping the test if there isn't one."""
+    if not feeds.change_streams_available():
+        pytest.skip("change streams need pymongo 3.9")
+    client = pymongo.MongoClient(
+        os.environ.get("NCATS_WEBD_TEST_MONGODB_URI", "mongodb://localhost:27017/"),
+        serverSelectionTimeoutMS=500,
+    )
+    try:
+        is_master = client.admin.command("isMaster")
+    except PyMongoError:
+        pytest.skip("no local MongoDB")
+    if "setName" not in is_master:
+        pytest.skip("the local MongoDB is not a replica set")
+    collection = client.ncats_webd_test.feed_tickets
+    collection.drop()
+    yield collection
+    collection.drop()
+    client.close()
+
+
+class FlakyCollection(object):
+    """A collection whose change streams fail once fail is set, noting the
+    resume token each stream is opened with."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.fail = threading.Event()
+        self.resumed_after = list()
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def watch(self, *args, **kwargs):
+        self.resumed_after.append(kwargs.get("resume_after"))
+        return FlakyStream(self.collection.watch(*args, **kwargs), self.fail)
+
+
+class FlakyStream(object):
+    def __init__(self, stream, fail):
+        self.stream = stream
+        self.fail = fail
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stream.close()
+
+    @property
+    def alive(self):
+        return self.stream.alive
+
+    @property
+    def resume_token(self):
+        return self.stream.resume_token
+
+    def try_next(self):
+        if self.fail.is_set():
+            self.fail.clear()
+            raise PyMongoError("connection lost")
+        return self.stream.try_next()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_change_stream_resumes_after_the_last_batch(
+    replica_set_collection, monkeypatch
+):
+    monkeypatch.setattr(feeds, "RETRY_DELAY", 0.5)
+    tickets = FlakyCollection(replica_set_collection)
+    emitter = Emitter()
+    with Flask(__name__).app_context():
+        feed = feeds.Feed(
+            tickets, emitter, LOGGER, since_field="last_change", batch_window=0.5
+        )
+    wait_for(lambda: tickets.resumed_after)
+    time.sleep(0.5)  # caught up with what changed before the stream opened
+    assert tickets.resumed_after == [None]
+
+    for name in "ab":
+        replica_set_collection.insert_one(
+            {"name": name, "last_change": feeds.util.utcnow()}
+        )
+    wait_for(lambda: emitter.batches)
+    # gathered into one batch
+    assert sorted(emitter.names()[0]) == ["a", "b"]
+    wait_for(lambda: feed._Feed__resume_token is not None)
+
+    tickets.fail.set()
+    replica_set_collection.insert_one({"name": "c", "last_change": feeds.util.utcnow()})
+    wait_for(lambda: len(tickets.resumed_after) == 2)
+    assert tickets.resumed_after[1] is not None
+    wait_for(lambda: len(emitter.batches) == 2)
+    time.sleep(1)
+    # c once, and nothing emitted again
+    assert emitter.names()[1:] == [["c"]]
@@ -0,0 +1,87 @@
+"""Election of the worker that runs the background jobs, between app
+instances sharing a lock file as the gunicorn workers do."""
+
+import threading
+import time
+
+import pytest
+from flask import Flask, current_app
+
+from ncats_webd import leader
+
+
+class Instance(object):
+    """An app electing itself with its own lock on path, as a worker does."""
+
+    def __init__(self, name, path):
+        self.app = Flask(name)
+        self.lock = leader.LeaderLock(path)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        with self.app.app_context():
+            leader.lead(self.lock)
+
+
+@pytest.fixture
+def elected(monkeypatch):
+    """The names of the apps that ran the on_elected jobs, in order."""
+    monkeypatch.setattr(leader, "RETRY_INTERVAL", 0.01)
+    names = list()
+    monkeypatch.setattr(
+        leader, "_elected_callbacks", [lambda: names.append(current_app.name)]
+    )
+    return names
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_only_one_instance_is_elected(tmpdir, elected):
+    path = str(tmpdir.join(leader.LOCK_FILENAME))
+    instances = [Instance("first", path), Instance("second", path)]
+    for instance in instances:
+        instance.thread.start()
+    wait_for(lambda: elected)
+    time.sleep(0.1)  # many retries
+    assert len(elected) == 1
+    assert [i.lock.is_leader for i in instances].count(True) == 1
+    assert int(tmpdir.join(leader.LOCK_FILENAME).read()) > 0
+    for instance in instances:
+        instance.lock.release()
+
+
+def test_the_other_instance_takes_over(tmpdir, elected):
+    path = str(tmpdir.join(leader.LOCK_FILENAME))
+    first = Instance("first", path)
+    first.thread.start()
+    wait_for(lambda: elected)
+    second = Instance("second", path)
+    second.thread.start()
+    time.sleep(0.1)
+    assert elected == ["first"]
+    assert not second.lock.is_leader
+
+    first.lock.release()  # as the kernel does when the worker exits
+    wait_for(lambda: len(elected) == 2)
+    assert elected == ["first", "second"]
+    assert second.lock.is_leader
+    second.lock.release()
+
+
+def test_the_callbacks_failures_are_logged(tmpdir, monkeypatch):
+    ran = list()
+
+    def fails():
+        raise ValueError("no database")
+
+    monkeypatch.setattr(leader, "_elected_callbacks", [fails, lambda: ran.append(1)])
+    instance = Instance("only", str(tmpdir.join(leader.LOCK_FILENAME)))
+    instance.run()
+    assert ran == [1]
+    instance.lock.release()
@@ -0,0 +1,61 @@
+"""create_app()'s check that several workers have a socket.io message queue."""
+
+import pytest
+
+pytest.importorskip("cyhy.core")
+
+from ncats_webd import ncats_webd
+from ncats_webd.common import socketio
+
+
+class SocketIOInitialized(Exception):
+    pass
+
+
+@pytest.fixture
+def config(tmpdir):
+    """Returns a function writing a config file with the given settings."""
+
+    def write(**settings):
+        path = tmpdir.join("cyhy.conf")
+        lines = ["[DEFAULT]", "default-section = test", "[test]", "cache-type = simple"]
+        lines += ["%s = %s" % item for item in settings.items()]
+        path.write("\n".join(lines) + "\n")
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def init_app(monkeypatch):
+    """Stops create_app() when it initializes socket.io, returning the
+    keyword arguments it was called with."""
+    kwargs = dict()
+
+    def stop(app, **init_kwargs):
+        kwargs.update(init_kwargs)
+        raise SocketIOInitialized()
+
+    monkeypatch.setattr(socketio, "init_app", stop)
+    return kwargs
+
+
+def test_several_workers_need_a_message_queue(config, init_app):
+    with pytest.raises(SystemExit):
+        ncats_webd.create_app(config_filename=config(), workers=2)
+    assert not init_app
+
+
+def test_several_workers_with_the_test_queue(config, init_app):
+    with pytest.raises(SocketIOInitialized):
+        ncats_webd.create_app(
+            config_filename=config(**{"socketio-message-queue": "memory://"}),
+            workers=2,
+        )
+    assert init_app["message_queue"] == "memory://"
+
+
+def test_one_worker_needs_no_message_queue(config, init_app):
+    with pytest.raises(SocketIOInitialized):
+        ncats_webd.create_app(config_filename=config(), workers=1)
+    assert init_app["message_queue"] is None
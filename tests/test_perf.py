@@ -0,0 +1,52 @@
+"""Two workers publishing their figures through a shared cache backend."""
+
+import time
+
+import pytest
+
+backends = pytest.importorskip("flask_caching.backends")
+
+from ncats_webd import perf
+
+
+def worker(monkeypatch, pid, seconds):
+    """Has this process pose as worker pid, with the figures of one call."""
+    monkeypatch.setattr(perf.os, "getpid", lambda: pid)
+    monkeypatch.setattr(perf, "_values", dict())
+    perf.observe("ncats_webd_job_seconds", seconds, job="job")
+
+
+def test_each_worker_is_listed_with_its_own_figures(monkeypatch):
+    shared = backends.SimpleCache()
+    worker(monkeypatch, 101, 0.002)
+    perf.publish(shared)
+    worker(monkeypatch, 102, 7)
+    perf.publish(shared)
+    # published again, replacing its first figures
+    perf.observe("ncats_webd_job_seconds", 7, job="job")
+    perf.publish(shared)
+    worker(monkeypatch, 103, 0.2)
+
+    workers = perf.worker_values(shared)
+    assert sorted(workers) == [101, 102, 103]
+    entries = perf.snapshot(workers)["ncats_webd_job_seconds"]
+    by_pid = dict((entry["labels"]["pid"], entry) for entry in entries)
+    assert sorted(by_pid) == ["101", "102", "103"]
+    assert [by_pid[pid]["count"] for pid in ["101", "102", "103"]] == [1, 2, 1]
+    assert by_pid["102"]["sum"] == 14
+
+    text = perf.prometheus_text(workers)
+    assert 'ncats_webd_job_seconds_count{job="job",pid="101"} 1' in text
+    assert 'ncats_webd_job_seconds_count{job="job",pid="102"} 2' in text
+
+
+def test_a_worker_that_stops_publishing_is_left_out(monkeypatch):
+    shared = backends.SimpleCache()
+    monkeypatch.setattr(perf, "WORKER_TIMEOUT", 1)
+    worker(monkeypatch, 101, 1)
+    perf.publish(shared)
+    time.sleep(1.1)
+    worker(monkeypatch, 102, 1)
+    perf.publish(shared)
+    worker(monkeypatch, 103, 1)
+    assert sorted(perf.worker_values(shared)) == [102, 103]
@@ -0,0 +1,147 @@
+"""ticketReport.ticket_counts_by_fiscal_year() against the per-year queries it
+replaced, on an in-memory database."""
+
+import datetime
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from ncats_webd.blueprints.metrics import ticketReport
+
+FY_START = datetime.datetime(2019, 10, 1)  # FY2020
+
+
+class TicketDB(object):
+    """The db.TicketDoc.collection the function reads from."""
+
+    def __init__(self, tickets):
+        collection = mongomock.MongoClient().db.tickets
+        if tickets:
+            collection.insert_many([dict(ticket) for ticket in tickets])
+        self.TicketDoc = type("TicketDoc", (object,), {"collection": collection})
+
+
+def ticket(opened, closed=None, is_open=None, false_positive=False, source="nessus"):
+    return {
+        "source": source,
+        "false_positive": false_positive,
+        "time_opened": opened,
+        "time_closed": closed,
+        "open": closed is None if is_open is None else is_open,
+    }
+
+
+def counted(tickets):
+    return [t for t in tickets if t["source"] == "nessus" and not t["false_positive"]]
+
+
+def query_counts(tickets, fy_start):
+    """The counts of the three queries each fiscal year used to run."""
+    fy_end = fy_start.replace(year=fy_start.year + 1)
+
+    def during(value):
+        return value is not None and fy_start <= value < fy_end
+
+    tickets = counted(tickets)
+    opened = sum(1 for t in tickets if during(t["time_opened"]))
+    open_tix = sum(
+        1
+        for t in tickets
+        if during(t["time_opened"])
+        or during(t["time_closed"])
+        or (t["time_opened"] < fy_start and t["open"])
+        or (
+            t["time_opened"] < fy_start
+            and not t["open"]
+            and t["time_closed"] is not None
+            and t["time_closed"] >= fy_end
+        )
+    )
+    closed = sum(1 for t in tickets if during(t["time_closed"]))
+    return opened, open_tix, closed
+
+
+def query_ticket_counts(tickets, current_fy_start):
+    """What ticket_counts_by_fiscal_year() returned before."""
+    by_year = dict()
+    totals = {"opened": 0, "closed": 0}
+    fy_start = current_fy_start
+    while True:
+        opened, open_tix, closed = query_counts(tickets, fy_start)
+        if not opened:
+            return by_year, totals
+        by_year[str(fy_start.year + 1)] = {
+            "opened": opened,
+            "open": open_tix,
+            "closed": closed,
+        }
+        totals["opened"] += opened
+        totals["closed"] += closed
+        fy_start = fy_start.replace(year=fy_start.year - 1)
+
+
+def d(*args):
+    return datetime.datetime(*args)
+
+
+TICKETS = [
+    # closed in the year it was opened
+    ticket(d(2019, 11, 5), d(2019, 12, 1)),
+    # closed the next fiscal year
+    ticket(d(2018, 3, 1), d(2018, 10, 2)),
+    # open through two whole fiscal years
+    ticket(d(2017, 5, 1), d(2019, 11, 30)),
+    # still open
+    ticket(d(2017, 10, 1)),
+    ticket(d(2019, 12, 24)),
+    # closed without a time_closed
+    ticket(d(2018, 12, 1), None, is_open=False),
+    # on the fiscal year boundaries
+    ticket(d(2018, 9, 30, 23, 59, 59), d(2018, 10, 1)),
+    ticket(d(2018, 10, 1), d(2019, 9, 30, 23, 59, 59)),
+    # reopened, so open with an old time_closed
+    ticket(d(2017, 2, 1), d(2017, 6, 1), is_open=True),
+    # not counted
+    ticket(d(2018, 1, 1), false_positive=True),
+    ticket(d(2018, 1, 1), source="nmap"),
+]
+
+
+def test_counts_match_the_per_year_queries():
+    result = ticketReport.ticket_counts_by_fiscal_year(TicketDB(TICKETS), FY_START)
+    assert result == query_ticket_counts(TICKETS, FY_START)
+
+
+def test_counts_by_hand():
+    by_year, totals = ticketReport.ticket_counts_by_fiscal_year(
+        TicketDB(TICKETS), FY_START
+    )
+    assert sorted(by_year) == ["2017", "2018", "2019", "2020"]
+    assert by_year["2020"] == {"opened": 2, "open": 5, "closed": 2}
+    assert by_year["2019"] == {"opened": 2, "open": 7, "closed": 3}
+    assert by_year["2018"] == {"opened": 3, "open": 5, "closed": 0}
+    assert by_year["2017"] == {"opened": 2, "open": 2, "closed": 1}
+    assert totals == {"opened": 9, "closed": 6}
+
+
+def test_stops_at_the_first_year_without_tickets_opened():
+    tickets = [
+        ticket(d(2019, 11, 1)),
+        ticket(d(2018, 11, 1), d(2019, 1, 1)),
+        # FY2018 has none, so FY2017 isn't reported
+        ticket(d(2016, 11, 1), d(2019, 11, 1)),
+    ]
+    by_year, totals = ticketReport.ticket_counts_by_fiscal_year(
+        TicketDB(tickets), FY_START
+    )
+    assert sorted(by_year) == ["2019", "2020"]
+    assert by_year == query_ticket_counts(tickets, FY_START)[0]
+    assert totals == {"opened": 2, "closed": 2}
+
+
+def test_no_tickets():
+    assert ticketReport.ticket_counts_by_fiscal_year(TicketDB([]), FY_START) == (
+        {},
+        {"opened": 0, "closed": 0},
+    )